@@ -1,21 +1,54 @@
 #! /usr/bin/env python
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
-from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
-
-from .config import get_db_url
-from .models import (
-    init_session,
-)
+# Imports are done in main(), so that the CLI tools importing caramel.config
+# and caramel.models don't pay for pyramid.config.
 
 
 def main(global_config, **settings):
     """This function returns a Pyramid WSGI application."""
+    from pyramid.config import Configurator
+    from pyramid.settings import asbool
+    from pyramid.tweens import INGRESS
+    from sqlalchemy import engine_from_config
+
+    from . import queries, sqlite
+    from .config import (
+        get_db_url,
+        get_replica_db_url,
+        get_replica_max_lag,
+        get_slow_sql_seconds,
+        get_sqlite_profile,
+        get_timing,
+        init_profiling,
+    )
+    from .models import init_session
+
     settings["sqlalchemy.url"] = get_db_url(settings=settings)
-    engine = engine_from_config(settings, "sqlalchemy.")
-    init_session(engine)
+    profile = asbool(get_sqlite_profile(None, settings, default=False))
+    options = sqlite.engine_options(settings["sqlalchemy.url"]) if profile else {}
+    engine = engine_from_config(settings, "sqlalchemy.", **options)
+    if profile:
+        sqlite.apply_profile(engine, settings)
+    replica = None
+    replica_url = get_replica_db_url(settings=settings)
+    if replica_url:
+        settings["replica.sqlalchemy.url"] = replica_url
+        replica = engine_from_config(settings, "replica.sqlalchemy.")
+    max_lag = float(get_replica_max_lag(settings=settings))
+    init_session(engine, replica=replica, max_lag=max_lag)
+    timing = asbool(get_timing(None, settings, default=False))
+    slow = get_slow_sql_seconds(settings=settings)
+    if timing or slow is not None:
+        for bind in (engine, replica):
+            if bind is not None:
+                queries.install(bind, slow)
+    # caramel_serve loads the app before forking, so workers inherit this
+    init_profiling(None, settings)
     config = Configurator(settings=settings)
     config.include("pyramid_tm")
+    if timing:
+        # Outermost, so the commit and error views are timed too
+        config.add_tween("caramel.timing.timing_tween_factory", under=INGRESS)
     config.add_route("ca", "/root.crt", request_method="GET")
     config.add_route("cabundle", "/bundle.crt", request_method="GET")
     config.add_route("csr", "/{sha256:[0-9a-f]{64}}", request_method="POST")
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.backlog estimates when a request waiting for signing should be
+polled again, for the Retry-After header of 202 responses"""
+
+import bisect
+import datetime
+import math
+import threading
+import time
+
+from .models import CSR, AutosignBatch
+
+
+class Backlog(object):
+    """Retry-After estimates from the position of a request in the unsigned
+    queue and the autosigner's signing capacity, its workers over their sign
+    latency in the last `window` seconds. Both are read from the database at
+    most every `ttl` seconds, and only the first `limit` queued ids are kept.
+    Estimates are clamped to [minimum, maximum] seconds. Without a recent
+    capacity, as on an idle server, requests are told to come back after
+    `minimum` seconds, the autosigner signs them within its own delay."""
+
+    def __init__(self, minimum=5, maximum=300, window=300, ttl=10, limit=10000):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.ttl = ttl
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._ids = []
+        self._total = 0
+        # Certificates per second, None when unknown
+        self._capacity = None
+        self._batches = False
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded is not None and now - self._loaded < self.ttl:
+                return
+            self._loaded = now
+            self._ids = CSR.unsigned_ids(limit=self.limit)
+            if len(self._ids) < self.limit:
+                self._total = len(self._ids)
+            else:
+                self._total = CSR.unsigned_count()
+            if not self._batches:
+                # Until the autosigner has created it
+                self._batches = AutosignBatch.table_exists()
+            if self._batches:
+                since = datetime.datetime.utcnow() - datetime.timedelta(
+                    seconds=self.window
+                )
+                self._capacity = AutosignBatch.capacity_since(since)
+
+    def position(self, csr_id):
+        """How many requests are signed before csr_id, or None if it is no
+        longer queued"""
+        self._refresh()
+        ids = self._ids
+        index = bisect.bisect_left(ids, csr_id)
+        if index < len(ids) and ids[index] == csr_id:
+            return index
+        if ids and csr_id < ids[-1]:
+            # Signed or rejected since the snapshot was taken
+            return None
+        # Newer than the snapshot, so at the end of the queue
+        return max(self._total, len(ids))
+
+    def clamp(self, seconds):
+        return int(min(self.maximum, max(self.minimum, math.ceil(seconds))))
+
+    def retry_after(self, csr_id):
+        """Seconds until the unsigned request csr_id is worth polling again"""
+        position = self.position(csr_id)
+        if position is None:
+            return self.minimum
+        if not self._capacity:
+            return self.minimum
+        return self.clamp((position + 1) / self._capacity)
@@ -4,12 +4,13 @@
 in one place used by the caramel CLI tools/scripts"""
 
 import argparse
+import configparser
 import logging
 import os
-from logging.config import dictConfig
+from logging.config import dictConfig, fileConfig
 
-import pyramid.paster as paster
-from pyramid.scripting import prepare
+# pyramid, sqlalchemy and caramel.models are imported where used, the CLI
+# tools run often and should not pay for building the web application.
 
 LOG_LEVEL = {
     "ERROR": logging.ERROR,
@@ -105,6 +106,15 @@ def add_db_url_argument(parser):
     )
 
 
+def add_replica_db_url_argument(parser):
+    """Adds an argument for the URL for a read replica of the database"""
+    parser.add_argument(
+        "--replica-dburl",
+        help="URL to a read replica of the database, used for listing",
+        type=str,
+    )
+
+
 def add_verbosity_argument(parser):
     """Adds an argument for verbosity to a given parser, counting the amount of
     'v's and 'verbose' on the commandline"""
@@ -117,6 +127,20 @@ def add_verbosity_argument(parser):
     )
 
 
+def add_sql_arguments(parser):
+    """Adds arguments for SQL statement statistics and the slow query log"""
+    parser.add_argument(
+        "--slow-sql",
+        help="Log SQL statements taking at least this long (ms)",
+        type=float,
+    )
+    parser.add_argument(
+        "--sql-stats",
+        help="Print how many SQL statements were run, and their time, at exit",
+        action="store_true",
+    )
+
+
 def add_ca_arguments(parser):
     """Adds a ca-cert and ca-key argument to a given parser"""
     parser.add_argument(
@@ -147,6 +171,21 @@ def add_lifetime_arguments(parser):
     )
 
 
+def add_renewal_arguments(parser):
+    """Adds arguments limiting refresh to certs close to expiry"""
+    parser.add_argument(
+        "--renew-hours",
+        help="Only refresh certs with less than this many hours left",
+        type=float,
+    )
+    parser.add_argument(
+        "--renew-percent",
+        help="Only refresh certs with less than this percent of their lifetime "
+        "left. Backdated certs look old, prefer --renew-hours for those",
+        type=float,
+    )
+
+
 def add_backdate_argument(parser):
     """Adds an argument to enable backdating certs"""
     parser.add_argument(
@@ -157,6 +196,34 @@ def add_backdate_argument(parser):
     )
 
 
+def add_metrics_argument(parser):
+    """Adds an argument for where to serve metrics"""
+    parser.add_argument(
+        "--metrics",
+        help="Serve Prometheus metrics on host:port or unix:/path",
+        type=str,
+    )
+
+
+def add_profile_arguments(parser):
+    """Adds arguments for profiling the process on SIGUSR2"""
+    parser.add_argument(
+        "--profile-dir",
+        help="On SIGUSR2, write a profile of the process into this directory",
+        type=str,
+    )
+    parser.add_argument(
+        "--profile-seconds",
+        help="How long a SIGUSR2 profile samples for, default 30",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile-mode",
+        help="Sample all threads (wall), or only those using CPU (cpu)",
+        choices=("wall", "cpu"),
+    )
+
+
 def _get_config_value(
     arguments: argparse.Namespace,
     variable,
@@ -208,6 +275,31 @@ def get_db_url(arguments=None, settings=None, required=True):
     )
 
 
+def get_replica_db_url(arguments=None, settings=None, required=False):
+    """Returns URL to use for the read replica, if any, prefer argument >
+    env-variable > config-file"""
+    return _get_config_value(
+        arguments,
+        variable="replica_dburl",
+        required=required,
+        setting_name="replica.sqlalchemy.url",
+        settings=settings,
+    )
+
+
+def get_replica_max_lag(arguments=None, settings=None, required=False, default=10):
+    """Returns how many seconds the replica may lag before reads go to the
+    primary"""
+    return _get_config_value(
+        arguments,
+        variable="replica_max_lag",
+        required=required,
+        setting_name="replica.max_lag",
+        settings=settings,
+        default=default,
+    )
+
+
 def get_log_level(argument_level, logger=None, env=None):
     """Calculates the highest verbosity(here inverted) from the argument,
     environment and root, capping it to between logging.DEBUG(10)-logging.ERROR(40),
@@ -286,6 +378,35 @@ def get_lifetime_long(
     )
 
 
+def get_renew_hours(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns how many hours left on a cert makes it due for refresh"""
+    return _get_config_value(
+        arguments,
+        variable="renew_hours",
+        required=required,
+        setting_name="refresh.renew_hours",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_renew_percent(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns how many percent of its lifetime left makes a cert due for
+    refresh"""
+    return _get_config_value(
+        arguments,
+        variable="renew_percent",
+        required=required,
+        setting_name="refresh.renew_percent",
+        settings=settings,
+        default=default,
+    )
+
+
 def get_backdate(
     arguments: argparse.Namespace, settings=None, required=False, default=None
 ):
@@ -299,18 +420,200 @@ def get_backdate(
     )
 
 
+def get_metrics_listen(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns where to serve metrics, host:port or unix:/path"""
+    return _get_config_value(
+        arguments,
+        variable="metrics",
+        required=required,
+        setting_name="metrics.listen",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_sqlite_profile(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns if the SQLite production profile should be applied"""
+    return _get_config_value(
+        arguments,
+        variable="sqlite_profile",
+        required=required,
+        setting_name="sqlite.profile",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_slow_sql(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns the time (ms) from which SQL statements are logged as slow"""
+    return _get_config_value(
+        arguments,
+        variable="slow_sql",
+        required=required,
+        setting_name="sql.slow_ms",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_slow_sql_seconds(arguments=None, settings=None):
+    """get_slow_sql in seconds, or None when slow queries aren't logged"""
+    slow = get_slow_sql(arguments, settings)
+    return None if slow is None else float(slow) / 1000
+
+
+def get_timing(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns if request phases should be timed, see caramel.timing"""
+    return _get_config_value(
+        arguments,
+        variable="timing",
+        required=required,
+        setting_name="timing.enabled",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_profile_dir(
+    arguments: argparse.Namespace, settings=None, required=False, default=None
+):
+    """Returns where to write profiles taken on SIGUSR2"""
+    return _get_config_value(
+        arguments,
+        variable="profile_dir",
+        required=required,
+        setting_name="profile.dir",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_profile_seconds(
+    arguments: argparse.Namespace, settings=None, required=False, default=30
+):
+    """Returns how many seconds a profile samples for"""
+    return _get_config_value(
+        arguments,
+        variable="profile_seconds",
+        required=required,
+        setting_name="profile.seconds",
+        settings=settings,
+        default=default,
+    )
+
+
+def get_profile_mode(
+    arguments: argparse.Namespace, settings=None, required=False, default="wall"
+):
+    """Returns if profiles sample wall or CPU time, see caramel.profiling"""
+    return _get_config_value(
+        arguments,
+        variable="profile_mode",
+        required=required,
+        setting_name="profile.mode",
+        settings=settings,
+        default=default,
+    )
+
+
+def init_profiling(arguments, settings):
+    """Profiles the process on SIGUSR2, if a profile directory is configured.
+    Returns the directory"""
+    from caramel import profiling
+
+    directory = get_profile_dir(arguments, settings)
+    if directory:
+        profiling.install(
+            directory,
+            seconds=float(get_profile_seconds(arguments, settings)),
+            mode=get_profile_mode(arguments, settings),
+        )
+    return directory
+
+
+def _read_ini(config_path):
+    """Returns a case preserving ConfigParser for config_path, with the
+    "here" and "__file__" defaults PasteDeploy provides"""
+    path = os.path.abspath(config_path)
+    parser = configparser.ConfigParser(
+        defaults={"here": os.path.dirname(path), "__file__": path}
+    )
+    parser.optionxform = str  # type: ignore
+    with open(path, "rt") as f:
+        parser.read_file(f)
+    return parser
+
+
+def load_settings(config_path=None, section="app:main"):
+    """Reads the app settings from config_path without building the app. ini
+    files that compose their app section from another config file fall back
+    on pyramid.paster. Without a config_path, DEFAULT_APP_SETTINGS"""
+    if not config_path:
+        return dict(DEFAULT_APP_SETTINGS)
+    parser = _read_ini(config_path)
+    if parser.get(section, "use", fallback="").startswith("config:"):
+        import pyramid.paster as paster
+
+        return paster.get_appsettings(config_path)
+    defaults = parser.defaults()
+    return {key: value for key, value in parser.items(section) if key not in defaults}
+
+
+def init_engine(arguments, settings, create=False):
+    """Creates the database engine from the db url in arguments, environment
+    or settings, and the read replica engine if one is configured, and binds
+    caramel.models to them"""
+    from pyramid.settings import asbool
+    from sqlalchemy import create_engine
+
+    from caramel import models, queries, sqlite
+
+    db_url = get_db_url(arguments, settings)
+    profile = asbool(get_sqlite_profile(arguments, settings, default=False))
+    engine = create_engine(db_url, **(sqlite.engine_options(db_url) if profile else {}))
+    if profile:
+        sqlite.apply_profile(engine, settings)
+    replica_url = get_replica_db_url(arguments, settings)
+    replica = create_engine(replica_url) if replica_url else None
+    slow = get_slow_sql_seconds(arguments, settings)
+    for bind in (engine, replica):
+        if bind is not None:
+            queries.install(bind, slow)
+    max_lag = float(get_replica_max_lag(arguments, settings))
+    models.init_session(engine, create=create, replica=replica, max_lag=max_lag)
+    return engine
+
+
 def setup_logging(config_path=None):
-    """wrapper for pyramid.paster.sertup_logging using file at config.path, if
-    no config_path is passed on use dictionary DEFAULT_LOGGING_CONFIG"""
+    """Configures logging from the ini-file at config.path the way
+    pyramid.paster.setup_logging does, if no config_path is passed on use
+    dictionary DEFAULT_LOGGING_CONFIG"""
     if config_path:
-        paster.setup_logging(config_path)
+        parser = _read_ini(config_path)
+        if parser.has_section("loggers"):
+            fileConfig(parser, disable_existing_loggers=False)
+        else:
+            logging.basicConfig()
     else:
         dictConfig(DEFAULT_LOGGING_CONFIG)
 
 
 def bootstrap(config_path=None, dburl=None):
     """wrapper for pyramid.paster.bootstraper, if a config_path is not given
-    then DEFAULT_APP_SETTINGS to bootstrap the app manually"""
+    then DEFAULT_APP_SETTINGS to bootstrap the app manually. This builds the
+    whole WSGI app, CLI tools only needing settings should use
+    load_settings"""
+    import pyramid.paster as paster
+    from pyramid.scripting import prepare
+
     if dburl:
         os.environ["CARAMEL_DBURL"] = dburl
     if config_path:
@@ -325,9 +628,6 @@ def bootstrap(config_path=None, dburl=None):
 
 
 def get_appsettings(config_path):
-    """wrapper for pyramid.paster.get_appsettings, if a config_path is not
-    given then return DEFAULT_APP_SETTINGS"""
-    if config_path:
-        return paster.get_appsettings(config_path)
-    else:
-        return DEFAULT_APP_SETTINGS
+    """Returns the app settings in config_path, see load_settings. If a
+    config_path is not given then return DEFAULT_APP_SETTINGS"""
+    return load_settings(config_path)
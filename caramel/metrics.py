@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.metrics is a small, dependency free, set of counters, gauges and
+histograms that can be served over HTTP in the Prometheus text format"""
+
+import contextlib
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (seconds) suitable for anything from a DB lookup to an RSA sign
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, _escape(v)) for n, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry(object):
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "{} expects labels {}, got {}".format(
+                    self.name, self.labelnames, tuple(labels)
+                )
+            )
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, key, (), value
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.documentation)
+        yield "# TYPE {} {}".format(self.name, self.kind)
+        for name, key, extra, value in self._samples():
+            labels = _format_labels(self.labelnames, key, extra)
+            yield "{}{} {}".format(name, labels, _format_value(value))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kws):
+        super(Histogram, self).__init__(*args, **kws)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing the wall time spent inside it"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def value(self, **labels):
+        """Returns (count, sum) for the given labels"""
+        counts, total = self._values.get(self._key(labels), ((), 0.0))
+        return sum(counts), total
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, (list(c), t)) for k, (c, t) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                extra = (("le", _format_value(bound)),)
+                yield self.name + "_bucket", key, extra, cumulative
+            yield self.name + "_sum", key, (), total
+            yield self.name + "_count", key, (), cumulative
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no peer address
+        return str(self.client_address and self.client_address[0])
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(listen, registry=REGISTRY):
+    """Serve the registry on `listen`, either "host:port" or "unix:/path",
+    from a daemon thread. Returns the server."""
+    handler = type("MetricsHandler", (_Handler,), {"registry": registry})
+    if listen.startswith("unix:"):
+        path = listen[len("unix:") :]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _UnixHTTPServer(path, handler)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = http.server.ThreadingHTTPServer(
+            (host or "127.0.0.1", int(port)), handler
+        )
+        server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on %s", listen)
+    return server
@@ -1,7 +1,11 @@
 #! /usr/bin/env python
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
 
+import contextlib
 import datetime as _datetime
+import logging
+import threading
+import time
 import uuid
 from typing import List
 
@@ -10,10 +14,15 @@ import OpenSSL.crypto as _crypto
 import sqlalchemy as _sa
 import sqlalchemy.orm as _orm
 from pyramid.decorator import reify as _reify
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import as_declarative
 from zope.sqlalchemy import register
 
+from . import timing
+
+logger = logging.getLogger(__name__)
+
 X509_V3 = 0x2  # RFC 2459, 4.1.2.1
 
 # Bitlength to Hash Strength lookup table.
@@ -65,16 +74,122 @@ class SigningCert(object):
         return matches
 
 
+class _epoch(_sa.sql.functions.FunctionElement):
+    """Seconds since the unix epoch of a (naive, UTC) DateTime expression"""
+
+    type = _sa.Float()
+    inherit_cache = True
+
+
+@compiles(_epoch)
+def _compile_epoch(element, compiler, **kw):
+    return "EXTRACT(EPOCH FROM {})".format(compiler.process(element.clauses, **kw))
+
+
+@compiles(_epoch, "sqlite")
+def _compile_epoch_sqlite(element, compiler, **kw):
+    return "((julianday({}) - 2440587.5) * 86400.0)".format(
+        compiler.process(element.clauses, **kw)
+    )
+
+
+@compiles(_epoch, "mysql")
+def _compile_epoch_mysql(element, compiler, **kw):
+    return "UNIX_TIMESTAMP({})".format(compiler.process(element.clauses, **kw))
+
+
+def _utc_timestamp(when):
+    return (when - _datetime.datetime(1970, 1, 1)).total_seconds()
+
+
 # XXX: probably error prone for cases where things are specified by string
 def _fkcolumn(referent, *args, **kwargs):
     refcol = referent.property.columns[0]
     return _sa.Column(refcol.type, _sa.ForeignKey(referent), *args, **kwargs)
 
 
-DBSession = _orm.scoped_session(_orm.sessionmaker())
+class _Replica(object):
+    """The optional read replica, and whether it is close enough to the
+    primary to be used. The lag is checked at most every `interval`
+    seconds."""
+
+    _LAG_SQL = {
+        "postgresql": (
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()"
+            " THEN 0 ELSE COALESCE("
+            "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        ),
+    }
+
+    def __init__(self):
+        self.configure(None)
+        self._lock = threading.Lock()
+
+    def configure(self, engine, max_lag=10.0, interval=5.0):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.interval = interval
+        self._checked = None
+        self._usable = engine is not None
+
+    def lag(self):
+        """Seconds the replica is behind the primary. Databases that can't
+        tell are assumed to be up to date"""
+        sql = self._LAG_SQL.get(self.engine.dialect.name)
+        if sql is None:
+            return 0.0
+        with self.engine.connect() as conn:
+            return float(conn.exec_driver_sql(sql).scalar() or 0)
+
+    def usable(self):
+        if self.engine is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked >= self.interval:
+                self._checked = now
+                try:
+                    lag = self.lag()
+                except _sa.exc.DBAPIError as exc:
+                    logger.warning("Replica unavailable, using primary: %s", exc)
+                    self._usable = False
+                else:
+                    self._usable = lag <= self.max_lag
+                    if not self._usable:
+                        logger.warning("Replica %.1fs behind, using primary", lag)
+            return self._usable
+
+
+REPLICA = _Replica()
+
+
+class RoutingSession(_orm.Session):
+    """Session sending queries to the read replica inside use_replica(), as
+    long as it is usable. Flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get("replica") and not self._flushing and REPLICA.usable():
+            return REPLICA.engine
+        return super(RoutingSession, self).get_bind(mapper, clause, **kw)
+
+
+DBSession = _orm.scoped_session(_orm.sessionmaker(class_=RoutingSession))
 register(DBSession)
 
 
+@contextlib.contextmanager
+def use_replica():
+    """Route the queries inside to the read replica, yields whether it is
+    used. Only for reads that can stand a little replication lag"""
+    session = DBSession()
+    previous = session.info.get("replica", False)
+    session.info["replica"] = True
+    try:
+        yield REPLICA.usable()
+    finally:
+        session.info["replica"] = previous
+
+
 @as_declarative()
 class Base(object):
     @declared_attr  # type: ignore
@@ -84,8 +199,9 @@ class Base(object):
     id = _sa.Column(_sa.Integer, primary_key=True)
 
     def save(self):
-        DBSession.add(self)
-        DBSession.flush()
+        with timing.phase("flush"):
+            DBSession.add(self)
+            DBSession.flush()
 
     @classmethod
     def query(cls):
@@ -97,14 +213,24 @@ class Base(object):
 
 
 # XXX: not the best of names
-def init_session(engine, create=False):
+def init_session(engine, create=False, replica=None, max_lag=10.0):
     DBSession.configure(bind=engine)
+    REPLICA.configure(replica, max_lag=max_lag)
     if create:
         Base.metadata.create_all(engine)
     else:
         Base.metadata.bind = engine
 
 
+def reset_after_fork():
+    """Drop the sessions and pooled connections inherited from a parent
+    process, without closing the parent's connections"""
+    DBSession.remove()
+    for engine in (DBSession.session_factory.kw.get("bind"), REPLICA.engine):
+        if engine is not None:
+            engine.dispose(close=False)
+
+
 # Upper bounds from RFC 5280
 _UB_CN_LEN = 64
 _UB_OU_LEN = 64
@@ -129,7 +255,7 @@ class CSR(Base):
         "Certificate",
         backref="csr",
         cascade_backrefs=False,
-        order_by="Certificate.not_after.desc()",
+        order_by="[Certificate.not_after.desc(), Certificate.id.desc()]",
         lazy="dynamic",
         cascade="all, delete-orphan",
     )
@@ -138,15 +264,16 @@ class CSR(Base):
         # XXX: assert sha256(reqtext).hexdigest() == sha256sum ?
         self.sha256sum = sha256sum
         self.pem = reqtext
-        # FIXME: Below 4 lines (try/except) are duped in the req() function.
-        try:
-            self.req.verify(self.req.get_pubkey())
-        except _crypto.Error:
-            raise ValueError("invalid PEM reqtext")
-        # Check for and reject reqtext with trailing content
-        pem = _crypto.dump_certificate_request(_crypto.FILETYPE_PEM, self.req)
-        if pem != self.pem:
-            raise ValueError("invalid PEM reqtext")
+        with timing.phase("parse"):
+            # FIXME: Below 4 lines (try/except) are duped in the req() function.
+            try:
+                self.req.verify(self.req.get_pubkey())
+            except _crypto.Error:
+                raise ValueError("invalid PEM reqtext")
+            # Check for and reject reqtext with trailing content
+            pem = _crypto.dump_certificate_request(_crypto.FILETYPE_PEM, self.req)
+            if pem != self.pem:
+                raise ValueError("invalid PEM reqtext")
         self.orgunit = self.subject.OU
         self.commonname = self.subject.CN
         self.rejected = False
@@ -175,45 +302,177 @@ class CSR(Base):
 
     @classmethod
     def list_csr_printable(cls):
-        return (
+        return cls.printable().order_by(CSR.id).all()
+
+    @classmethod
+    def printable(
+        cls, signed=None, expiring_before=None, orgunit=None, like=None, ids=None
+    ):
+        """Query of (id, commonname, sha256sum, newest not_after) for valid
+        requests, optionally filtered on being signed, the newest certificate
+        expiring before a datetime, OU, a LIKE pattern for the CN or
+        (first, last) id ranges"""
+        not_after = _sa.func.max(Certificate.not_after)
+        query = (
             DBSession.query(
                 CSR.id,
                 CSR.commonname,
                 CSR.sha256sum,
-                _sa.func.max(Certificate.not_after),
+                not_after,
             )
             .outerjoin(CSR.certificates)
             .group_by(CSR.id)
             .filter(CSR.rejected.is_(False))
-            .order_by(CSR.id)
-            .all()
         )
+        if ids is not None:
+            query = query.filter(
+                _sa.or_(*(CSR.id.between(first, last) for first, last in ids))
+            )
+        if orgunit is not None:
+            query = query.filter(CSR.orgunit == orgunit)
+        if like is not None:
+            query = query.filter(CSR.commonname.like(like, escape="\\"))
+        if signed is True:
+            query = query.having(not_after.isnot(None))
+        elif signed is False:
+            query = query.having(not_after.is_(None))
+        if expiring_before is not None:
+            # Unsigned requests have no not_after and never match
+            query = query.having(not_after < expiring_before)
+        return query
+
+    @classmethod
+    def iter_printable(cls, page_size=1000, signed=None, **filters):
+        """Yields the rows of printable(), signed requests first and each
+        part in id order, fetching page_size rows at a time by id"""
+        if signed is None and filters.get("expiring_before") is not None:
+            signed = True
+        parts = (True, False) if signed is None else (signed,)
+        for part in parts:
+            after_id = 0
+            while True:
+                page = (
+                    cls.printable(signed=part, **filters)
+                    .filter(CSR.id > after_id)
+                    .order_by(CSR.id)
+                    .limit(page_size)
+                    .all()
+                )
+                yield from page
+                if len(page) < page_size:
+                    break
+                after_id = page[-1].id
 
     @classmethod
-    def refreshable(cls):
+    def refreshable(
+        cls, renew_within=None, renew_fraction=None, limit=None, after_id=None
+    ):
         """Using "valid" and looking at csr.certificates doesn't scale.
-        Better to do it in the Query."""
+        Better to do it in the Query.
+
+        renew_within (a timedelta) and renew_fraction (of the lifetime) limit
+        the result to requests whose newest certificate has less than that
+        left. With neither, every signed request is returned. limit and
+        after_id walk the result in id order."""
 
         # Options subqueryload is to prevent thousands of small queries and
         # instead batch load the certificates at once
         all_signed = _sa.select(Certificate.csr_id)
+        if renew_within is not None or renew_fraction is not None:
+            all_signed = cls._renewal_due(renew_within, renew_fraction)
+        query = cls.query().filter_by(rejected=False).filter(CSR.id.in_(all_signed))
+        if limit is not None or after_id is not None:
+            query = query.order_by(CSR.id)
+        if after_id is not None:
+            query = query.filter(CSR.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @staticmethod
+    def _renewal_due(renew_within=None, renew_fraction=None):
+        """Select of csr_id whose newest certificate is inside the renewal
+        window"""
+        now = _datetime.datetime.utcnow()
+        newest = (
+            _sa.select(
+                Certificate.csr_id,
+                _sa.func.max(Certificate.not_after).label("not_after"),
+            )
+            .group_by(Certificate.csr_id)
+            .subquery()
+        )
+        latest = _orm.aliased(Certificate)
+        conditions = []
+        if renew_within is not None:
+            conditions.append(newest.c.not_after < now + renew_within)
+        if renew_fraction is not None:
+            not_after = _epoch(latest.not_after)
+            lifetime = not_after - _epoch(latest.not_before)
+            remaining = not_after - _utc_timestamp(now)
+            conditions.append(remaining < lifetime * renew_fraction)
         return (
-            cls.query().filter_by(rejected=False).filter(CSR.id.in_(all_signed)).all()
+            _sa.select(newest.c.csr_id)
+            .join(
+                latest,
+                _sa.and_(
+                    latest.csr_id == newest.c.csr_id,
+                    latest.not_after == newest.c.not_after,
+                ),
+            )
+            .where(_sa.or_(*conditions))
+        )
+
+    @classmethod
+    def unsigned(cls, limit=None, after_id=None):
+        """Unsigned, non-rejected requests in id order. limit and after_id
+        allow walking a large backlog in batches."""
+        all_signed = _sa.select(Certificate.csr_id)
+        query = (
+            cls.query()
+            .filter_by(rejected=False)
+            .filter(CSR.id.notin_(all_signed))
+            .order_by(CSR.id)
         )
+        if after_id is not None:
+            query = query.filter(CSR.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
     @classmethod
-    def unsigned(cls):
+    def unsigned_count(cls):
         all_signed = _sa.select(Certificate.csr_id)
         return (
             cls.query()
             .filter_by(rejected=False)
             .filter(CSR.id.notin_(all_signed))
-            .all()
+            .count()
+        )
+
+    @classmethod
+    def unsigned_ids(cls, limit=None):
+        """Ids of unsigned, non-rejected requests in id order, the order the
+        autosigner works through them"""
+        all_signed = _sa.select(Certificate.csr_id)
+        query = (
+            DBSession.query(cls.id)
+            .filter_by(rejected=False)
+            .filter(cls.id.notin_(all_signed))
+            .order_by(cls.id)
         )
+        if limit is not None:
+            query = query.limit(limit)
+        return [csr_id for csr_id, in query]
 
     @classmethod
-    def by_sha256sum(cls, sha256sum):
-        return cls.query().filter_by(sha256sum=sha256sum).one()
+    def by_sha256sum(cls, sha256sum, populate_existing=False):
+        """The request with sha256sum. populate_existing reloads it if it is
+        already in the session, as when it was read from the replica"""
+        query = cls.query()
+        if populate_existing:
+            query = query.populate_existing()
+        return query.filter_by(sha256sum=sha256sum).one()
 
     def __json__(self, request):
         url = request.route_url("cert", sha256=self.sha256sum)
@@ -246,6 +505,25 @@ class AccessLog(Base):
         self.csr = csr
         self.addr = addr
 
+    @classmethod
+    def iter_trace(cls, since=None, until=None, page_size=10000):
+        """Yields (id, when, addr, csr_id) of the accesses from since up to
+        until, in id order, fetching page_size rows at a time by id"""
+        query = DBSession.query(cls.id, cls.when, cls.addr, cls.csr_id)
+        if since is not None:
+            query = query.filter(cls.when >= since)
+        if until is not None:
+            query = query.filter(cls.when < until)
+        after_id = 0
+        while True:
+            page = (
+                query.filter(cls.id > after_id).order_by(cls.id).limit(page_size).all()
+            )
+            yield from page
+            if len(page) < page_size:
+                break
+            after_id = page[-1].id
+
     def __str__(self):
         return (
             "<{0.__class__.__name__} id={0.id} " "csr={0.csr.sha256sum} when={0.when}>"
@@ -255,6 +533,99 @@ class AccessLog(Base):
         return "<{0.__class__.__name__} id={0.id}>".format(self)
 
 
+class RefreshRun(Base):
+    """Progress of a "caramel_tool --refresh" pass, so an interrupted one can
+    be resumed"""
+
+    started = _sa.Column(
+        _sa.DateTime, default=_datetime.datetime.utcnow, nullable=False
+    )
+    # NULL until the pass has gone through every request
+    finished = _sa.Column(_sa.DateTime)
+    last_csr_id = _sa.Column(_sa.Integer)
+    signed = _sa.Column(_sa.Integer, default=0, nullable=False)
+    failed = _sa.Column(_sa.Integer, default=0, nullable=False)
+
+    @classmethod
+    def ensure_table(cls):
+        """Databases created before refresh checkpoints lack the table"""
+        cls.__table__.create(DBSession.get_bind(), checkfirst=True)
+
+    @classmethod
+    def latest(cls):
+        return cls.query().order_by(cls.id.desc()).first()
+
+    def __repr__(self):
+        return (
+            "<{0.__class__.__name__} id={0.id} "  # (no comma)
+            "last_csr_id={0.last_csr_id} finished={0.finished}>"
+        ).format(self)
+
+
+class AutosignBatch(Base):
+    """Certificates the autosigner signed in one batch, the seconds its
+    workers spent signing them and how many workers it has, for the signing
+    capacity behind Retry-After. caramel_tool signs in bursts of its own, and
+    is not counted. Batches older than a day are pruned as new ones come in."""
+
+    finished = _sa.Column(
+        _sa.DateTime, default=_datetime.datetime.utcnow, nullable=False, index=True
+    )
+    signed = _sa.Column(_sa.Integer, nullable=False)
+    seconds = _sa.Column(_sa.Float, nullable=False, default=0.0)
+    workers = _sa.Column(_sa.Integer, nullable=False, default=1)
+
+    # Seconds of batches to keep
+    KEEP = 24 * 3600
+
+    @classmethod
+    def ensure_table(cls):
+        """Databases created before autosign batches were kept lack the
+        table"""
+        cls.__table__.create(DBSession.get_bind(), checkfirst=True)
+
+    @classmethod
+    def table_exists(cls):
+        return _sa.inspect(DBSession.get_bind()).has_table(cls.__tablename__)
+
+    @classmethod
+    def record(cls, signed, seconds=0.0, workers=1, now=None):
+        """Add a batch of signed certificates, taking seconds of signing
+        summed over the workers, and prune the old ones"""
+        if now is None:
+            now = _datetime.datetime.utcnow()
+        DBSession.add(
+            cls(finished=now, signed=signed, seconds=seconds, workers=workers)
+        )
+        oldest = now - _datetime.timedelta(seconds=cls.KEEP)
+        cls.query().filter(cls.finished < oldest).delete(synchronize_session=False)
+        DBSession.flush()
+
+    @classmethod
+    def capacity_since(cls, when):
+        """Certificates per second the autosigner can sign, its workers times
+        the mean sign latency of the batches from when or later, or None
+        without any"""
+        signed, seconds, workers = (
+            DBSession.query(
+                _sa.func.sum(cls.signed),
+                _sa.func.sum(cls.seconds),
+                _sa.func.max(cls.workers),
+            )
+            .filter(cls.finished >= when)
+            .one()
+        )
+        if not signed or not seconds:
+            return None
+        return workers * signed / seconds
+
+    def __repr__(self):
+        return (
+            "<{0.__class__.__name__} id={0.id} "  # (no comma)
+            "finished={0.finished} signed={0.signed} seconds={0.seconds}>"
+        ).format(self)
+
+
 class Extension(object):
     """Convenience class to make validating Extensions a bit easier"""
 
@@ -325,6 +696,69 @@ class Certificate(Base):
     def __repr__(self):
         return "<{0.__class__.__name__} id={0.id}>".format(self)
 
+    @classmethod
+    def newest_for(cls, csr_ids):
+        """Returns a dict of csr_id to the newest certificate, for the given
+        csr ids"""
+        newest = {}
+        query = (
+            cls.query()
+            .filter(cls.csr_id.in_(csr_ids))
+            .order_by(cls.csr_id, cls.not_after.desc(), cls.id.desc())
+        )
+        for cert in query:
+            newest.setdefault(cert.csr_id, cert)
+        return newest
+
+    @classmethod
+    def superseded(cls, csr_id=None, rejected=True):
+        """Select of ids of certificates that are not the newest for their
+        CSR, optionally only for one CSR. Of certificates expiring at the same
+        time, the last one made is the newest. rejected=False leaves the
+        certificates of rejected requests out"""
+        newer = _orm.aliased(cls)
+        newer_exists = (
+            _sa.select(newer.id)
+            .where(newer.csr_id == cls.csr_id)
+            .where(
+                _sa.or_(
+                    newer.not_after > cls.not_after,
+                    _sa.and_(newer.not_after == cls.not_after, newer.id > cls.id),
+                )
+            )
+            .exists()
+        )
+        selection = _sa.select(cls.id).where(newer_exists)
+        if csr_id is not None:
+            selection = selection.where(cls.csr_id == csr_id)
+        if not rejected:
+            rejected_ids = _sa.select(CSR.id).where(CSR.rejected.is_(True))
+            selection = selection.where(cls.csr_id.notin_(rejected_ids))
+        return selection
+
+    @classmethod
+    def of_csr(cls, csr_id):
+        """Select of ids of all certificates for a CSR"""
+        return _sa.select(cls.id).where(cls.csr_id == csr_id)
+
+    @staticmethod
+    def count_selected(selection):
+        subquery = selection.subquery()
+        return DBSession.execute(
+            _sa.select(_sa.func.count()).select_from(subquery)
+        ).scalar()
+
+    @classmethod
+    def delete_selected(cls, selection, limit):
+        """Delete up to limit of the selected certificates, returning how many
+        were deleted. Ids are fetched first, as not every database allows a
+        DELETE to select from its own table."""
+        ids = DBSession.execute(selection.order_by(cls.id).limit(limit)).scalars()
+        ids = list(ids)
+        if ids:
+            cls.query().filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        return len(ids)
+
     @classmethod
     def sign(cls, CSR, ca, lifetime=_datetime.timedelta(30 * 3), backdate=False):
         """Takes a CSR, signs it, generating and returning a Certificate.
@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.profiling samples the stacks of every thread of a running
+process, without restarting it. With profile.dir set, a SIGUSR2 samples for
+profile.seconds and writes caramel-<pid>-<time>.folded into profile.dir, in
+the collapsed format flamegraph.pl and speedscope read.
+
+Wall mode counts every thread at every sample, waiting ones too. CPU mode
+only counts the threads that got CPU time since the previous sample, read
+from /proc on Linux, and falls back on wall mode elsewhere.
+
+caramel_tool --profile samples a whole command the same way, or runs it
+under cProfile for paths ending in .pstats."""
+
+import collections
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between samples
+INTERVAL = 0.005
+MODES = ("wall", "cpu")
+
+_PACKAGE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _frame_name(code):
+    filename = os.path.abspath(code.co_filename)
+    if filename.startswith(_PACKAGE):
+        filename = "caramel/" + os.path.relpath(filename, _PACKAGE)
+    else:
+        filename = os.path.basename(filename)
+    return "{}:{}".format(filename, code.co_name)
+
+
+def collapse(frame, thread_name=None):
+    """The stack of frame, outermost first and separated by ;"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if thread_name is not None:
+        names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def _cpu_time(native_id):
+    """Nanoseconds thread native_id has run, None without /proc"""
+    try:
+        with open("/proc/self/task/{}/schedstat".format(native_id), "rb") as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Sampler(object):
+    """Counts the stacks of the other threads every interval seconds"""
+
+    def __init__(self, mode="wall", interval=INTERVAL):
+        if mode not in MODES:
+            raise ValueError("Unknown profile mode {!r}".format(mode))
+        # Native thread ids are new in Python 3.8
+        get_native_id = getattr(threading, "get_native_id", None)
+        if mode == "cpu" and (
+            get_native_id is None or _cpu_time(get_native_id()) is None
+        ):
+            logger.warning("No per thread CPU time here, profiling wall time")
+            mode = "wall"
+        self.mode = mode
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._cpu = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self, skip=None):
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            thread = threads.get(ident)
+            if self.mode == "cpu" and thread is not None:
+                cpu = _cpu_time(thread.native_id)
+                previous = self._cpu.get(ident)
+                self._cpu[ident] = cpu
+                if cpu is None or previous is None or cpu == previous:
+                    continue
+            name = thread.name if thread is not None else str(ident)
+            self.stacks[collapse(frame, name)] += 1
+        self.samples += 1
+
+    def run(self, seconds=None):
+        """Samples from this thread until stop(), or for seconds"""
+        deadline = None if seconds is None else time.monotonic() + seconds
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(skip=me)
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+    def start(self):
+        """Samples from a daemon thread until stop()"""
+        self._thread = threading.Thread(
+            target=self.run, name="caramel-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path):
+        """Writes the stacks in the collapsed format, most sampled first"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class _Profile(object):
+    """A profile of the rest of the process, written to path by stop()"""
+
+    def __init__(self, path, mode="wall"):
+        self.path = path
+        if path.endswith(".pstats"):
+            # cProfile only sees the thread that enabled it
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+            self._sampler = None
+        else:
+            self._sampler = Sampler(mode)
+            self._sampler.start()
+
+    def stop(self):
+        if self._sampler is None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.path)
+        else:
+            self._sampler.stop()
+            self._sampler.write(self.path)
+
+
+def start(path, mode="wall"):
+    """Profiles the process until stop() is called on the returned object,
+    into a pstats file if path ends with .pstats, collapsed stacks otherwise"""
+    return _Profile(path, mode)
+
+
+def profile_to(directory, seconds, mode="wall"):
+    """Samples the process for seconds, returns the collapsed stacks file
+    written into directory"""
+    path = os.path.join(
+        directory,
+        "caramel-{}-{}.folded".format(os.getpid(), time.strftime("%Y%m%dT%H%M%S")),
+    )
+    sampler = Sampler(mode)
+    sampler.run(seconds)
+    sampler.write(path)
+    return path
+
+
+def install(directory, seconds=30, mode="wall", signum=signal.SIGUSR2):
+    """Profiles the process into directory for seconds on every signum, one
+    profile at a time. Returns False if signals can't be handled here, like
+    outside the main thread"""
+    busy = threading.Lock()
+
+    def profile():
+        if not busy.acquire(blocking=False):
+            logger.warning("Already profiling, ignoring %s", signum)
+            return
+        try:
+            logger.warning("Profiling for %ss", seconds)
+            path = profile_to(directory, seconds, mode)
+            logger.warning("Wrote profile %s", path)
+        except Exception:
+            logger.exception("Profiling failed")
+        finally:
+            busy.release()
+
+    def handler(signum, frame):
+        # Signal handlers run between bytecodes of the main thread, so leave
+        # the sampling, and the logging, to a thread of its own
+        threading.Thread(target=profile, name="caramel-profiler", daemon=True).start()
+
+    try:
+        signal.signal(signum, handler)
+    except ValueError as exc:
+        logger.warning("Not profiling on %s: %s", signum, exc)
+        return False
+    return True
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.queries counts and times the SQL statements run inside
+counting(), for a request, or after counting_process(), for a CLI command,
+and logs every statement slower than a threshold (sql.slow_ms) along with
+the caramel code that ran it. Nothing is done for engines install() wasn't
+called on."""
+
+import contextlib
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_THIS = os.path.abspath(__file__)
+_PACKAGE = os.path.dirname(_THIS)
+_stats: contextvars.ContextVar = contextvars.ContextVar("sql_stats", default=None)
+# Counts statements from every thread, once counting_process() is called
+_process = None
+
+
+class QueryStats(object):
+    """Statements run, and seconds spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self._lock = threading.Lock()
+
+    def add(self, statement, seconds):
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            self.statements.append(statement)
+
+    def __str__(self):
+        return "{} SQL statements in {:.1f}ms".format(self.count, self.seconds * 1000)
+
+
+@contextlib.contextmanager
+def counting():
+    """Counts the statements run inside, in this thread, yields the
+    QueryStats"""
+    stats = QueryStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+def counting_process():
+    """Counts the statements of all threads from now on, returns the
+    QueryStats"""
+    global _process
+    _process = QueryStats()
+    return _process
+
+
+def call_site():
+    """file:line of the innermost caramel code on the stack, outside of
+    this module"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_PACKAGE) and filename != _THIS:
+            return "{}:{}".format(os.path.relpath(filename, _PACKAGE), frame.f_lineno)
+        frame = frame.f_back
+    return "?"
+
+
+def install(engine, slow=None):
+    """Hooks engine up to counting(), and logs statements taking at least
+    slow seconds, if given"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context._caramel_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._caramel_started
+        for stats in (_stats.get(), _process):
+            if stats is not None:
+                stats.add(statement, seconds)
+        if slow is not None and seconds >= slow:
+            logger.warning(
+                "Slow query, %.1fms from %s: %s",
+                seconds * 1000,
+                call_site(),
+                " ".join(statement.split()),
+            )
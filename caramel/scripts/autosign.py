@@ -27,57 +27,189 @@ import concurrent.futures
 import datetime
 import logging
 import sys
+import threading
 import time
 import uuid
 
-import transaction
-from sqlalchemy import create_engine
-
 import caramel.models as models
-from caramel import config
-from caramel.config import (
-    bootstrap,
-    setup_logging,
-)
+from caramel import config, metrics, sqlite
+from caramel.config import setup_logging
 
 logger = logging.getLogger(__name__)
 
+QUEUE_DEPTH = metrics.Gauge(
+    "caramel_autosign_unsigned", "Unsigned, non-rejected requests waiting"
+)
+SIGN_SECONDS = metrics.Histogram(
+    "caramel_autosign_sign_seconds",
+    "Time spent signing and storing one certificate",
+    labelnames=("bits",),
+)
+SIGNED = metrics.Counter(
+    "caramel_autosign_signed_total", "Certificates issued by the autosigner"
+)
+SIGN_RATE = metrics.Gauge(
+    "caramel_autosign_signs_per_second", "Signing throughput of the last batch"
+)
+SKIPPED = metrics.Counter(
+    "caramel_autosign_skipped_total",
+    "Requests the autosigner will not sign",
+    labelnames=("reason",),
+)
+FAILURES = metrics.Counter(
+    "caramel_autosign_failures_total",
+    "Signing attempts that raised",
+    labelnames=("reason",),
+)
+LOOP_SECONDS = metrics.Histogram(
+    "caramel_autosign_loop_seconds", "Duration of one mainloop iteration"
+)
+QUERY_SECONDS = metrics.Histogram(
+    "caramel_autosign_db_query_seconds",
+    "Time spent in autosign queries",
+    labelnames=("query",),
+)
+
 
 def csr_sign(csr, ca, delta):
     """Signs a CSR and saves it in a transaction.
     Transaction so we won't have racing with the database.
-    Also validates that it's a UUID for commonname."""
+    Also validates that it's a UUID for commonname.
+    Returns True if a certificate was issued."""
 
     # Could have been by us, or before
     if csr.rejected:
-        return
+        SKIPPED.inc(reason="rejected")
+        return False
 
     try:
         uuid.UUID(csr.commonname)
     except ValueError:
         # not a valid uuid. Just ignore
-        return
+        SKIPPED.inc(reason="not_uuid")
+        return False
 
-    with transaction.manager:
-        cert = models.Certificate.sign(csr, ca, delta)
-        cert.save()
-    return
+    cert = models.Certificate.sign(csr, ca, delta)
+    sqlite.retry_on_busy(cert.save)
+    return True
 
 
-def mainloop(delay, ca, delta):
+def timed_sign(csr, ca, delta):
+    """Runs csr_sign, returning (signed, seconds spent)"""
+    start = time.monotonic()
+    try:
+        signed = csr_sign(csr, ca, delta)
+    except Exception as exc:
+        FAILURES.inc(reason=type(exc).__name__)
+        raise
+    duration = time.monotonic() - start
+    if signed:
+        SIGNED.inc()
+        SIGN_SECONDS.observe(duration, bits=csr.req.get_pubkey().bits())
+    return signed, duration
+
+
+class Pacer(object):
+    """Sizes batches and sleep intervals for the mainloop.
+
+    Batches are sized so that `workers` threads should finish one in about
+    `target` seconds at the observed sign latency, never more than
+    `max_batch`. A full batch means there is more backlog, so the next one
+    starts without sleeping. A pass over the backlog that signed nothing
+    doubles the sleep, up to `max_delay`."""
+
+    # Weight of the newest sample in the latency moving average
+    alpha = 0.3
+
+    def __init__(self, delay, max_delay, max_batch=256, workers=16, target=1.0):
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.max_batch = max(1, max_batch)
+        self.workers = workers
+        self.target = target
+        self.latency = None
+        self.idle_delay = delay
+
+    def observe(self, durations):
+        """Feed the per-CSR sign latencies (seconds) from the last batch"""
+        for duration in durations:
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += self.alpha * (duration - self.latency)
+
+    def batch_size(self):
+        if not self.latency:
+            return min(self.workers, self.max_batch)
+        per_worker = max(1, int(self.target / self.latency))
+        return min(self.max_batch, per_worker * self.workers)
+
+    def next_delay(self, fetched, batch, signed):
+        """Returns how long to sleep, given how many CSRs the last batch
+        fetched out of `batch` and how many the current pass has signed."""
+        if fetched >= batch:
+            return 0
+        if signed:
+            self.idle_delay = self.delay
+            return self.delay
+        delay = self.idle_delay
+        self.idle_delay = min(self.max_delay, self.idle_delay * 2)
+        return delay
+
+
+def mainloop(delay, ca, delta, max_delay=None, max_batch=256, workers=16, stop=None):
     """Concurrent-enabled mainloop.
-    Spins forever and signs all certificates that come in"""
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        while True:
-            csrs = models.CSR.unsigned()
-            futures = [executor.submit(csr_sign, csr, ca, delta) for csr in csrs]
-
-            time.sleep(delay)
+    Spins until stop (a threading.Event) is set, forever by default, and signs
+    all certificates that come in, walking the backlog in batches so
+    in-flight work stays bounded."""
+    if stop is None:
+        stop = threading.Event()
+    if max_delay is None:
+        max_delay = delay
+    pacer = Pacer(delay, max_delay, max_batch=max_batch, workers=workers)
+    # Skipped requests stay unsigned, so walk past them rather than fetching
+    # the same batch again.
+    after_id = None
+    signed = 0
+    models.AutosignBatch.ensure_table()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while not stop.is_set():
+            start = time.monotonic()
+            if after_id is None:
+                with QUERY_SECONDS.time(query="unsigned_count"):
+                    QUEUE_DEPTH.set(models.CSR.unsigned_count())
+            batch = pacer.batch_size()
+            with QUERY_SECONDS.time(query="unsigned"):
+                csrs = models.CSR.unsigned(limit=batch, after_id=after_id)
+            futures = [executor.submit(timed_sign, csr, ca, delta) for csr in csrs]
+
+            durations = []
             for future in concurrent.futures.as_completed(futures):
                 try:
-                    future.result()
+                    did_sign, duration = future.result()
                 except Exception:
                     logger.exception("Future failed")
+                    continue
+                if did_sign:
+                    signed += 1
+                    durations.append(duration)
+            pacer.observe(durations)
+            if durations:
+                sqlite.retry_on_busy(
+                    models.AutosignBatch.record, len(durations), sum(durations), workers
+                )
+            elapsed = time.monotonic() - start
+            LOOP_SECONDS.observe(elapsed)
+            if csrs:
+                SIGN_RATE.set(len(durations) / elapsed)
+
+            sleep = pacer.next_delay(len(csrs), batch, signed)
+            if len(csrs) >= batch:
+                after_id = csrs[-1].id
+            else:
+                after_id = None
+                signed = 0
+            stop.wait(sleep)
 
 
 def cmdline():
@@ -88,18 +220,25 @@ def cmdline():
     config.add_db_url_argument(parser)
     config.add_verbosity_argument(parser)
     config.add_ca_arguments(parser)
+    config.add_metrics_argument(parser)
+    config.add_profile_arguments(parser)
 
     parser.add_argument("--delay", help="How long to sleep. (ms)")
+    parser.add_argument(
+        "--max-delay", help="Longest sleep when there is nothing to sign. (ms)"
+    )
+    parser.add_argument(
+        "--max-batch", help="Most requests to have in flight at once", type=int
+    )
     parser.add_argument("--valid", help="How many hours the certificate is valid for")
 
     args = parser.parse_args()
     return args
 
 
-def error_out(message, closer):
-    """Just log a message, and perform cleanup"""
+def error_out(message):
+    """Just log a message and exit"""
     logger.error(message)
-    closer()
     sys.exit(1)
 
 
@@ -111,14 +250,12 @@ def main():
     setup_logging(config_path)
     config.configure_log_level(args)
 
-    env = bootstrap(config_path, dburl=args.dburl)
-    settings, closer = env["registry"].settings, env["closer"]
-
-    db_url = config.get_db_url(args, settings)
-    engine = create_engine(db_url)
-
-    models.init_session(engine)
-    delay = int(settings.get("delay", 500)) / 1000
+    settings = config.load_settings(config_path)
+    config.init_engine(args, settings)
+    config.init_profiling(args, settings)
+    delay = int(args.delay or settings.get("delay", 500)) / 1000
+    max_delay = int(args.max_delay or settings.get("max_delay", 30000)) / 1000
+    max_batch = int(args.max_batch or settings.get("max_batch", 256))
     valid = int(settings.get("valid", 3))
     delta = datetime.timedelta(days=0, hours=valid)
     del valid
@@ -126,9 +263,13 @@ def main():
     try:
         ca_cert_path, ca_key_path = config.get_ca_cert_key_path(args, settings)
     except ValueError as error:
-        error_out(str(error), closer)
+        error_out(str(error))
     ca = models.SigningCert.from_files(ca_cert_path, ca_key_path)
-    mainloop(delay, ca, delta)
+
+    listen = config.get_metrics_listen(args, settings)
+    if listen:
+        metrics.serve(listen)
+    mainloop(delay, ca, delta, max_delay=max_delay, max_batch=max_batch)
 
 
 if __name__ == "__main__":
@@ -2,14 +2,11 @@
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
 import argparse
 
-from sqlalchemy import create_engine
-
 import caramel.config as config
 from caramel.config import (
-    get_appsettings,
+    load_settings,
     setup_logging,
 )
-from caramel.models import init_session
 
 
 def cmdline():
@@ -26,11 +23,9 @@ def cmdline():
 def main():
     args = cmdline()
     config_path = args.inifile
-    settings = get_appsettings(config_path)
+    settings = load_settings(config_path)
 
     setup_logging(config_path)
     config.configure_log_level(args)
 
-    db_url = config.get_db_url(args, settings)
-    engine = create_engine(db_url)
-    init_session(engine, create=True)
+    config.init_engine(args, settings, create=True)
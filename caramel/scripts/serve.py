@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel_serve runs the web application in several pre-forked waitress
+worker processes sharing one listening socket, so request handling isn't
+limited to a single GIL.
+
+The application, its routes and the CA certificate are loaded once in the
+master before forking. Each worker drops the database connections it
+inherited. SIGHUP reloads the configuration and CA and replaces the
+workers gracefully, SIGTERM and SIGINT stop the server.
+
+Workers are numbered from 0. With metrics.listen set, worker N serves its
+metrics on port + N, or on path-N for unix:path, see
+caramel.timing.metrics_address."""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from caramel import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LISTEN = "0.0.0.0:6543"
+
+# Seconds a worker waits for open connections before exiting anyway
+GRACEFUL_TIMEOUT = 30
+# Handled by the master, and by workers once they have their own handlers
+SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+
+def cmdline():
+    parser = argparse.ArgumentParser()
+
+    config.add_inifile_argument(parser)
+    config.add_db_url_argument(parser)
+    config.add_verbosity_argument(parser)
+
+    parser.add_argument(
+        "--listen",
+        help="host:port to listen on, default from [server:main] or " + DEFAULT_LISTEN,
+        type=str,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of worker processes, default is the number of CPUs",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--threads",
+        help="Number of threads per worker",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        help="Seconds stopping workers wait for open connections",
+        type=float,
+        default=GRACEFUL_TIMEOUT,
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def get_listen(arguments, config_path=None):
+    """Returns host:port from the argument, CARAMEL_LISTEN or the ini-file
+    [server:main] section"""
+    settings = {}
+    if config_path:
+        server = config.load_settings(config_path, section="server:main")
+        if "port" in server:
+            settings["listen"] = "{}:{}".format(
+                server.get("host", "0.0.0.0"), server["port"]
+            )
+    return config._get_config_value(
+        arguments, variable="listen", settings=settings, default=DEFAULT_LISTEN
+    )
+
+
+def bind(listen):
+    """Returns a listening socket for host:port"""
+    host, _, port = listen.rpartition(":")
+    host = host.strip("[]") or "0.0.0.0"
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def load_app(config_path):
+    """Builds the WSGI application and loads what the workers should share"""
+    import pyramid.paster as paster
+
+    from caramel import views
+
+    app = paster.get_app(config_path)
+    if app.registry.settings.get("ca.cert"):
+        views.get_ca(app.registry)
+    return app
+
+
+def run_worker(app, sock, threads=4, graceful_timeout=GRACEFUL_TIMEOUT, worker=0):
+    """Serve app on sock until SIGTERM, then stop accepting and wait up to
+    graceful_timeout for open connections to finish. worker numbers the
+    worker from 0, for the address it serves its metrics on"""
+    from waitress import create_server, wasyncore
+
+    from caramel import models, timing
+
+    models.reset_after_fork()
+    timing.set_worker(worker)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(True))
+    # The master handles these for the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+
+    server = create_server(app, sockets=[sock], threads=threads)
+    deadline = None
+    while True:
+        wasyncore.loop(timeout=1.0, map=server._map, count=1)
+        if stopping and deadline is None:
+            server.accepting = False
+            deadline = time.monotonic() + graceful_timeout
+        if deadline is not None:
+            if not server.active_channels or time.monotonic() >= deadline:
+                break
+    server.task_dispatcher.shutdown()
+
+
+class Master(object):
+    """Forks and supervises the workers. load is called before forking to
+    build the application, again on every reload. Workers are numbered from 0
+    to workers - 1, a replacement gets the number of the worker it replaces"""
+
+    def __init__(
+        self, load, sock, workers=1, threads=4, graceful_timeout=GRACEFUL_TIMEOUT
+    ):
+        self.load = load
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.app = None
+        # pid: number of the running workers
+        self.pids = {}
+        self._signals = []
+
+    def spawn(self, worker):
+        # A SIGTERM sent before the worker has its own handler would otherwise
+        # run the master's, and be lost. Blocked, it waits for run_worker.
+        blocked = signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+            self.pids[pid] = worker
+            return pid
+        status = 0
+        try:
+            run_worker(self.app, self.sock, self.threads, self.graceful_timeout, worker)
+        except BaseException:
+            logger.exception("Worker %s failed", os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self, block=False):
+        """Collect exited workers, returning their pids"""
+        exited = set()
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.pids.clear()
+                break
+            if pid == 0:
+                break
+            if pid in self.pids:
+                del self.pids[pid]
+                exited.add(pid)
+                if status:
+                    logger.warning("Worker %s exited with status %s", pid, status)
+            if block:
+                break
+        return exited
+
+    def reload(self):
+        """Load the application again and replace all workers, returning the
+        pids of the workers being replaced. On failure the current workers
+        are kept"""
+        try:
+            app = self.load()
+        except Exception:
+            logger.exception("Reload failed, keeping the current workers")
+            return set()
+        old, self.app = set(self.pids), app
+        for worker in range(self.workers):
+            self.spawn(worker)
+        self.stop(old)
+        logger.info("Reloaded, replacing workers %s", sorted(old))
+        return old
+
+    def run(self):
+        self.app = self.load()
+        for signum in SIGNALS:
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+        for worker in range(self.workers):
+            self.spawn(worker)
+        logger.info(
+            "Serving on %s with %s workers", self.sock.getsockname(), self.workers
+        )
+
+        replacing = set()
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    replacing |= self.reload()
+                else:
+                    self.shutdown()
+                    return
+            for pid in self.reap():
+                if pid in replacing:
+                    replacing.discard(pid)
+                elif len(self.pids) - len(replacing) < self.workers:
+                    self.spawn(self.free_worker(replacing))
+            time.sleep(0.2)
+
+    def free_worker(self, replacing):
+        """Lowest worker number not used by a worker that is not being
+        replaced"""
+        used = {worker for pid, worker in self.pids.items() if pid not in replacing}
+        return min(set(range(self.workers)) - used)
+
+    def shutdown(self):
+        logger.info("Stopping workers %s", sorted(self.pids))
+        self.stop(self.pids)
+        while self.pids:
+            self.reap(block=True)
+
+
+def main():
+    args = cmdline()
+    config_path = args.inifile
+    if not config_path:
+        print("caramel_serve needs an ini-file", file=sys.stderr)
+        sys.exit(1)
+
+    config.setup_logging(config_path)
+    config.configure_log_level(args)
+    if args.dburl:
+        os.environ["CARAMEL_DBURL"] = args.dburl
+
+    sock = bind(get_listen(args, config_path))
+    master = Master(
+        lambda: load_app(config_path),
+        sock,
+        workers=max(1, args.workers),
+        threads=args.threads,
+        graceful_timeout=args.graceful_timeout,
+    )
+    master.run()
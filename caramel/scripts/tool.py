@@ -3,20 +3,31 @@
 """Admin tool to sign/refresh certificates."""
 
 import argparse
+import atexit
 import concurrent.futures
+import csv
 import datetime
+import json
 import logging
+import re
 import sys
 
+import dateutil.parser
 import transaction
 from dateutil.relativedelta import relativedelta
 from pyramid.settings import asbool
-from sqlalchemy import create_engine
 
-from caramel import config, models
+from caramel import config, models, profiling, queries, sqlite
 
 LOG = logging.getLogger(name="caramel.tool")
 
+# How many requests a refresh signs between checkpoints
+REFRESH_CHUNK = 500
+# How many certificates to delete per transaction when cleaning
+CLEAN_CHUNK = 5000
+# How many requests bulk operations load and store per transaction
+BULK_CHUNK = 200
+
 
 def cmdline():
     """Parse commandline."""
@@ -24,9 +35,13 @@ def cmdline():
 
     config.add_inifile_argument(parser)
     config.add_db_url_argument(parser)
+    config.add_replica_db_url_argument(parser)
     config.add_ca_arguments(parser)
     config.add_backdate_argument(parser)
     config.add_lifetime_arguments(parser)
+    config.add_renewal_arguments(parser)
+    config.add_sql_arguments(parser)
+    config.add_profile_arguments(parser)
 
     parser.add_argument(
         "--long",
@@ -40,6 +55,40 @@ def cmdline():
         action="store_true",
     )
 
+    listing = parser.add_argument_group("--list filters and output")
+    signed = listing.add_mutually_exclusive_group()
+    signed.add_argument(
+        "--signed",
+        help="Only list signed requests",
+        dest="signed",
+        action="store_const",
+        const=True,
+    )
+    signed.add_argument(
+        "--unsigned",
+        help="Only list unsigned requests",
+        dest="signed",
+        action="store_const",
+        const=False,
+    )
+    listing.add_argument(
+        "--expiring-before",
+        metavar="datetime",
+        type=parse_utc,
+        help="Only list requests whose newest cert expires before this (UTC, "
+        "unless it has an offset)",
+    )
+    listing.add_argument("--ou", help="Only list requests in this OU")
+    listing.add_argument(
+        "--cn", metavar="pattern", help="Only list CNs matching this (* and ?)"
+    )
+    listing.add_argument(
+        "--format",
+        choices=("text", "jsonl", "csv"),
+        default="text",
+        help="Output format of --list",
+    )
+
     exclusives = parser.add_mutually_exclusive_group()
     exclusives.add_argument(
         "--sign", metavar="id", type=int, help="Sign the CSR with this id"
@@ -51,6 +100,30 @@ def cmdline():
         help="Reject the CSR with this id",
     )
 
+    exclusives.add_argument(
+        "--sign-bulk",
+        help="Sign every request matched by the selectors",
+        action="store_true",
+    )
+    exclusives.add_argument(
+        "--reject-bulk",
+        help="Reject every request matched by the selectors",
+        action="store_true",
+    )
+    selectors = parser.add_argument_group(
+        "bulk selectors",
+        "--sign-bulk and --reject-bulk act on requests matching all given "
+        "selectors, and the --list filters",
+    )
+    selectors.add_argument(
+        "--ids",
+        metavar="ids",
+        help='Ids and ranges, like "1-10,15". "-" reads them from stdin',
+    )
+    selectors.add_argument(
+        "--cn-regex", metavar="regex", help="CN matches this regular expression"
+    )
+
     cleanout = parser.add_mutually_exclusive_group()
     cleanout.add_argument(
         "--clean",
@@ -78,6 +151,26 @@ def cmdline():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--dry-run",
+        help="Only show what --clean, --wipe, --cleanall or bulk operations "
+        "would do",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted --refresh, nothing if the last one finished",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile",
+        metavar="path",
+        help="Profile the whole command into this file, as collapsed stacks, or "
+        "with cProfile (main thread only) if it ends in .pstats",
+    )
+
     args = parser.parse_args()
     # Didn't find a way to do this with argparse, but I didn't look too hard.
     return args
@@ -91,20 +184,47 @@ def error_out(message, exc=None):
     sys.exit(1)
 
 
-def print_list():
-    """Print a list of certificates."""
-    valid_requests = models.CSR.list_csr_printable()
-
-    def unsigned_last(csr):
-        return (not csr[3], csr.id)
-
-    valid_requests.sort(key=unsigned_last)
-
-    for csr_id, csr_commonname, csr_sha256sum, not_after in valid_requests:
-        not_after = "----------" if not_after is None else str(not_after)
-        output = " ".join((str(csr_id), csr_commonname, csr_sha256sum, not_after))
-        # TODO: Add lifetime of latest (fetched?) cert for the key.
-        print(output)
+def parse_utc(value):
+    """Parse a date and time as a naive UTC datetime, like the database
+    columns, converting from its offset if it has one"""
+    when = dateutil.parser.parse(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def glob_to_like(pattern):
+    """Translate a shell style pattern (* and ?) into a LIKE pattern"""
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def print_list(output_format="text", out=None, **filters):
+    """Print a list of certificates, signed first, as rows arrive from the
+    database. filters are passed on to models.CSR.iter_printable."""
+    if out is None:
+        out = sys.stdout
+    fields = ("id", "commonname", "sha256sum", "not_after")
+    writer = None
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(fields)
+
+    for csr_id, csr_commonname, csr_sha256sum, not_after in models.CSR.iter_printable(
+        **filters
+    ):
+        if output_format == "jsonl":
+            not_after = None if not_after is None else not_after.isoformat()
+            row = dict(zip(fields, (csr_id, csr_commonname, csr_sha256sum, not_after)))
+            out.write(json.dumps(row) + "\n")
+        elif writer is not None:
+            not_after = "" if not_after is None else not_after.isoformat()
+            writer.writerow((csr_id, csr_commonname, csr_sha256sum, not_after))
+        else:
+            not_after = "----------" if not_after is None else str(not_after)
+            output = " ".join((str(csr_id), csr_commonname, csr_sha256sum, not_after))
+            # TODO: Add lifetime of latest (fetched?) cert for the key.
+            out.write(output + "\n")
 
 
 def calc_lifetime(lifetime=relativedelta(hours=24)):
@@ -114,32 +234,49 @@ def calc_lifetime(lifetime=relativedelta(hours=24)):
     return future - now
 
 
-def csr_wipe(csr_id):
-    """Wipe a certain csr."""
+def delete_certificates(selection, dry_run=False, chunk=CLEAN_CHUNK):
+    """Delete the selected certificates, chunk per transaction, and return
+    how many were (or with dry_run, would be) deleted."""
+    if dry_run:
+        with transaction.manager:
+            count = models.Certificate.count_selected(selection)
+        print("Would delete {} certificates".format(count))
+        return count
+
+    total = 0
+    while True:
+        with transaction.manager:
+            deleted = models.Certificate.delete_selected(selection, chunk)
+        total += deleted
+        if deleted < chunk:
+            break
+    print("Deleted {} certificates".format(total))
+    return total
+
+
+def _assert_csr_exists(csr_id):
     with transaction.manager:
-        csr = models.CSR.query().get(csr_id)
-        if not csr:
+        if not models.CSR.query().get(csr_id):
             error_out("ID not found")
-        csr.certificates = []
-        csr.save()
 
 
-def csr_clean(csr_id):
+def csr_wipe(csr_id, dry_run=False):
+    """Wipe a certain csr."""
+    _assert_csr_exists(csr_id)
+    return delete_certificates(models.Certificate.of_csr(csr_id), dry_run)
+
+
+def csr_clean(csr_id, dry_run=False):
     """Clean out old certs."""
-    with transaction.manager:
-        csr = models.CSR.query().get(csr_id)
-        if not csr:
-            error_out("ID not found")
-        certs = [csr.certificates.first()]
-        csr.certificates = certs
-        csr.save()
+    _assert_csr_exists(csr_id)
+    return delete_certificates(models.Certificate.superseded(csr_id), dry_run)
 
 
-def clean_all():
-    """Clean out all old requests."""
-    csrlist = models.CSR.refreshable()
-    for csr in csrlist:
-        csr_clean(csr.id)
+def clean_all(dry_run=False):
+    """Clean out all old certs, keeping the newest for every request. Like
+    before, rejected requests are left alone."""
+    selection = models.Certificate.superseded(rejected=False)
+    return delete_certificates(selection, dry_run)
 
 
 def csr_reject(csr_id):
@@ -152,6 +289,13 @@ def csr_reject(csr_id):
         csr.save()
 
 
+def _would_shorten(cert, timedelta):
+    """Cert hasn't expired, and currently has longer lifetime"""
+    today = datetime.datetime.utcnow()
+    cur_lifetime = cert.not_after - cert.not_before
+    return (cert.not_after > today) and (cur_lifetime > timedelta)
+
+
 def csr_sign(csr_id, ca_cert, timedelta, backdate):
     """Sign a request with ca, valid for timedelta, or backdate as well."""
     with transaction.manager:
@@ -162,27 +306,136 @@ def csr_sign(csr_id, ca_cert, timedelta, backdate):
             error_out("Refusing to sign rejected ID")
 
         cert = csr.certificates.first()
-        if cert:
-            today = datetime.datetime.utcnow()
+        if cert and _would_shorten(cert, timedelta):
             cur_lifetime = cert.not_after - cert.not_before
-            # Cert hasn't expired, and currently has longer lifetime
-            if (cert.not_after > today) and (cur_lifetime > timedelta):
-                msg = (
-                    "Currently has a valid certificate with {} lifetime, "
-                    "new certificate would have {} lifetime. \n"
-                    "Clean out existing certificates before shortening "
-                    "lifetime.\n"
-                    "The old certificate is still out there."
-                )
-                error_out(msg.format(cur_lifetime, timedelta))
+            msg = (
+                "Currently has a valid certificate with {} lifetime, "
+                "new certificate would have {} lifetime. \n"
+                "Clean out existing certificates before shortening "
+                "lifetime.\n"
+                "The old certificate is still out there."
+            )
+            error_out(msg.format(cur_lifetime, timedelta))
 
         cert = models.Certificate.sign(csr, ca_cert, timedelta, backdate)
         cert.save()
 
 
-def refresh(csr, ca_cert, lifetime_short, lifetime_long, backdate):
-    """Refresh a single csr."""
-    last = csr.certificates.first()
+def parse_ids(spec, stdin=None):
+    """Parse an id selection like "1-10,15 17" into a list of inclusive
+    (first, last) ranges. "-" reads the selection from stdin."""
+    if spec == "-":
+        spec = (stdin or sys.stdin).read()
+    ranges = []
+    for part in re.split(r"[\s,]+", spec.strip()):
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        try:
+            ranges.append((int(first), int(last if sep else first)))
+        except ValueError:
+            error_out("Invalid id selection: {}".format(part))
+    return ranges
+
+
+def select_bulk(ids=None, cn_regex=None, **filters):
+    """Yields the printable rows of valid requests matching every given
+    selector. ids are ranges from parse_ids, filters those of
+    models.CSR.iter_printable. Only the regex is matched here, the rest is
+    up to the database."""
+    pattern = re.compile(cn_regex) if cn_regex is not None else None
+    for row in models.CSR.iter_printable(ids=ids, **filters):
+        if pattern is not None and not pattern.search(row.commonname or ""):
+            continue
+        yield row
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _summary(verb, rows, dry_run):
+    """Print the dry run listing, returning the ids to act on"""
+    ids = []
+    for row in rows:
+        ids.append(row.id)
+        if dry_run:
+            print("Would {} {} {}".format(verb, row.id, row.commonname))
+    return ids
+
+
+def bulk_reject(rows, dry_run=False, chunk=BULK_CHUNK):
+    """Reject all requests in rows, chunk per UPDATE. Returns the count."""
+    ids = _summary("reject", rows, dry_run)
+    if dry_run:
+        print("Would reject {} requests".format(len(ids)))
+        return len(ids)
+    for part in _chunked(ids, chunk):
+        with transaction.manager:
+            models.CSR.query().filter(models.CSR.id.in_(part)).update(
+                {"rejected": True}, synchronize_session=False
+            )
+    print("Rejected {} requests".format(len(ids)))
+    return len(ids)
+
+
+def bulk_sign(
+    rows, ca_cert, timedelta, backdate, dry_run=False, chunk=BULK_CHUNK, workers=16
+):
+    """Sign all requests in rows. Signing runs in parallel, while loading
+    and storing is done chunk requests per transaction. Requests that
+    currently have a longer lived, valid, certificate are skipped.
+    Returns (signed, skipped)."""
+    ids = _summary("sign", rows, dry_run)
+    if dry_run:
+        print("Would sign {} requests".format(len(ids)))
+        return 0, 0
+
+    signed = skipped = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for part in _chunked(ids, chunk):
+            with transaction.manager:
+                csrs = models.CSR.query().filter(models.CSR.id.in_(part)).all()
+                newest = models.Certificate.newest_for(part)
+                todo = []
+                for csr in csrs:
+                    cert = newest.get(csr.id)
+                    if cert is not None and _would_shorten(cert, timedelta):
+                        LOG.warning("Skipping %s, has a longer valid cert", csr.id)
+                        skipped += 1
+                    else:
+                        todo.append(csr)
+                futures = [
+                    executor.submit(
+                        models.Certificate.sign, csr, ca_cert, timedelta, backdate
+                    )
+                    for csr in todo
+                ]
+                certs = []
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        certs.append(future.result())
+                    except Exception as exc:  # pylint:disable=broad-except
+                        LOG.error("Signing failed: %s", exc)
+                        skipped += 1
+                models.DBSession.add_all(certs)
+            signed += len(certs)
+    print("Signed {} requests, skipped {}".format(signed, skipped))
+    return signed, skipped
+
+
+def refresh(csr, ca_cert, lifetime_short, lifetime_long, backdate, last=None):
+    """Refresh a single csr. last is its newest certificate, looked up if
+    not given."""
+    if last is None:
+        last = csr.certificates.first()
     old_lifetime = last.not_after - last.not_before
     # In a backdated cert, this is almost always true.
     if old_lifetime >= lifetime_long:
@@ -190,39 +443,117 @@ def refresh(csr, ca_cert, lifetime_short, lifetime_long, backdate):
     else:
         # Never backdate short-lived certs
         cert = models.Certificate.sign(csr, ca_cert, lifetime_short, False)
-    with transaction.manager:
-        cert.save()
-
-
-def csr_resign(ca_cert, lifetime_short, lifetime_long, backdate):
-    """Re-sign all requests for lifetime."""
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+    sqlite.retry_on_busy(cert.save)
+
+
+def _refresh_chunk(executor, csrlist, ca_cert, lifetime_short, lifetime_long, backdate):
+    """Refresh a list of csrs in parallel, returning (signed, failed)."""
+    # One query for the newest certificates, rather than one per request from
+    # the worker threads, which mustn't use this thread's session anyway
+    newest = models.Certificate.newest_for([csr.id for csr in csrlist])
+    futures = [
+        executor.submit(
+            refresh,
+            csr,
+            ca_cert,
+            lifetime_short,
+            lifetime_long,
+            backdate,
+            last=newest.get(csr.id),
+        )
+        for csr in csrlist
+    ]
+    signed = failed = 0
+    for future in concurrent.futures.as_completed(futures):
         try:
-            csrlist = models.CSR.refreshable()
+            future.result()
         except Exception as exc:  # pylint:disable=broad-except
-            error_out("Not found or some other error", exc=exc)
-        futures = (
-            executor.submit(
-                refresh, csr, ca_cert, lifetime_short, lifetime_long, backdate
-            )
-            for csr in csrlist
-        )
-        for future in concurrent.futures.as_completed(futures):
+            LOG.error("Future failed: %s", exc)
+            failed += 1
+        else:
+            signed += 1
+    return signed, failed
+
+
+def _checkpoint(run_id, last_csr_id, signed, failed):
+    run = models.RefreshRun.query().get(run_id)
+    run.last_csr_id = last_csr_id
+    run.signed += signed
+    run.failed += failed
+
+
+def csr_resign(
+    ca_cert,
+    lifetime_short,
+    lifetime_long,
+    backdate,
+    renew_within=None,
+    renew_fraction=None,
+    resume=False,
+    chunk=REFRESH_CHUNK,
+):
+    """Re-sign all requests for lifetime, or only those inside the renewal
+    window if one is given.
+
+    Requests are walked in id order, chunk at a time, and progress is
+    recorded in a RefreshRun after each chunk. With resume the latest run
+    continues where it stopped, or does nothing if it finished."""
+    try:
+        models.RefreshRun.ensure_table()
+        with transaction.manager:
+            run = models.RefreshRun.latest() if resume else None
+            if run is not None and run.finished is not None:
+                LOG.info("Refresh run %s already finished", run.id)
+                return
+            if run is None:
+                run = models.RefreshRun()
+                run.save()
+            run_id, after_id = run.id, run.last_csr_id
+    except Exception as exc:  # pylint:disable=broad-except
+        error_out("Could not record refresh progress", exc=exc)
+    LOG.info("Refresh run %s starting after csr id %s", run_id, after_id)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        while True:
             try:
-                future.result()
+                csrlist = models.CSR.refreshable(
+                    renew_within, renew_fraction, limit=chunk, after_id=after_id
+                )
             except Exception as exc:  # pylint:disable=broad-except
-                LOG.error("Future failed: %s", exc)
+                error_out("Not found or some other error", exc=exc)
+            if not csrlist:
+                break
+            after_id = csrlist[-1].id
+            signed, failed = _refresh_chunk(
+                executor, csrlist, ca_cert, lifetime_short, lifetime_long, backdate
+            )
+            sqlite.retry_on_busy(_checkpoint, run_id, after_id, signed, failed)
+            del csrlist
+
+    with transaction.manager:
+        run = models.RefreshRun.query().get(run_id)
+        run.finished = datetime.datetime.utcnow()
+        LOG.info(
+            "Refresh run %s finished, %s signed, %s failed",
+            run_id,
+            run.signed,
+            run.failed,
+        )
 
 
 def main():
     """Entrypoint of application."""
     args = cmdline()
     logging.basicConfig(format="%(message)s", level=logging.WARNING)
-    env = config.bootstrap(args.inifile, dburl=args.dburl)
-    settings, closer = env["registry"].settings, env["closer"]
-    db_url = config.get_db_url(args, settings)
-    engine = create_engine(db_url)
-    models.init_session(engine)
+    settings = config.load_settings(args.inifile)
+    if args.profile:
+        profile = profiling.start(args.profile, config.get_profile_mode(args, settings))
+        atexit.register(profile.stop)
+    config.init_profiling(args, settings)
+    config.init_engine(args, settings)
+    if args.sql_stats:
+        stats = queries.counting_process()
+        atexit.register(lambda: print(stats, file=sys.stderr))
     settings_backdate = asbool(config.get_backdate(args, settings, default=False))
 
     _short = int(config.get_lifetime_short(args, settings, default=48))
@@ -231,12 +562,22 @@ def main():
     life_long = calc_lifetime(relativedelta(hours=_long))
     del _short, _long
 
-    try:
-        ca_cert_path, ca_key_path = config.get_ca_cert_key_path(args, settings)
-    except ValueError as error:
-        error_out("Error reading ca data", exc=error)
-
-    ca_cert = models.SigningCert.from_files(ca_cert_path, ca_key_path)
+    renew_hours = config.get_renew_hours(args, settings)
+    renew_within = None
+    if renew_hours is not None:
+        renew_within = datetime.timedelta(hours=float(renew_hours))
+    renew_percent = config.get_renew_percent(args, settings)
+    renew_fraction = None
+    if renew_percent is not None:
+        renew_fraction = float(renew_percent) / 100
+
+    ca_cert = None
+    if args.sign or args.sign_bulk or args.refresh or args.resume:
+        try:
+            ca_cert_path, ca_key_path = config.get_ca_cert_key_path(args, settings)
+        except ValueError as error:
+            error_out("Error reading ca data", exc=error)
+        ca_cert = models.SigningCert.from_files(ca_cert_path, ca_key_path)
 
     if life_short > life_long:
         error_out(
@@ -244,21 +585,27 @@ def main():
             f"than long lived certs ({life_long})"
         )
     if args.list:
-        print_list()
-        closer()
+        with models.use_replica():
+            print_list(
+                args.format,
+                signed=args.signed,
+                expiring_before=args.expiring_before,
+                orgunit=args.ou,
+                like=None if args.cn is None else glob_to_like(args.cn),
+            )
         sys.exit(0)
 
     if args.reject:
         csr_reject(args.reject)
 
     if args.wipe:
-        error_out("Not implemented yet")
+        csr_wipe(args.wipe, args.dry_run)
 
     if args.clean:
-        error_out("Not implemented yet")
+        csr_clean(args.clean, args.dry_run)
 
     if args.cleanall:
-        clean_all()
+        clean_all(args.dry_run)
 
     if args.sign:
         if args.long:
@@ -267,5 +614,36 @@ def main():
             # Never backdate short lived certs
             csr_sign(args.sign, ca_cert, life_short, False)
 
-    if args.refresh:
-        csr_resign(ca_cert, life_short, life_long, settings_backdate)
+    if args.sign_bulk or args.reject_bulk:
+        filters = dict(
+            signed=args.signed,
+            expiring_before=args.expiring_before,
+            orgunit=args.ou,
+            like=None if args.cn is None else glob_to_like(args.cn),
+        )
+        if (
+            args.ids is None
+            and args.cn_regex is None
+            and all(value is None for value in filters.values())
+        ):
+            error_out("Bulk operations need at least one selector")
+        ids = None if args.ids is None else parse_ids(args.ids)
+        rows = select_bulk(ids=ids, cn_regex=args.cn_regex, **filters)
+        if args.reject_bulk:
+            bulk_reject(rows, args.dry_run)
+        elif args.long:
+            bulk_sign(rows, ca_cert, life_long, settings_backdate, args.dry_run)
+        else:
+            # Never backdate short lived certs
+            bulk_sign(rows, ca_cert, life_short, False, args.dry_run)
+
+    if args.refresh or args.resume:
+        csr_resign(
+            ca_cert,
+            life_short,
+            life_long,
+            settings_backdate,
+            renew_within,
+            renew_fraction,
+            resume=args.resume,
+        )
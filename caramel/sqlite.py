@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.sqlite holds the opt-in SQLite production profile, enabled with
+sqlite.profile = true, and retry handling for writes that hit a busy
+database.
+
+The profile turns on WAL, so readers no longer block behind the signer,
+and tunes each connection as it is opened. Every pragma can be overridden
+with a sqlite.<pragma> setting."""
+
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+import transaction
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    # Durable on checkpoint, which is enough in WAL mode
+    "synchronous": "NORMAL",
+    # ms to wait for a lock before failing with "database is locked"
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative means KiB rather than pages
+    "cache_size": -64 * 1024,
+}
+
+# Seconds between "PRAGMA optimize" runs
+OPTIMIZE_INTERVAL = 3600
+
+# Writes that find the database busy are retried this many times, sleeping
+# BUSY_DELAY seconds, doubled for each attempt, with jitter
+BUSY_ATTEMPTS = 5
+BUSY_DELAY = 0.05
+
+# Primary result codes, extended codes like SQLITE_BUSY_SNAPSHOT share them
+_SQLITE_BUSY = 5
+_SQLITE_LOCKED = 6
+
+
+def is_file_database(url):
+    """True for SQLite urls that point at a file, not at memory"""
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return False
+    if url.query.get("mode") == "memory":
+        return False
+    return url.database not in (None, "", ":memory:")
+
+
+def engine_options(url):
+    """Extra create_engine arguments for the profile. Pooling keeps the
+    per-connection cache and mmap alive between transactions"""
+    if not is_file_database(url):
+        return {}
+    return {"poolclass": QueuePool, "connect_args": {"check_same_thread": False}}
+
+
+def profile_pragmas(settings=None):
+    """Returns PRAGMAS, with sqlite.<pragma> settings applied"""
+    pragmas = dict(PRAGMAS)
+    for name in pragmas:
+        value = (settings or {}).get("sqlite." + name)
+        if value is not None:
+            pragmas[name] = value
+    return pragmas
+
+
+def apply_profile(engine, settings=None):
+    """Register connect events on engine setting the profile pragmas, and a
+    periodic "PRAGMA optimize". Returns False, leaving the engine alone,
+    if it isn't a file backed SQLite database"""
+    if not is_file_database(engine.url):
+        logger.warning("sqlite.profile set, but %s is not a SQLite file", engine.url)
+        return False
+    pragmas = profile_pragmas(settings)
+    interval = float(
+        (settings or {}).get("sqlite.optimize_interval", OPTIMIZE_INTERVAL)
+    )
+    state = {"optimized": time.monotonic()}
+    lock = threading.Lock()
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute("PRAGMA {} = {}".format(name, value))
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, "checkin")
+    def optimize(dbapi_connection, connection_record):
+        if dbapi_connection is None:
+            return
+        with lock:
+            if time.monotonic() - state["optimized"] < interval:
+                return
+            state["optimized"] = time.monotonic()
+        try:
+            dbapi_connection.execute("PRAGMA optimize")
+        except sqlite3.Error as exc:
+            logger.warning("PRAGMA optimize failed: %s", exc)
+
+    logger.info("SQLite profile enabled: %s", pragmas)
+    return True
+
+
+def is_busy(error):
+    """True if error is SQLite reporting a busy or locked database"""
+    if not isinstance(error, OperationalError):
+        return False
+    orig = error.orig
+    if not isinstance(orig, sqlite3.OperationalError):
+        return False
+    code = getattr(orig, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (_SQLITE_BUSY, _SQLITE_LOCKED)
+    message = str(orig)
+    return "locked" in message or "busy" in message
+
+
+def retry_on_busy(func, *args, **kws):
+    """Run func(*args, **kws) in its own transaction, retrying it if the
+    database is busy. Returns what func returns"""
+    for attempt in range(BUSY_ATTEMPTS):
+        try:
+            with transaction.manager:
+                return func(*args, **kws)
+        except OperationalError as exc:
+            if attempt + 1 >= BUSY_ATTEMPTS or not is_busy(exc):
+                raise
+            sleep = BUSY_DELAY * 2**attempt * random.uniform(0.5, 1.5)
+            logger.debug("Database busy, retrying in %.3fs", sleep)
+            time.sleep(sleep)
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""caramel.timing measures the phases of a request, like reading the body,
+parsing the PEM or flushing to the database, enabled with
+timing.enabled = true.
+
+Phases, and the number of SQL statements, are reported in a Server-Timing
+header, unless timing.header is false, and observed into per route
+histograms, served on metrics.listen if set. With timing disabled the tween
+isn't installed and phase() returns a shared null context."""
+
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+from . import metrics, queries
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = metrics.Histogram(
+    "caramel_request_seconds", "Time spent handling a request", labelnames=("route",)
+)
+REQUEST_STATEMENTS = metrics.Histogram(
+    "caramel_request_sql_statements",
+    "SQL statements run for a request",
+    labelnames=("route",),
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+)
+PHASE_SECONDS = metrics.Histogram(
+    "caramel_request_phase_seconds",
+    "Time spent in each phase of a request",
+    labelnames=("route", "phase"),
+)
+
+# (name, seconds) of the phases of the current request, None when not timed
+_phases: contextvars.ContextVar = contextvars.ContextVar("phases", default=None)
+_NULL = contextlib.nullcontext()
+
+
+class _Phase(object):
+    __slots__ = ("phases", "name", "start")
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.phases.append((self.name, time.perf_counter() - self.start))
+
+
+def phase(name):
+    """Context manager timing the phase name of the current request"""
+    phases = _phases.get()
+    if phases is None:
+        return _NULL
+    return _Phase(phases, name)
+
+
+def server_timing(phases):
+    """Server-Timing header value for (name, seconds), summing repeated
+    phases"""
+    totals = {}
+    for name, seconds in phases:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(
+        "{};dur={:.2f}".format(name, seconds * 1000) for name, seconds in totals.items()
+    )
+
+
+# Number of the caramel_serve worker this process is, None outside caramel_serve
+_worker = None
+
+
+def set_worker(number):
+    """Called by caramel_serve in each worker, see metrics_address"""
+    global _worker
+    _worker = number
+
+
+def metrics_address(listen, worker=None):
+    """Address worker serves the metrics of metrics.listen on, as every
+    caramel_serve worker has its own: port + worker for host:port, path-worker
+    for unix:path. Outside caramel_serve, listen itself"""
+    if worker is None:
+        return listen
+    if listen.startswith("unix:"):
+        return "{}-{}".format(listen, worker)
+    host, _, port = listen.rpartition(":")
+    return "{}:{}".format(host, int(port) + worker)
+
+
+class _MetricsServer(object):
+    """Serves the metrics from the first process that handles a request, so
+    not from a caramel_serve master. A worker replacing one that hasn't exited
+    yet tries again after RETRY seconds"""
+
+    RETRY = 5
+
+    def __init__(self, listen):
+        self.listen = listen
+        self._lock = threading.Lock()
+        self._started = False
+        self._retry_at = 0.0
+
+    def start(self):
+        if self._started or time.monotonic() < self._retry_at:
+            return
+        with self._lock:
+            if self._started or time.monotonic() < self._retry_at:
+                return
+            listen = metrics_address(self.listen, _worker)
+            try:
+                metrics.serve(listen)
+            except OSError as exc:
+                logger.warning("Not serving metrics on %s: %s", listen, exc)
+                self._retry_at = time.monotonic() + self.RETRY
+            else:
+                self._started = True
+
+
+def timing_tween_factory(handler, registry):
+    from pyramid.settings import asbool
+
+    header = asbool(registry.settings.get("timing.header", True))
+    listen = registry.settings.get("metrics.listen")
+    server = _MetricsServer(listen) if listen else None
+
+    def timing_tween(request):
+        if server is not None:
+            server.start()
+        phases = []
+        token = _phases.set(phases)
+        start = time.perf_counter()
+        try:
+            with queries.counting() as sql:
+                response = handler(request)
+        finally:
+            _phases.reset(token)
+        total = time.perf_counter() - start
+        route = request.matched_route.name if request.matched_route else "none"
+        REQUEST_SECONDS.observe(total, route=route)
+        REQUEST_STATEMENTS.observe(sql.count, route=route)
+        for name, seconds in phases:
+            PHASE_SECONDS.observe(seconds, route=route, phase=name)
+        if header:
+            phases.append(("total", total))
+            response.headers["Server-Timing"] = (
+                '{}, sql;desc="{} statements";dur={:.2f}'.format(
+                    server_timing(phases), sql.count, sql.seconds * 1000
+                )
+            )
+        return response
+
+    return timing_tween
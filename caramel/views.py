@@ -16,11 +16,14 @@ from pyramid.view import view_config
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
+from .backlog import Backlog
 from .models import (
     CSR,
     AccessLog,
     SigningCert,
+    use_replica,
 )
+from .timing import phase
 
 # Maximum length allowed for csr uploads.
 # 2 kbyte should be enough for up to 4 kbit keys.
@@ -29,6 +32,40 @@ from .models import (
 _MAXLEN = 2 * 2**10
 
 
+def get_ca(registry):
+    """Returns the CA certificate, read once per application and kept on the
+    registry. caramel_serve loads it before forking workers"""
+    ca = getattr(registry, "caramel_ca", None)
+    if ca is None:
+        ca = registry.caramel_ca = SigningCert.from_files(registry.settings["ca.cert"])
+    return ca
+
+
+def get_backlog(registry):
+    """Returns the Backlog used for Retry-After, one per application"""
+    backlog = getattr(registry, "caramel_backlog", None)
+    if backlog is None:
+        settings = registry.settings
+        backlog = registry.caramel_backlog = Backlog(
+            minimum=int(settings.get("retry_after.min", 5)),
+            maximum=int(settings.get("retry_after.max", 300)),
+            window=int(settings.get("retry_after.window", 300)),
+        )
+    return backlog
+
+
+def set_retry_after(request, csr, queued=True):
+    """Tells the client when to poll for the certificate of csr again.
+    Requests that aren't queued for the autosigner wait the longest"""
+    backlog = get_backlog(request.registry)
+    if queued:
+        with phase("retry_after"), use_replica():
+            seconds = backlog.retry_after(csr.id)
+    else:
+        seconds = backlog.maximum
+    request.response.headers["Retry-After"] = str(seconds)
+
+
 def raise_for_length(req, limit=_MAXLEN):
     # two possible error cases: no length specified, or length exceeds limit
     # raise appropriate exception if either applies
@@ -60,8 +97,9 @@ def HTTPErrorToJson(exc, request):
 @view_config(route_name="csr", request_method="POST", renderer="json")
 def csr_add(request):
     # XXX: do length check in middleware? server?
-    raise_for_length(request)
-    sha256sum = sha256(request.body).hexdigest()
+    with phase("body"):
+        raise_for_length(request)
+        sha256sum = sha256(request.body).hexdigest()
     if sha256sum != request.matchdict["sha256"]:
         raise HTTPBadRequest("hash mismatch ({0})".format(sha256sum))
     try:
@@ -70,10 +108,12 @@ def csr_add(request):
         raise HTTPBadRequest("crypto error: {0}".format(err))
 
     # Verify the parts of the subject we care about
-    ca = SigningCert.from_files(request.registry.settings["ca.cert"])
-    CA_PREFIX = ca.get_ca_prefix()
+    with phase("ca"):
+        ca = get_ca(request.registry)
+        CA_PREFIX = ca.get_ca_prefix()
     try:
-        raise_for_subject(csr.subject_components, CA_PREFIX)
+        with phase("subject"):
+            raise_for_subject(csr.subject_components, CA_PREFIX)
     except ValueError as err:
         raise HTTPBadRequest("Bad subject: {0}".format(err))
 
@@ -85,6 +125,7 @@ def csr_add(request):
         raise HTTPBadRequest("duplicate request")
     # We've accepted the signing request, but there's been no signing yet
     request.response.status_int = 202
+    set_retry_after(request, csr)
     # JSON-rendered data (client could calculate this itself, and often will)
     return csr
 
@@ -93,30 +134,51 @@ def csr_add(request):
 def cert_fetch(request):
     # XXX: JSON-renderer at the moment, to dump
     sha256sum = request.matchdict["sha256"]
-    try:
-        csr = CSR.by_sha256sum(sha256sum)
-    except NoResultFound:
+    csr = cert = None
+    with phase("lookup"), use_replica() as replica:
+        try:
+            csr = CSR.by_sha256sum(sha256sum)
+            cert = csr.certificates.first()
+        except NoResultFound:
+            pass
+    now = datetime.utcnow()
+    if replica and csr is None:
+        # The replica is at most max_lag behind, so a certificate signed
+        # since shows up by the next poll. A request posted since can't
+        # wait, or the client would be told to post it again.
+        with phase("lookup"):
+            try:
+                csr = CSR.by_sha256sum(sha256sum, populate_existing=True)
+            except NoResultFound:
+                raise HTTPNotFound
+            cert = csr.certificates.first()
+    elif csr is None:
         raise HTTPNotFound
     # XXX: Exceptions? remote_addr or client_addr?
     AccessLog(csr, request.remote_addr).save()
     if csr.rejected:
         raise HTTPForbidden
-    cert = csr.certificates.first()
     if cert:
-        if datetime.utcnow() < cert.not_after:
+        if now < cert.not_after:
             # XXX: appropriate content-type is ... ?
-            return Response(
-                cert.pem, content_type="application/octet-stream", charset="UTF-8"
+            # The ETag is the sha256 of the pem, so clients can send the hash
+            # of the certificate they have in If-None-Match
+            response = Response(
+                cert.pem,
+                content_type="application/octet-stream",
+                charset="UTF-8",
+                conditional_response=True,
             )
+            response.etag = sha256(cert.pem).hexdigest()
+            return response
     request.response.status_int = 202
+    set_retry_after(request, csr, queued=cert is None)
     return csr
 
 
 @view_config(route_name="ca", request_method="GET", renderer="string", http_cache=3600)
 def ca_fetch(request):
-    ca_file = request.registry.settings["ca.cert"]
-    ca = SigningCert.from_files(ca_file)
-    return ca.pem.decode("utf8")
+    return get_ca(request.registry).pem.decode("utf8")
 
 
 @view_config(
@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+"""asyncio version of the certificate fetch, for enrolling many identities
+concurrently from one event loop. Needs aiohttp, install the "aio" extra.
+
+    async with AsyncClient(server, ca_cert_file_name, limit=100) as client:
+        failed = await client.perform_all(client_ids)
+
+Requests share one connection pool. At most `limit` fetches run at once.
+Cancelling a task stops its polling at the next await."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import ssl
+
+import aiohttp
+from cryptography import x509
+
+from caramelrequest.certificaterequest import (
+    POLL_INITIAL,
+    POLL_MAX,
+    CertificateRequest,
+    CertificateRequestException,
+    jitter,
+    load_cert,
+    retry_after,
+    verify_cert,
+)
+
+# Seconds for each HTTP request, not the whole (polling) fetch
+TIMEOUT = 60
+
+
+class AsyncClient(object):
+    """Fetches certificates from server, trusting only the CA in
+    ca_cert_file_name, with at most limit fetches running at once"""
+
+    def __init__(self, server, ca_cert_file_name=None, limit=100):
+        self.server = server
+        self.ca_cert_file_name = ca_cert_file_name or server + '.cacert'
+        self.limit = limit
+        self.session = None
+        self._slots = None
+        self._ca_cert = None
+
+    async def __aenter__(self):
+        context = ssl.create_default_context(cafile=self.ca_cert_file_name)
+        connector = aiohttp.TCPConnector(ssl=context, limit=self.limit)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+        self._slots = asyncio.Semaphore(self.limit)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    @property
+    def ca_cert(self):
+        if self._ca_cert is None:
+            self._ca_cert = load_cert(self.ca_cert_file_name)
+        return self._ca_cert
+
+    async def fetch(self, csr, verify=True):
+        """The PEM certificate for csr, a PEM request, posting it if the
+        server hasn't seen it and polling until it is signed. With verify,
+        the certificate must be issued by our CA."""
+        url = 'https://{}/{}'.format(self.server,
+                                     hashlib.sha256(csr).hexdigest())
+        async with self._slots:
+            content = await self._fetch(url, csr)
+        if verify:
+            cert = load_cert_bytes(content)
+            if cert is None or not verify_cert(cert, self.ca_cert):
+                raise CertificateRequestException(
+                    'Certificate from {} is not valid'.format(url))
+        return content
+
+    async def _fetch(self, url, csr):
+        backoff = POLL_INITIAL
+        status, headers, content = await self._request('GET', url)
+        while True:
+            if status == 404:
+                logging.info('CSR not posted; posting it')
+                status, headers, content = await self._request('POST', url,
+                                                               csr)
+            elif status == 202 or status == 304:
+                delay = retry_after(headers)
+                if delay is None:
+                    delay, backoff = backoff, min(POLL_MAX, backoff * 2)
+                delay = jitter(min(POLL_MAX, delay))
+                logging.debug('CSR not processed yet; waiting {:.0f}s ...'
+                              .format(delay))
+                await asyncio.sleep(delay)
+                status, headers, content = await self._request('GET', url)
+            elif status == 200:
+                return content
+            else:
+                raise CertificateRequestException(
+                    'Request failed: HTTP {}: {}'.format(
+                        status, content.decode('utf-8', 'replace')[:200]))
+
+    async def _request(self, method, url, data=None):
+        async with self.session.request(method, url, data=data) as response:
+            return response.status, response.headers, await response.read()
+
+    async def perform(self, client_id):
+        """Like CertificateRequest.perform: make sure the key and CSR files
+        for client_id are in place, fetch the certificate and move it to
+        client_id.crt once verified"""
+        request = CertificateRequest(server=self.server, client_id=client_id,
+                                     ca_cert=self.ca_cert)
+        request.ca_cert_file_name = self.ca_cert_file_name
+        request.assert_ca_cert_available()
+        # Key generation and file checks block, keep them off the loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, request.ensure_verified_inputs)
+        csr, _ = request.get_csr_and_hash()
+        content = await self.fetch(csr)
+        with open(request.crt_temp_file_name, 'wb') as f:
+            f.write(content)
+        os.replace(request.crt_temp_file_name, request.crt_file_name)
+        logging.info('Saved certificate {}'.format(request.crt_file_name))
+
+    async def perform_all(self, client_ids):
+        """perform every client id, returning a dict of the client ids
+        that failed and their exceptions"""
+        client_ids = list(client_ids)
+        results = await asyncio.gather(
+            *(self.perform(client_id) for client_id in client_ids),
+            return_exceptions=True)
+        failed = {}
+        for client_id, result in zip(client_ids, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                logging.error('{}: {}'.format(client_id, result))
+                failed[client_id] = result
+        return failed
+
+
+def load_cert_bytes(data):
+    try:
+        return x509.load_pem_x509_certificate(data)
+    except ValueError:
+        return None
@@ -1,91 +1,167 @@
 #! /usr/bin/env python
 
-import distutils.spawn
+import argparse
+import contextlib
+import datetime
+import email.utils
 import hashlib
+import json
 import logging
 import os
-import subprocess
+import random
 import sys
-import time
 import tempfile
+import time
 from xml.etree import ElementTree as ET
 
 import requests
-
-OPENSSL_CNF = b"""
-# This definition stops the following lines choking if HOME isn't
-# defined.
-HOME            = .
-RANDFILE        = $ENV::HOME/.rnd
-####################################################################
-[ req ]
-default_bits        = 2048
-default_md      = sha256
-default_keyfile     = privkey.pem
-distinguished_name  = req_distinguished_name
-attributes      = req_attributes
-x509_extensions = v3_req    # The extentions to add to the self signed cert
-string_mask = utf8only
-
-[ v3_req ]
-basicConstraints = CA:FALSE
-keyUsage = nonRepudiation, digitalSignature, keyEncipherment
-
-
-[ req_distinguished_name ]
-countryName         = Country Name (2 letter code)
-countryName_default     = AU
-countryName_min         = 2
-countryName_max         = 2
-stateOrProvinceName     = State or Province Name (full name)
-stateOrProvinceName_default = Some-State
-localityName            = Locality Name (eg, city)
-0.organizationName      = Organization Name (eg, company)
-0.organizationName_default  = Internet Widgits Pty Ltd
-organizationalUnitName      = Organizational Unit Name (eg, section)
-commonName          = Common Name (e.g. server FQDN or YOUR name)
-commonName_max          = 64
-emailAddress            = Email Address
-emailAddress_max        = 64
-
-[ req_attributes ]
-challengePassword       = A challenge password
-challengePassword_min       = 4
-challengePassword_max       = 20
-unstructuredName        = An optional company name
-"""
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+KEY_SIZE = 2048
+
+# Seconds between polls for a certificate that isn't signed yet, when the
+# server doesn't say. Doubled for every poll, up to POLL_MAX.
+POLL_INITIAL = 15
+POLL_MAX = 600
+# Shortest wait, whatever the server says, so a Retry-After of 0 can't spin
+POLL_MIN = 1
+# Polls are spread by up to this fraction, so devices don't synchronize
+POLL_JITTER = 0.2
+
+# In daemon mode, certificates are fetched again when this fraction of
+# their lifetime has passed, spread by up to +/- RENEW_JITTER / 2 of the
+# lifetime by a per-device offset
+RENEW_FRACTION = 0.5
+RENEW_JITTER = 0.2
+# Seconds to wait after a failed or unchanged fetch, doubled every time
+RETRY_MIN = 60
+RETRY_MAX = 3600
+
+# The server wants these first, in this order, matching its CA
+SUBJECT_ORDER = (
+    NameOID.COUNTRY_NAME,
+    NameOID.STATE_OR_PROVINCE_NAME,
+    NameOID.LOCALITY_NAME,
+    NameOID.ORGANIZATION_NAME,
+    NameOID.ORGANIZATIONAL_UNIT_NAME,
+)
 
 
 class CertificateRequestException(Exception):
     pass
 
 
+class ValidationState(object):
+    """Input files verified by earlier runs, by path, as their size, mtime
+    and sha256, and when the verification stops being good, kept in a JSON
+    file. A file is still verified while its size and mtime, or failing
+    that its sha256, are the same."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.info('Ignoring invalid state file {}'.format(path))
+
+    def _unchanged(self, path):
+        entry = self.entries.get(path)
+        if not entry:
+            return False
+        if entry.get('valid_until') is not None and \
+                time.time() >= entry['valid_until']:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime']:
+            return True
+        if sha256_file(path) != entry['sha256']:
+            return False
+        entry['mtime'] = stat.st_mtime_ns
+        self.changed = True
+        return True
+
+    def is_verified(self, *paths):
+        return all(self._unchanged(path) for path in paths)
+
+    def record(self, path, valid_until=None):
+        """Remember path as verified, until valid_until if given"""
+        stat = os.stat(path)
+        self.entries[path] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha256': sha256_file(path),
+            'valid_until': None if valid_until is None
+            else valid_until.timestamp(),
+        }
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temp, self.path)
+        self.changed = False
+
+
 class CertificateRequest(object):
-    def __init__(self, *, server, client_id):
+    """Fetches a certificate for client_id from server. session, ca_cert
+    and keygen (a context manager held while generating keys, such as a
+    Semaphore) let many requests share resources."""
+
+    def __init__(self, *, server, client_id, session=None, ca_cert=None,
+                 keygen=None):
         self.server = server
         self.client_id = client_id
+        self.session = session
+        self._ca_cert = ca_cert
+        self.keygen = keygen if keygen is not None else contextlib.nullcontext()
         self.key_file_name = client_id + '.key'
         self.csr_file_name = client_id + '.csr'
         self.crt_temp_file_name = client_id + '.tmp'
         self.crt_file_name = client_id + '.crt'
         self.ca_cert_file_name = server + '.cacert'
+        self.state_file_name = client_id + '.state'
+        # In run_daemon, an interrupted poll stops the daemon rather than
+        # failing the fetch, which would be retried
+        self.daemon = False
 
     def perform(self):
-        self.assert_openssl_available()
         self.assert_ca_cert_available()
-        self.assert_ca_cert_verifies()
-        subject = self.get_subject()
-        self.ensure_valid_key_file()
-        self.ensure_valid_csr_file(subject)
+        self.ensure_verified_inputs()
         self.request_cert_from_server()
         self.assert_temp_cert_verifies()
         self.rename_temp_cert()
 
-    def assert_openssl_available(self):
-        path = distutils.spawn.find_executable('openssl')
-        if path is None:
-            logging.error('Cannot find an openssl executable!')
-            raise CertificateRequestException()
+    def ensure_verified_inputs(self):
+        """Verify the CA, key and CSR files, unless they are unchanged since
+        a previous run verified them"""
+        state = ValidationState(self.state_file_name)
+        if not state.is_verified(self.ca_cert_file_name):
+            self.assert_ca_cert_verifies()
+            state.record(self.ca_cert_file_name,
+                         valid_until=self.ca_cert.not_valid_after_utc)
+        if not state.is_verified(self.key_file_name, self.csr_file_name):
+            key = self.ensure_valid_key_file()
+            self.ensure_valid_csr_file(self.get_subject(), key)
+            state.record(self.key_file_name)
+            state.record(self.csr_file_name)
+        state.save()
 
     def assert_ca_cert_available(self):
         if not os.path.isfile(self.ca_cert_file_name):
@@ -93,24 +169,73 @@ class CertificateRequest(object):
                          .format(self.ca_cert_file_name))
             raise CertificateRequestException()
 
+    @property
+    def ca_cert(self):
+        if self._ca_cert is None:
+            self._ca_cert = load_cert(self.ca_cert_file_name)
+        return self._ca_cert
+
     def assert_ca_cert_verifies(self):
-        result = call_silent('openssl', 'verify',
-                             '-CAfile', self.ca_cert_file_name,
-                             self.ca_cert_file_name)
-        if 0 != result:
+        if self.ca_cert is None or not verify_cert(self.ca_cert, self.ca_cert):
             logging.error('CA cert {} is not valid; bailing'
                           .format(self.ca_cert_file_name))
             raise CertificateRequestException()
 
     def assert_temp_cert_verifies(self):
-        result = call_silent('openssl', 'verify',
-                             '-CAfile', self.ca_cert_file_name,
-                             self.crt_temp_file_name)
-        if 0 != result:
+        cert = load_cert(self.crt_temp_file_name)
+        if cert is None or not verify_cert(cert, self.ca_cert):
             logging.error('Our new cert {} is not valid; bailing'
                           .format(self.crt_temp_file_name))
             raise CertificateRequestException()
 
+    def next_fetch_in(self, fraction=RENEW_FRACTION, jitter=RENEW_JITTER,
+                      now=None):
+        """Seconds until the local certificate is due for a fetch, 0 if it
+        is missing or already due"""
+        cert = load_cert(self.crt_file_name)
+        if cert is None:
+            return 0
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        start = cert.not_valid_before_utc
+        lifetime = cert.not_valid_after_utc - start
+        offset = jitter * (device_offset(self.client_id) - 0.5)
+        due = start + lifetime * min(1.0, max(0.0, fraction + offset))
+        return max(0.0, (due - now).total_seconds())
+
+    def run_daemon(self, fraction=RENEW_FRACTION, jitter=RENEW_JITTER,
+                   retry_min=RETRY_MIN, retry_max=RETRY_MAX,
+                   sleep=time.sleep):
+        """Fetch the certificate whenever it is due, forever. Failures, and
+        fetches that return the certificate we already have, are retried
+        with jittered exponential backoff."""
+        backoff = retry_min
+        self.daemon = True
+        while True:
+            delay = self.next_fetch_in(fraction, jitter)
+            if delay:
+                logging.info('Next fetch in {:.0f}s'.format(delay))
+                sleep(delay)
+            before = not_after(self.crt_file_name)
+            try:
+                self.perform()
+            except (CertificateRequestException, requests.RequestException,
+                    OSError) as exc:
+                logging.warning('Fetch failed: {}'
+                                .format(str(exc) or type(exc).__name__))
+                retry = True
+            else:
+                retry = not_after(self.crt_file_name) == before
+                if retry:
+                    logging.info('Certificate not renewed yet')
+            if not retry:
+                backoff = retry_min
+                continue
+            delay = jitter_delay(backoff)
+            backoff = min(retry_max, backoff * 2)
+            logging.info('Retrying in {:.0f}s'.format(delay))
+            sleep(delay)
+
     def rename_temp_cert(self):
         logging.info('Recieved certificate valid; moving it to {}'
                      .format(self.crt_file_name))
@@ -118,53 +243,50 @@ class CertificateRequest(object):
                   self.crt_file_name)
 
     def get_subject(self):
-        output = check_output_silent('openssl',
-                                     'x509',
-                                     '-subject',
-                                     '-noout',
-                                     '-in', self.ca_cert_file_name)
-        _, value = decode_openssl_utf8(output).strip().split('subject= ', 1)
-        prefix, original_cn = value.split('/CN=')
-        if prefix == '/C=SE/OU=Caramel/L=Linköping/O=Modio AB/ST=Östergötland':
-            prefix = '/C=SE/ST=Östergötland/L=Linköping/O=Modio AB/OU=Caramel'
-        return '{}/CN={}'.format(prefix, self.client_id)
+        """The CA subject, in the order the server expects, with our
+        client_id as CN"""
+        attributes = [attribute for attribute in self.ca_cert.subject
+                      if attribute.oid != NameOID.COMMON_NAME]
+
+        def order(attribute):
+            if attribute.oid in SUBJECT_ORDER:
+                return SUBJECT_ORDER.index(attribute.oid)
+            return len(SUBJECT_ORDER)
+        attributes.sort(key=order)
+        attributes.append(x509.NameAttribute(NameOID.COMMON_NAME,
+                                             self.client_id))
+        return x509.Name(attributes)
 
     def ensure_valid_key_file(self):
-        have_key = False
+        key = None
         if not os.path.isfile(self.key_file_name):
             logging.info('Key file {} does not exist; generating it'
                          .format(self.key_file_name))
-        elif 0 != call_silent('openssl',
-                              'pkey',
-                              '-noout',
-                              '-in', self.key_file_name):
-            logging.info('Key file {} is not valid; regenerating it'
-                         .format(self.key_file_name))
         else:
-            logging.info('Key file {} is valid; using it'
-                         .format(self.key_file_name))
-            have_key = True
-        if not have_key:
-            result = call_silent('openssl',
-                                 'genrsa',
-                                 '-out', self.key_file_name,
-                                 '2048')
-            if result != 0:
-                logging.error('Failed to generate private key!')
-                raise CertificateRequestException()
-
-    def ensure_valid_csr_file(self, subject):
+            key = load_key(self.key_file_name)
+            if key is None:
+                logging.info('Key file {} is not valid; regenerating it'
+                             .format(self.key_file_name))
+            else:
+                logging.info('Key file {} is valid; using it'
+                             .format(self.key_file_name))
+        if key is None:
+            with self.keygen:
+                key = rsa.generate_private_key(public_exponent=65537,
+                                               key_size=KEY_SIZE)
+            pem = key.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+            write_file(self.key_file_name, pem, mode=0o600)
+        return key
+
+    def ensure_valid_csr_file(self, subject, key):
         have_csr = False
         if not os.path.isfile(self.csr_file_name):
             logging.info(('Certificate signing request file {} ' +
                           'does not exist; generating it')
                          .format(self.csr_file_name))
-        elif 0 != call_silent('openssl',
-                              'req',
-                              '-noout',
-                              '-verify',
-                              '-in', self.csr_file_name,
-                              '-key', self.key_file_name):
+        elif not csr_matches_key(self.csr_file_name, key):
             logging.info(('Certificate signing request file {} ' +
                           'is not valid; regenerating it')
                          .format(self.csr_file_name))
@@ -173,39 +295,38 @@ class CertificateRequest(object):
                           'using it').format(self.csr_file_name))
             have_csr = True
         if not have_csr:
-            with tempfile.NamedTemporaryFile() as cnf:
-                cnf.write(OPENSSL_CNF)
-                cnf.flush()
-                result = call_silent('openssl',
-                                     'req',
-                                     '-config', cnf.name,
-                                     '-sha256',
-                                     '-utf8',
-                                     '-new',
-                                     '-key', self.key_file_name,
-                                     '-out', self.csr_file_name,
-                                     '-subj', subject)
-            if result != 0:
-                logging.error('Failed to create certificate signing request!')
-                raise CertificateRequestException()
+            csr = (x509.CertificateSigningRequestBuilder()
+                   .subject_name(subject)
+                   .sign(key, hashes.SHA256()))
+            write_file(self.csr_file_name,
+                       csr.public_bytes(serialization.Encoding.PEM))
 
     def request_cert_from_server(self):
         csr, csr_hash = self.get_csr_and_hash()
         url = 'https://{}/{}'.format(self.server, csr_hash)
 
-        session = requests.Session()
-        session.verify = self.ca_cert_file_name
+        session = self.session
+        if session is None:
+            session = make_session(self.ca_cert_file_name)
 
         response = session.get(url)
+        backoff = POLL_INITIAL
         while True:
             if response.status_code == 404:
                 logging.info('CSR not posted; posting it')
                 response = session.post(url, csr)
             elif response.status_code == 202 or response.status_code == 304:
-                logging.info('CSR not processed yet; waiting ...')
+                delay = retry_after(response.headers)
+                if delay is None:
+                    delay, backoff = backoff, min(POLL_MAX, backoff * 2)
+                delay = jitter(min(POLL_MAX, delay))
+                logging.info('CSR not processed yet; waiting {:.0f}s ...'
+                             .format(delay))
                 try:
-                    time.sleep(15)
+                    time.sleep(delay)
                 except KeyboardInterrupt:
+                    if self.daemon:
+                        raise
                     break
                 response = session.get(url)
             elif response.status_code == 200:
@@ -226,6 +347,18 @@ class CertificateRequest(object):
         return csr, hashlib.sha256(csr).hexdigest()
 
 
+def make_session(ca_cert_file_name, pool_size=None):
+    """A requests Session trusting only our CA, keeping up to pool_size
+    connections alive for use by as many threads"""
+    session = requests.Session()
+    session.verify = ca_cert_file_name
+    if pool_size is not None:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+    return session
+
+
 def printerr(text):
     sys.stderr.write(text + '\n')
 
@@ -243,35 +376,166 @@ def parse_html(response):
                    for e in ET.fromstring(response.text).iterfind('body//'))
 
 
-def decode_openssl_utf8(text):
-    return bytes(ord(x) for x in text.decode('unicode_escape')) \
-        .decode('utf-8')
+def retry_after(headers):
+    """Seconds from the Retry-After header in headers, a case-insensitive
+    mapping, at least POLL_MIN, or None"""
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    if value.isdigit():
+        return max(POLL_MIN, int(value))
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(POLL_MIN, (when - now).total_seconds())
+
+
+def jitter(seconds):
+    return seconds * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
 
 
-def call_silent(*args):
-    return subprocess.call(args,
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
+def jitter_delay(seconds):
+    """Anywhere between half and all of seconds"""
+    return random.uniform(seconds / 2, seconds)
 
 
-def check_output_silent(*args):
-    return subprocess.check_output(args, stderr=subprocess.DEVNULL)
+def device_offset(client_id):
+    """A stable number in [0, 1) for client_id, spreading devices over
+    time the same way on every run"""
+    digest = hashlib.sha256(client_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2**64
+
+
+def sha256_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def not_after(path):
+    cert = load_cert(path)
+    return None if cert is None else cert.not_valid_after_utc
+
+
+def load_cert(path):
+    """Returns the certificate in path, or None if it can't be read"""
+    try:
+        with open(path, 'rb') as f:
+            return x509.load_pem_x509_certificate(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def load_key(path):
+    """Returns the unencrypted private key in path, or None if it can't be
+    read"""
+    try:
+        with open(path, 'rb') as f:
+            return serialization.load_pem_private_key(f.read(), None)
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def verify_cert(cert, ca_cert):
+    """Checks that cert is signed by ca_cert, a CA, and both are currently
+    valid, like "openssl verify -CAfile" does for a one step chain"""
+    try:
+        constraints = ca_cert.extensions.get_extension_for_class(
+            x509.BasicConstraints).value
+    except x509.ExtensionNotFound:
+        return False
+    if not constraints.ca:
+        return False
+    try:
+        cert.verify_directly_issued_by(ca_cert)
+    except (ValueError, TypeError, InvalidSignature):
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return all(c.not_valid_before_utc <= now <= c.not_valid_after_utc
+               for c in (cert, ca_cert))
+
+
+def csr_matches_key(path, key):
+    """Checks that the CSR in path is well signed, and by key"""
+    try:
+        with open(path, 'rb') as f:
+            csr = x509.load_pem_x509_csr(f.read())
+    except (OSError, ValueError):
+        return False
+    spki = (serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+    return (csr.is_signature_valid and
+            csr.public_key().public_bytes(*spki) ==
+            key.public_key().public_bytes(*spki))
+
+
+def write_file(path, data, mode=0o644):
+    """Write data to path through a temporary file, so that path gets mode
+    even if it existed, and never has the data readable under another
+    mode"""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                prefix=os.path.basename(path) + '.')
+    try:
+        with open(fd, 'wb') as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
 
 
 def main():
     logging.basicConfig(level=logging.INFO,
                         format='%(message)s')
 
-    if (len(sys.argv) == 3):
-        server = sys.argv[1]
-        client_id = sys.argv[2]
-    else:
-        print('Usage: {} SERVER CLIENTID\n'.format(sys.argv[0]),
-              file=sys.stderr)
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='Fetch certificates signed by a caramel server')
+    parser.add_argument('server')
+    parser.add_argument('client_id', nargs='?')
+    parser.add_argument('--manifest',
+                        help='File with one client id per line, '
+                             '- for stdin, to fetch them all in one run')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Identities processed at once with --manifest')
+    parser.add_argument('--keygen', type=int, default=os.cpu_count() or 1,
+                        help='Keys generated at once with --manifest')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, fetching the certificate again '
+                             'when it is due')
+    parser.add_argument('--renew-fraction', type=float,
+                        default=RENEW_FRACTION,
+                        help='Fraction of the lifetime after which the '
+                             'certificate is due, with --daemon')
+    parser.add_argument('--renew-jitter', type=float, default=RENEW_JITTER,
+                        help='Fraction of the lifetime renewals are spread '
+                             'over, with --daemon')
+    args = parser.parse_args()
+    if (args.client_id is None) == (args.manifest is None):
+        parser.error('Give either a CLIENTID or --manifest')
+
+    if args.daemon and args.manifest:
+        parser.error('--daemon needs a CLIENTID')
+
+    if args.manifest:
+        from caramelrequest.fleet import perform_all, read_manifest
+        client_ids = read_manifest(args.manifest)
+        failed = perform_all(args.server, client_ids, workers=args.workers,
+                             keygen=args.keygen)
+        sys.exit(1 if failed else 0)
+
+    request = CertificateRequest(server=args.server, client_id=args.client_id)
+    if args.daemon:
+        try:
+            request.run_daemon(args.renew_fraction, args.renew_jitter)
+        except KeyboardInterrupt:
+            sys.exit(0)
 
     try:
-        CertificateRequest(server=server, client_id=client_id).perform()
+        request.perform()
     except CertificateRequestException:
         sys.exit(1)
 
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+"""Fetch certificates for many client ids in one process, sharing the CA,
+one keep-alive connection pool and a bound on concurrent key generation."""
+
+import concurrent.futures
+import logging
+import sys
+import threading
+
+from caramelrequest.certificaterequest import (
+    CertificateRequest,
+    CertificateRequestException,
+    make_session,
+)
+
+
+def read_manifest(path):
+    """Client ids from path, one per line, - for stdin. Blank lines, lines
+    starting with # and repeated client ids, which would have two requests
+    writing the same files, are skipped."""
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as f:
+            lines = f.readlines()
+    client_ids = []
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#') and line not in seen:
+            seen.add(line)
+            client_ids.append(line)
+    return client_ids
+
+
+def perform_all(server, client_ids, workers=8, keygen=1):
+    """Run CertificateRequest.perform for every client id, at most workers
+    at a time and keygen of them generating keys. Returns the client ids
+    that failed."""
+    first = CertificateRequest(server=server, client_id='')
+    first.assert_ca_cert_available()
+    first.assert_ca_cert_verifies()
+    session = make_session(first.ca_cert_file_name, pool_size=workers)
+    limiter = threading.BoundedSemaphore(max(1, keygen))
+
+    def perform(client_id):
+        CertificateRequest(server=server, client_id=client_id,
+                           session=session, ca_cert=first.ca_cert,
+                           keygen=limiter).perform()
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(perform, client_id): client_id
+                   for client_id in client_ids}
+        for future in concurrent.futures.as_completed(futures):
+            client_id = futures[future]
+            try:
+                future.result()
+            except CertificateRequestException:
+                failed.append(client_id)
+            except Exception as exc:
+                logging.error('{}: {}'.format(client_id, exc))
+                failed.append(client_id)
+    session.close()
+    logging.info('Fetched {} certificates, {} failed'
+                 .format(len(client_ids) - len(failed), len(failed)))
+    return failed
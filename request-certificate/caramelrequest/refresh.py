@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+"""caramel-refresh, refreshes the certificates listed in a config file.
+
+One request per line, semicolon (;) separated fields:
+Field 0: CSR filename
+Field 1: CRT filename
+Field 2: PEM filename (optional, for lighttpd and others)
+
+The PEM file is the concatenation of the private key and the certificate,
+the key is assumed to be named as the CSR, s/.csr/.key/.
+
+Certificates are fetched in parallel over keep-alive connections, with
+If-None-Match, and files are only rewritten, atomically, when their
+content changes. The hook, if given, runs for each entry that changed."""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+import requests
+
+DEFAULT_CONFIG = '/etc/caramel-refresh.conf'
+# (connect, read) timeouts in seconds
+TIMEOUT = (30, 60)
+
+
+class Entry(object):
+    def __init__(self, csr, crt, pem=None):
+        self.csr = csr
+        self.crt = crt
+        self.pem = pem or None
+        self.key = csr.replace('.csr', '.key') if self.pem else None
+
+    def __repr__(self):
+        return '{} => {}'.format(self.csr, self.crt)
+
+
+def read_config(path):
+    entries = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(';')]
+            if len(fields) < 2 or not fields[0] or not fields[1]:
+                raise ValueError('{}:{}: each line is: csr filename;'
+                                 'cert filename;pem filename'
+                                 .format(path, number))
+            entries.append(Entry(*fields[:3]))
+    return entries
+
+
+class HashCache(object):
+    """sha256 of files, remembered by path, size and mtime, optionally
+    kept in a JSON file between runs"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                logging.warning('Ignoring unreadable hash cache {}'
+                                .format(path))
+
+    def sha256(self, path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        cached = self.entries.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.entries[path] = [stamp, digest]
+        return digest
+
+    def forget(self, path):
+        self.entries.pop(path, None)
+
+    def save(self):
+        if self.path:
+            write_if_changed(self.path,
+                             json.dumps(self.entries, sort_keys=True).encode())
+
+
+def write_if_changed(path, data):
+    """Atomically replace path with data, keeping its mode, unless it
+    already holds exactly that. Returns if it was written."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+    directory = os.path.dirname(path) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory,
+                                prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, mode)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return True
+
+
+def check(entry):
+    for path in (entry.csr, entry.crt):
+        if not os.path.getsize(path):
+            raise ValueError('{}: is empty'.format(path))
+    if entry.pem:
+        for path in (entry.pem, entry.key):
+            if not os.path.isfile(path) or not os.path.getsize(path):
+                raise ValueError('{}: found in config but {} missing'
+                                 .format(entry.pem, path))
+
+
+def refresh(session, url, entry, hashes):
+    """Fetch the certificate for entry, returning if any file changed"""
+    check(entry)
+    csr_sum = hashes.sha256(entry.csr)
+    headers = {'If-None-Match': '"{}"'.format(hashes.sha256(entry.crt))}
+    response = session.get('{}/{}'.format(url.rstrip('/'), csr_sum),
+                           headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304:
+        logging.info('Unchanged: {}'.format(entry))
+        return False
+    if response.status_code != 200:
+        raise ValueError('HTTP Status: {}'.format(response.status_code))
+
+    changed = write_if_changed(entry.crt, response.content)
+    if changed:
+        hashes.forget(entry.crt)
+    if entry.pem:
+        with open(entry.key, 'rb') as f:
+            key = f.read()
+        changed = write_if_changed(entry.pem, key + response.content) or changed
+    logging.info('{}: {}'.format('Updated' if changed else 'Unchanged', entry))
+    return changed
+
+
+def run_hook(hook, entry):
+    env = dict(os.environ, CARAMEL_CSR=entry.csr, CARAMEL_CRT=entry.crt,
+               CARAMEL_PEM=entry.pem or '')
+    subprocess.run(hook, shell=True, env=env, check=True)
+
+
+def refresh_all(url, entries, ca_cert=None, workers=8, hook=None,
+                hashes=None):
+    """Refresh all entries, returning a list of (entry, error) for those
+    that failed"""
+    if hashes is None:
+        hashes = HashCache()
+    session = requests.Session()
+    if ca_cert:
+        session.verify = ca_cert
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(refresh, session, url, entry, hashes): entry
+                   for entry in entries}
+        for future in concurrent.futures.as_completed(futures):
+            entry = futures[future]
+            try:
+                changed = future.result()
+                if changed and hook:
+                    run_hook(hook, entry)
+            except Exception as exc:
+                failed.append((entry, exc))
+    session.close()
+    return failed
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', help='The CA server URI')
+    parser.add_argument('ca_cert', nargs='?', help='The CA server cert')
+    parser.add_argument('--config',
+                        default=os.environ.get('CONFIG', DEFAULT_CONFIG),
+                        help='Default $CONFIG or ' + DEFAULT_CONFIG)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Certificates fetched at once')
+    parser.add_argument('--hook',
+                        help='Shell command run for every entry that '
+                             'changed, with CARAMEL_CSR, CARAMEL_CRT and '
+                             'CARAMEL_PEM set')
+    parser.add_argument('--hash-cache',
+                        help='File remembering hashes between runs')
+    args = parser.parse_args()
+
+    if args.ca_cert and not (os.path.isfile(args.ca_cert) and
+                             os.path.getsize(args.ca_cert)):
+        sys.exit('Error: {} missing'.format(args.ca_cert))
+    try:
+        entries = read_config(args.config)
+    except (OSError, ValueError) as exc:
+        sys.exit('Error: {}'.format(exc))
+    if not entries:
+        sys.exit('Error: {} should point to .csr files to be refreshed'
+                 .format(args.config))
+
+    hashes = HashCache(args.hash_cache)
+    failed = refresh_all(args.url, entries, args.ca_cert, args.workers,
+                         args.hook, hashes)
+    hashes.save()
+    if failed:
+        sys.exit('Error: \n' + ''.join('{} => {}\n'.format(entry.csr, exc)
+                                       for entry, exc in failed))
+    print('all done')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,9 @@ setup(
     name='caramel-request-cert',
     version='0.1',
     packages=find_packages(),
-    scripts=['request-cert'],
+    scripts=['request-cert', 'caramel-refresh'],
 
-    install_requires=['requests']
+    install_requires=['requests', 'cryptography >= 42'],
+    extras_require={'aio': ['aiohttp >= 3.8'],
+                    'test': ['aiohttp >= 3.8']},
 )
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+"""Unittests for caramelrequest.aio, run from this directory with
+python -m unittest. Needs the "test" extra, for aiohttp"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    from caramelrequest import aio
+except ImportError:
+    aio = None
+
+CSR = b'csr'
+
+
+@unittest.skipIf(aio is None, 'aiohttp is not installed')
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.client = aio.AsyncClient('ca.example.com', 'ca.cacert', limit=2)
+
+    def run_with_slots(self, coroutine):
+        async def run():
+            # What __aenter__ sets up, apart from the session
+            self.client._slots = asyncio.Semaphore(self.client.limit)
+            return await coroutine
+
+        return asyncio.run(run())
+
+    def test_retry_after(self):
+        """A 202 is polled again after its Retry-After"""
+        responses = [(202, {'Retry-After': '7'}, b''), (200, {}, b'cert')]
+        sleep = mock.AsyncMock()
+        with mock.patch.object(self.client, '_request',
+                               side_effect=responses) as request, \
+                mock.patch.object(aio.asyncio, 'sleep', sleep), \
+                mock.patch.object(aio, 'jitter', lambda seconds: seconds):
+            content = self.run_with_slots(self.client.fetch(CSR,
+                                                            verify=False))
+        self.assertEqual(content, b'cert')
+        sleep.assert_awaited_once_with(7)
+        self.assertEqual([call[0][0] for call in request.call_args_list],
+                         ['GET', 'GET'])
+
+    def test_posts_unknown(self):
+        responses = [(404, {}, b''), (200, {}, b'cert')]
+        with mock.patch.object(self.client, '_request',
+                               side_effect=responses) as request:
+            self.run_with_slots(self.client.fetch(CSR, verify=False))
+        self.assertEqual(request.call_args_list[1][0][0], 'POST')
+
+    def test_limit(self):
+        """At most limit fetches are in flight"""
+        in_flight = []
+        most = []
+
+        async def request(method, url, data=None):
+            in_flight.append(url)
+            most.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(url)
+            return 200, {}, b'cert'
+
+        async def fetch_all():
+            csrs = [b'csr %d' % n for n in range(6)]
+            return await asyncio.gather(
+                *(self.client.fetch(csr, verify=False) for csr in csrs))
+
+        with mock.patch.object(self.client, '_request', request):
+            self.assertEqual(self.run_with_slots(fetch_all()), [b'cert'] * 6)
+        self.assertEqual(max(most), 2)
+
+    def test_perform_all(self):
+        """A failing client id is reported, the others still performed"""
+        error = aio.CertificateRequestException('failed')
+
+        async def perform(client_id):
+            if client_id == 'bad':
+                raise error
+
+        with mock.patch.object(self.client, 'perform',
+                               side_effect=perform) as performed, \
+                self.assertLogs(level='ERROR'):
+            failed = asyncio.run(
+                self.client.perform_all(['one', 'bad', 'two']))
+        self.assertEqual(failed, {'bad': error})
+        self.assertEqual(performed.await_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
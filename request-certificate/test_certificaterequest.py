@@ -0,0 +1,356 @@
+#! /usr/bin/env python
+"""Unittests for caramelrequest.certificaterequest, run from this directory
+with python -m unittest"""
+
+import datetime
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from requests.structures import CaseInsensitiveDict
+
+from caramelrequest import certificaterequest
+from caramelrequest.certificaterequest import CertificateRequest
+
+
+def in_temp_dir(test):
+    """Runs the rest of test in a temporary working directory"""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    cwd = os.getcwd()
+    os.chdir(directory.name)
+    test.addCleanup(os.chdir, cwd)
+
+
+def name(*attributes):
+    return x509.Name([x509.NameAttribute(oid, value)
+                      for oid, value in attributes])
+
+
+def make_cert(subject, issuer=None, ca=True, days=(-1, 30)):
+    """(certificate, key) for subject, signed by issuer, a (certificate,
+    key) pair, or self-signed, valid for days relative to now"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    issuer_name, issuer_key = subject, key
+    if issuer is not None:
+        issuer_name, issuer_key = issuer[0].subject, issuer[1]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer_name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now + datetime.timedelta(days=days[0]))
+            .not_valid_after(now + datetime.timedelta(days=days[1]))
+            .add_extension(x509.BasicConstraints(ca=ca, path_length=None),
+                           critical=True)
+            .sign(issuer_key, hashes.SHA256()))
+    return cert, key
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        session = mock.Mock()
+        session.get.return_value = mock.Mock(status_code=202, headers={})
+        self.request = CertificateRequest(server='ca.example.com',
+                                          client_id='client',
+                                          session=session)
+        for name in ('assert_ca_cert_available', 'ensure_verified_inputs'):
+            patcher = mock.patch.object(self.request, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.request, 'get_csr_and_hash',
+                                    return_value=(b'csr', 'hash'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_interrupted_poll(self):
+        """Ctrl-C while polling stops the daemon, rather than a retry"""
+        def retry(seconds):
+            self.fail('Retried after an interrupt')
+
+        with mock.patch.object(certificaterequest.time, 'sleep',
+                               side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.request.run_daemon(sleep=retry)
+
+    def test_interrupted_fetch(self):
+        """Outside the daemon, Ctrl-C while polling ends the fetch"""
+        with mock.patch.object(certificaterequest.time, 'sleep',
+                               side_effect=KeyboardInterrupt):
+            self.request.request_cert_from_server()
+        self.assertFalse(os.path.exists(self.request.crt_temp_file_name))
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_headers(self):
+        """Takes the headers, so aiohttp's work as well as requests'"""
+        headers = CaseInsensitiveDict({'retry-after': '30'})
+        self.assertEqual(certificaterequest.retry_after(headers), 30)
+        self.assertIsNone(certificaterequest.retry_after({}))
+
+
+class TestWriteFile(unittest.TestCase):
+    def test_existing(self):
+        """An existing file gets the mode, not only a new one"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'client.key')
+            certificaterequest.write_file(path, b'old')
+            os.chmod(path, 0o644)
+            certificaterequest.write_file(path, b'key', mode=0o600)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'key')
+            self.assertEqual(os.listdir(directory), ['client.key'])
+
+
+class TestVerifyCert(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ca = make_cert(name((NameOID.COMMON_NAME, 'CA')))
+
+    def leaf(self, issuer=None, days=(-1, 30)):
+        cert, _ = make_cert(name((NameOID.COMMON_NAME, 'client')),
+                            issuer or self.ca, ca=False, days=days)
+        return cert
+
+    def test_valid(self):
+        self.assertTrue(certificaterequest.verify_cert(self.leaf(),
+                                                       self.ca[0]))
+        self.assertTrue(certificaterequest.verify_cert(self.ca[0],
+                                                       self.ca[0]))
+
+    def test_other_ca(self):
+        other = make_cert(name((NameOID.COMMON_NAME, 'CA')))
+        self.assertFalse(certificaterequest.verify_cert(self.leaf(other),
+                                                        self.ca[0]))
+
+    def test_expired(self):
+        cert = self.leaf(days=(-30, -1))
+        self.assertFalse(certificaterequest.verify_cert(cert, self.ca[0]))
+
+    def test_not_yet_valid(self):
+        cert = self.leaf(days=(1, 30))
+        self.assertFalse(certificaterequest.verify_cert(cert, self.ca[0]))
+
+    def test_expired_ca(self):
+        ca = make_cert(name((NameOID.COMMON_NAME, 'CA')), days=(-30, -1))
+        self.assertFalse(certificaterequest.verify_cert(self.leaf(ca),
+                                                        ca[0]))
+
+    def test_issuer_not_ca(self):
+        issuer = make_cert(name((NameOID.COMMON_NAME, 'CA')), self.ca,
+                           ca=False)
+        self.assertFalse(certificaterequest.verify_cert(self.leaf(issuer),
+                                                        issuer[0]))
+
+
+class TestCsrMatchesKey(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        self.key = ec.generate_private_key(ec.SECP256R1())
+        csr = (x509.CertificateSigningRequestBuilder()
+               .subject_name(name((NameOID.COMMON_NAME, 'client')))
+               .sign(self.key, hashes.SHA256()))
+        with open('client.csr', 'wb') as f:
+            f.write(csr.public_bytes(serialization.Encoding.PEM))
+
+    def test_match(self):
+        self.assertTrue(certificaterequest.csr_matches_key('client.csr',
+                                                           self.key))
+
+    def test_other_key(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        self.assertFalse(certificaterequest.csr_matches_key('client.csr',
+                                                            key))
+
+    def test_invalid(self):
+        with open('client.csr', 'wb') as f:
+            f.write(b'not a CSR')
+        self.assertFalse(certificaterequest.csr_matches_key('client.csr',
+                                                            self.key))
+        self.assertFalse(certificaterequest.csr_matches_key('missing.csr',
+                                                            self.key))
+
+
+class TestSubject(unittest.TestCase):
+    def test_order(self):
+        """C, ST, L, O and OU first, the order of the server's
+        CA_SUBJ_MATCH, whatever the order of the CA subject"""
+        ca, _ = make_cert(name((NameOID.ORGANIZATIONAL_UNIT_NAME, 'Unit'),
+                               (NameOID.COMMON_NAME, 'CA'),
+                               (NameOID.ORGANIZATION_NAME, 'Org'),
+                               (NameOID.LOCALITY_NAME, 'City'),
+                               (NameOID.COUNTRY_NAME, 'SE'),
+                               (NameOID.STATE_OR_PROVINCE_NAME, 'State')))
+        request = CertificateRequest(server='ca.example.com',
+                                     client_id='client', ca_cert=ca)
+        subject = request.get_subject()
+        self.assertEqual(
+            [(attribute.oid, attribute.value) for attribute in subject],
+            [(NameOID.COUNTRY_NAME, 'SE'),
+             (NameOID.STATE_OR_PROVINCE_NAME, 'State'),
+             (NameOID.LOCALITY_NAME, 'City'),
+             (NameOID.ORGANIZATION_NAME, 'Org'),
+             (NameOID.ORGANIZATIONAL_UNIT_NAME, 'Unit'),
+             (NameOID.COMMON_NAME, 'client')])
+
+
+class TestKeyFile(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        self.request = CertificateRequest(server='ca.example.com',
+                                          client_id='client')
+
+    def public(self, key):
+        return key.public_key().public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def mode(self):
+        return os.stat(self.request.key_file_name).st_mode & 0o777
+
+    def test_generated(self):
+        key = self.request.ensure_valid_key_file()
+        self.assertEqual(self.mode(), 0o600)
+        # Kept on the next run
+        self.assertEqual(self.public(self.request.ensure_valid_key_file()),
+                         self.public(key))
+
+    def test_invalid_existing(self):
+        """A key file that exists but isn't a key is replaced, as 0600"""
+        with open(self.request.key_file_name, 'wb') as f:
+            f.write(b'not a key')
+        os.chmod(self.request.key_file_name, 0o644)
+        self.request.ensure_valid_key_file()
+        self.assertEqual(self.mode(), 0o600)
+        self.assertIsNotNone(
+            certificaterequest.load_key(self.request.key_file_name))
+
+
+class TestValidationState(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        with open('client.key', 'wb') as f:
+            f.write(b'key')
+
+    def reload(self, state):
+        state.save()
+        return certificaterequest.ValidationState('client.state')
+
+    def test_unchanged(self):
+        state = certificaterequest.ValidationState('client.state')
+        self.assertFalse(state.is_verified('client.key'))
+        state.record('client.key')
+        self.assertTrue(self.reload(state).is_verified('client.key'))
+
+    def test_touched(self):
+        """A new mtime with the same content is still verified"""
+        state = certificaterequest.ValidationState('client.state')
+        state.record('client.key')
+        state = self.reload(state)
+        os.utime('client.key', ns=(0, 0))
+        self.assertTrue(state.is_verified('client.key'))
+        self.assertEqual(state.entries['client.key']['mtime'], 0)
+
+    def test_changed(self):
+        state = certificaterequest.ValidationState('client.state')
+        state.record('client.key')
+        state = self.reload(state)
+        stat = os.stat('client.key')
+        with open('client.key', 'wb') as f:
+            f.write(b'KEY')
+        # Same size and mtime, so only the hash tells
+        os.utime('client.key', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertFalse(state.is_verified('client.key'))
+        os.remove('client.key')
+        self.assertFalse(state.is_verified('client.key'))
+
+    def test_expired(self):
+        state = certificaterequest.ValidationState('client.state')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        state.record('client.key', valid_until=now + datetime.timedelta(1))
+        self.assertTrue(state.is_verified('client.key'))
+        with mock.patch.object(certificaterequest.time, 'time',
+                               return_value=now.timestamp() + 2 * 86400):
+            self.assertFalse(state.is_verified('client.key'))
+
+    def test_corrupt(self):
+        with open('client.state', 'w') as f:
+            f.write('{not json')
+        state = certificaterequest.ValidationState('client.state')
+        self.assertFalse(state.is_verified('client.key'))
+
+
+class TestVerifiedInputs(unittest.TestCase):
+    """ensure_verified_inputs only verifies what changed since the last
+    run"""
+
+    def setUp(self):
+        in_temp_dir(self)
+        self.write_ca()
+        for path in ('client.key', 'client.csr'):
+            with open(path, 'wb') as f:
+                f.write(path.encode())
+        self.request = CertificateRequest(server='ca.example.com',
+                                          client_id='client')
+        self.calls = mock.Mock(unsafe=True)
+        for name in ('assert_ca_cert_verifies', 'ensure_valid_key_file',
+                     'ensure_valid_csr_file', 'get_subject'):
+            patcher = mock.patch.object(CertificateRequest, name,
+                                        getattr(self.calls, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_ca(self, days=(-1, 30)):
+        cert, _ = make_cert(name((NameOID.COMMON_NAME, 'CA')), days=days)
+        with open('ca.example.com.cacert', 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+    def run_again(self):
+        """Runs ensure_verified_inputs as a new process would, returning
+        what was verified"""
+        self.calls.reset_mock()
+        request = CertificateRequest(server='ca.example.com',
+                                     client_id='client')
+        request.ensure_verified_inputs()
+        return {call[0] for call in self.calls.mock_calls}
+
+    def test_unchanged(self):
+        self.assertEqual(self.run_again(),
+                         {'assert_ca_cert_verifies', 'ensure_valid_key_file',
+                          'get_subject', 'ensure_valid_csr_file'})
+        self.assertEqual(self.run_again(), set())
+
+    def test_ca_changed(self):
+        self.run_again()
+        self.write_ca()
+        self.assertEqual(self.run_again(), {'assert_ca_cert_verifies'})
+
+    def test_key_changed(self):
+        self.run_again()
+        with open('client.key', 'wb') as f:
+            f.write(b'another key')
+        self.assertEqual(self.run_again(),
+                         {'ensure_valid_key_file', 'get_subject',
+                          'ensure_valid_csr_file'})
+
+    def test_ca_expired(self):
+        """The CA is verified again once it is no longer valid"""
+        self.write_ca(days=(-1, 1))
+        self.run_again()
+        later = time.time() + 2 * 86400
+        with mock.patch.object(certificaterequest.time, 'time',
+                               return_value=later):
+            self.assertEqual(self.run_again(), {'assert_ca_cert_verifies'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+"""Unittests for caramelrequest.fleet, run from this directory with
+python -m unittest"""
+
+import io
+import threading
+import time
+import unittest
+from unittest import mock
+
+from caramelrequest import fleet
+from caramelrequest.certificaterequest import CertificateRequest
+from test_certificaterequest import in_temp_dir
+
+MANIFEST = '''\
+# Test rig
+one
+  two
+
+one
+# three
+four
+'''
+
+
+class TestManifest(unittest.TestCase):
+    def test_file(self):
+        """Comments, blank lines and repeated ids are skipped"""
+        in_temp_dir(self)
+        with open('manifest', 'w') as f:
+            f.write(MANIFEST)
+        self.assertEqual(fleet.read_manifest('manifest'),
+                         ['one', 'two', 'four'])
+
+    def test_stdin(self):
+        with mock.patch.object(fleet.sys, 'stdin', io.StringIO(MANIFEST)):
+            self.assertEqual(fleet.read_manifest('-'),
+                             ['one', 'two', 'four'])
+
+
+class TestPerformAll(unittest.TestCase):
+    def setUp(self):
+        for name in ('assert_ca_cert_available', 'assert_ca_cert_verifies'):
+            patcher = mock.patch.object(CertificateRequest, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(fleet, 'make_session')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def perform_all(self, perform, client_ids, **kwargs):
+        with mock.patch.object(CertificateRequest, 'perform', autospec=True,
+                               side_effect=perform):
+            return fleet.perform_all('ca.example.com', client_ids, **kwargs)
+
+    def test_keygen_bounded(self):
+        """At most keygen requests generate keys at once"""
+        lock = threading.Lock()
+        generating = []
+        most = []
+
+        def perform(request):
+            with request.keygen:
+                with lock:
+                    generating.append(request.client_id)
+                    most.append(len(generating))
+                time.sleep(0.01)
+                with lock:
+                    generating.remove(request.client_id)
+
+        client_ids = ['client{}'.format(n) for n in range(12)]
+        self.assertEqual(self.perform_all(perform, client_ids, workers=8,
+                                          keygen=2), [])
+        self.assertEqual(len(most), 12)
+        self.assertEqual(max(most), 2)
+
+    def test_failure(self):
+        """A failing client id is reported, the others still performed"""
+        performed = []
+
+        def perform(request):
+            if request.client_id == 'bad':
+                raise OSError('disk full')
+            performed.append(request.client_id)
+
+        with self.assertLogs(level='ERROR') as logs:
+            failed = self.perform_all(perform, ['one', 'bad', 'two'])
+        self.assertEqual(failed, ['bad'])
+        self.assertEqual(sorted(performed), ['one', 'two'])
+        self.assertIn('bad: disk full', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
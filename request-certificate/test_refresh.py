@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+"""Unittests for caramelrequest.refresh, run from this directory with
+python -m unittest"""
+
+import hashlib
+import json
+import os
+import unittest
+from unittest import mock
+
+from caramelrequest import refresh
+from test_certificaterequest import in_temp_dir
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        write('client.csr', b'csr')
+        write('client.crt', b'old cert')
+        write('client.key', b'key ')
+        self.entry = refresh.Entry('client.csr', 'client.crt', 'client.pem')
+        write('client.pem', b'key old cert')
+        self.session = mock.Mock()
+        patcher = mock.patch.object(refresh.requests, 'Session',
+                                    return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(refresh, 'run_hook')
+        self.run_hook = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def respond(self, status_code, content=b''):
+        self.session.get.return_value = mock.Mock(status_code=status_code,
+                                                  content=content)
+
+    def refresh_all(self):
+        failed = refresh.refresh_all('https://ca.example.com', [self.entry],
+                                     hook='reload')
+        self.assertEqual(failed, [])
+
+    def stat(self):
+        return {path: os.stat(path)
+                for path in ('client.crt', 'client.pem')}
+
+    def assertUntouched(self, before):
+        for path, stat in self.stat().items():
+            self.assertEqual((stat.st_ino, stat.st_mtime_ns),
+                             (before[path].st_ino, before[path].st_mtime_ns))
+
+    def test_not_modified(self):
+        """If-None-Match holds the hash of the certificate we have"""
+        self.respond(304)
+        before = self.stat()
+        self.refresh_all()
+        url = 'https://ca.example.com/' + hashlib.sha256(b'csr').hexdigest()
+        etag = '"{}"'.format(hashlib.sha256(b'old cert').hexdigest())
+        self.session.get.assert_called_once_with(
+            url, headers={'If-None-Match': etag}, timeout=refresh.TIMEOUT)
+        self.assertUntouched(before)
+        self.run_hook.assert_not_called()
+
+    def test_same_content(self):
+        self.respond(200, b'old cert')
+        before = self.stat()
+        self.refresh_all()
+        self.assertUntouched(before)
+        self.run_hook.assert_not_called()
+
+    def test_changed(self):
+        """Written by replacing the files, in their modes, then the hook
+        runs once for the entry"""
+        os.chmod('client.crt', 0o640)
+        os.chmod('client.pem', 0o600)
+        self.respond(200, b'new cert')
+        before = self.stat()
+        self.refresh_all()
+        self.assertEqual(read('client.crt'), b'new cert')
+        self.assertEqual(read('client.pem'), b'key new cert')
+        after = self.stat()
+        for path in after:
+            self.assertNotEqual(after[path].st_ino, before[path].st_ino)
+        self.assertEqual(after['client.crt'].st_mode & 0o777, 0o640)
+        self.assertEqual(after['client.pem'].st_mode & 0o777, 0o600)
+        self.assertEqual(sorted(os.listdir('.')),
+                         ['client.crt', 'client.csr', 'client.key',
+                          'client.pem'])
+        self.run_hook.assert_called_once_with('reload', self.entry)
+
+    def test_failed(self):
+        self.respond(500)
+        failed = refresh.refresh_all('https://ca.example.com', [self.entry],
+                                     hook='reload')
+        self.assertEqual([entry for entry, _ in failed], [self.entry])
+        self.assertEqual(read('client.crt'), b'old cert')
+        self.run_hook.assert_not_called()
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        in_temp_dir(self)
+        write('client.crt', b'cert')
+
+    def test_corrupt(self):
+        """An unreadable cache is started over"""
+        write('hashes.json', b'{not json')
+        with self.assertLogs(level='WARNING'):
+            hashes = refresh.HashCache('hashes.json')
+        self.assertEqual(hashes.sha256('client.crt'),
+                         hashlib.sha256(b'cert').hexdigest())
+        hashes.save()
+        with open('hashes.json') as f:
+            self.assertIn('client.crt', json.load(f))
+
+    def test_cached(self):
+        hashes = refresh.HashCache('hashes.json')
+        hashes.sha256('client.crt')
+        hashes.save()
+        hashes = refresh.HashCache('hashes.json')
+        with mock.patch.object(refresh, 'open', create=True) as opened:
+            self.assertEqual(hashes.sha256('client.crt'),
+                             hashlib.sha256(b'cert').hexdigest())
+        opened.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
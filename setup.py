@@ -63,5 +63,6 @@ should be considered broken.
       caramel_tool = caramel.scripts.tool:main
       caramel_ca = caramel.scripts.generate_ca:main
       caramel_autosign = caramel.scripts.autosign:main
+      caramel_serve = caramel.scripts.serve:main
       """,
 )
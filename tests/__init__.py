@@ -1,10 +1,12 @@
 #! /usr/bin/env python
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+import contextlib
 import unittest
 from itertools import zip_longest
 
 import transaction
 
+from caramel import queries
 from caramel.models import (
     DBSession,
     init_session,
@@ -13,25 +15,50 @@ from caramel.models import (
 from . import fixtures
 
 
+def init_db():
+    """Binds the session to a new in-memory database, holding the initial
+    fixtures"""
+    # Clear existing session, if any.
+    DBSession.remove()
+    from sqlalchemy import create_engine
+
+    engine = create_engine("sqlite://")
+    queries.install(engine)
+    init_session(engine, create=True)
+    with transaction.manager:
+        csr = fixtures.CSRData.initial()
+        csr.save()
+
+
 class ModelTestCase(unittest.TestCase):
+    # Tests that commit need a database each, the others share one per class
+    db_per_test = False
+
     @classmethod
     def setUpClass(cls):
         super(ModelTestCase, cls).setUpClass()
-        # Clear existing session, if any.
-        DBSession.remove()
-        from sqlalchemy import create_engine
-
-        engine = create_engine("sqlite://")
-        init_session(engine, create=True)
-        with transaction.manager:
-            csr = fixtures.CSRData.initial()
-            csr.save()
+        if not cls.db_per_test:
+            init_db()
 
     def setUp(self):
         super(ModelTestCase, self).setUp()
+        if self.db_per_test:
+            init_db()
         # Always run in a fresh session
         DBSession.remove()
 
+    @contextlib.contextmanager
+    def assertMaxQueries(self, maximum):
+        """Fails if the code inside runs more than maximum SQL statements"""
+        with queries.counting() as stats:
+            yield stats
+        if stats.count > maximum:
+            self.fail(
+                "{} SQL statements, expected at most {}:\n{}".format(
+                    stats.count, maximum, "\n".join(stats.statements)
+                )
+            )
+
     def assertSimilar(self, a, b, msg=None):
         if isinstance(b, fixtures.SimilarityComparable):
             a, b = b, a
@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.bench_crypto times the per-certificate crypto in caramel.models, for
+request keys of 1024, 2048 and 4096 bits and CA keys of 2048 and 4096 bits:
+
+    python -m tests.bench_crypto --output bench.json
+    python -m tests.bench_crypto --baseline bench.json
+
+Results are the best time per call, in seconds, over a few repeats. With
+--baseline, anything slower than the baseline by more than --tolerance is
+reported, and the exit status is 1."""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from hashlib import sha256
+
+import OpenSSL
+import OpenSSL.crypto as _crypto
+
+from caramel import models
+
+from . import fixtures
+
+KEY_BITS = (1024, 2048, 4096)
+CA_BITS = (2048, 4096)
+REPEAT = 5
+TOLERANCE = 0.25
+
+
+def make_csr(bits):
+    """A PEM request for a fresh key of bits, matching fixtures.signing_ca"""
+    key = _crypto.PKey()
+    key.generate_key(_crypto.TYPE_RSA, bits)
+    req = _crypto.X509Req()
+    subject = req.get_subject()
+    for name, value in fixtures.subject_prefix + (("CN", "bench.example.com"),):
+        setattr(subject, name, value)
+    req.set_pubkey(key)
+    req.sign(key, models.HASH[bits])
+    return _crypto.dump_certificate_request(_crypto.FILETYPE_PEM, req)
+
+
+def measure(func, repeat=REPEAT):
+    """Best seconds per call of func"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(key_bits=KEY_BITS, ca_bits=CA_BITS, repeat=REPEAT, log=None):
+    results = {}
+
+    def record(name, func):
+        results[name] = measure(func, repeat)
+        if log:
+            log("{:<40} {:>10.1f} us".format(name, results[name] * 1e6))
+
+    csrs = {}
+    for bits in key_bits:
+        pem = make_csr(bits)
+        sha256sum = sha256(pem).hexdigest()
+        csrs[bits] = models.CSR(sha256sum, pem)
+        record("CSR.__init__/key{}".format(bits), lambda: models.CSR(sha256sum, pem))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for ca_size in ca_bits:
+            ca = fixtures.signing_ca(ca_size)
+            certfile = os.path.join(directory, "ca{}.crt".format(ca_size))
+            keyfile = os.path.join(directory, "ca{}.key".format(ca_size))
+            with open(certfile, "wb") as f:
+                f.write(ca.pem)
+            with open(keyfile, "wb") as f:
+                f.write(_crypto.dump_privatekey(_crypto.FILETYPE_PEM, ca.key))
+            record(
+                "SigningCert.from_files/ca{}".format(ca_size),
+                lambda: models.SigningCert.from_files(certfile, keyfile),
+            )
+
+            for bits, csr in csrs.items():
+                suffix = "/key{}/ca{}".format(bits, ca_size)
+                record(
+                    "Certificate.sign" + suffix,
+                    lambda: models.Certificate.sign(csr, ca),
+                )
+                pem = models.Certificate.sign(csr, ca).pem
+                # Certificate.cert parses and validates, from __init__
+                record(
+                    "Certificate.__init__" + suffix,
+                    lambda: models.Certificate(csr, pem),
+                )
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """(name, baseline, result) of the results slower than baseline by more
+    than tolerance"""
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if before and seconds > before * (1 + tolerance):
+            regressions.append((name, before, seconds))
+    return regressions
+
+
+def cmdline():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+
+    def bits(text):
+        return tuple(int(part) for part in text.split(","))
+
+    parser.add_argument("--keys", type=bits, default=KEY_BITS, help="Request key sizes")
+    parser.add_argument("--ca", type=bits, default=CA_BITS, help="CA key sizes")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help="Write the results as JSON here, - for stdout")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="Allowed slowdown against the baseline, as a fraction",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = cmdline()
+
+    def log(line):
+        print(line, file=sys.stderr)
+
+    results = run(args.keys, args.ca, args.repeat, log=log)
+    report = {
+        "python": platform.python_version(),
+        "openssl": OpenSSL.SSL.SSLeay_version(OpenSSL.SSL.SSLEAY_VERSION).decode(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            log(
+                "REGRESSION {}: {:.1f} us -> {:.1f} us ({:+.0%})".format(
+                    name, before * 1e6, after * 1e6, after / before - 1
+                )
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.dataset fills a database with a synthetic fleet, for profiling
+queries like CSR.list_csr_printable, CSR.refreshable and CSR.unsigned at
+realistic volumes:
+
+    python -m tests.dataset --dburl sqlite:///fleet.sqlite --csrs 1000000
+
+Rows are bulk inserted through SQLAlchemy Core. No crypto is done per row:
+every CSR reuses the PEM of one of the fixture requests, and every
+certificate one signed for it once, by fixtures.signing_ca. sha256sum and
+commonname are made unique per row, so they don't match the PEM. Given the
+same --seed and --now, the same rows are generated, apart from the PEMs: the
+templates are signed by a freshly generated CA on every run."""
+
+import argparse
+import datetime
+import hashlib
+import logging
+import random
+import sys
+import time
+
+import sqlalchemy as sa
+
+from caramel import config, models
+from caramel.scripts.tool import parse_utc
+
+from . import fixtures
+
+logger = logging.getLogger(__name__)
+
+BATCH = 10000
+LIFETIME = datetime.timedelta(days=90)
+
+# Fixture requests whose subject matches fixtures.signing_ca
+TEMPLATES = ("initial", "with_expired_cert", "good")
+
+
+def templates():
+    """(csr pem, certificate pem) pairs, signed once by a fresh CA"""
+    ca = fixtures.signing_ca()
+    pairs = []
+    for name in TEMPLATES:
+        fixture = getattr(fixtures.CSRData, name)
+        csr = models.CSR(fixture.sha256sum, fixture.pem)
+        pairs.append((csr.pem, models.Certificate.sign(csr, ca, LIFETIME).pem))
+    return pairs
+
+
+class Fleet(object):
+    """Rows for csrs requests starting at first_id. Each request has up to
+    certificates certificates, apart from the unsigned and rejected
+    fractions, and on average accesses access log entries."""
+
+    def __init__(
+        self,
+        csrs,
+        certificates=3,
+        accesses=10,
+        unsigned=0.05,
+        rejected=0.01,
+        first_id=1,
+        seed=0,
+        now=None,
+    ):
+        self.csrs = csrs
+        self.certificates = certificates
+        self.accesses = accesses
+        self.unsigned = unsigned
+        self.rejected = rejected
+        self.first_id = first_id
+        self.random = random.Random(seed)
+        self.now = now or datetime.datetime.utcnow()
+        self.templates = templates()
+        self.orgunits = ["Dept {}".format(n) for n in range(10)]
+
+    def batches(self, size=BATCH):
+        """Yields (csr rows, certificate rows, access rows) for size
+        requests at a time"""
+        rand = self.random
+        last = self.first_id + self.csrs
+        for start in range(self.first_id, last, size):
+            csrs, certs, accesses = [], [], []
+            for csr_id in range(start, min(start + size, last)):
+                csr_pem, cert_pem = rand.choice(self.templates)
+                roll = rand.random()
+                rejected = roll < self.rejected
+                csrs.append(
+                    {
+                        "id": csr_id,
+                        "sha256sum": hashlib.sha256(b"%d" % csr_id).hexdigest(),
+                        "pem": csr_pem,
+                        "orgunit": rand.choice(self.orgunits),
+                        "commonname": "host{}.example.com".format(csr_id),
+                        "rejected": rejected,
+                    }
+                )
+                if rejected or roll < self.rejected + self.unsigned:
+                    continue
+                # The newest certificate from "expired a month ago" to
+                # "just signed", each older one a lifetime before it
+                not_after = self.now + LIFETIME * rand.uniform(-0.33, 1.0)
+                for _ in range(rand.randint(1, self.certificates)):
+                    certs.append(
+                        {
+                            "csr_id": csr_id,
+                            "pem": cert_pem,
+                            "not_before": not_after - LIFETIME,
+                            "not_after": not_after,
+                        }
+                    )
+                    not_after -= LIFETIME
+                count = rand.expovariate(1.0 / self.accesses) if self.accesses else 0
+                for _ in range(int(count)):
+                    accesses.append(
+                        {
+                            "csr_id": csr_id,
+                            "when": self.now - LIFETIME * rand.random(),
+                            "addr": "10.{}.{}.{}".format(
+                                rand.randrange(256),
+                                rand.randrange(256),
+                                rand.randrange(1, 255),
+                            ),
+                        }
+                    )
+            yield csrs, certs, accesses
+
+
+def advance_sequence(conn, table):
+    """Moves the id sequence of table past the ids inserted explicitly, which
+    PostgreSQL doesn't do itself, so later inserts don't reuse them"""
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(
+        sa.text(
+            "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            "(SELECT max(id) FROM {}))".format(table.name)
+        ),
+        {"table": table.name},
+    )
+
+
+def generate(engine, fleet, batch=BATCH):
+    """Inserts the fleet, one transaction per batch. Returns the row counts
+    for CSR, Certificate and AccessLog"""
+    tables = (
+        models.CSR.__table__,
+        models.Certificate.__table__,
+        models.AccessLog.__table__,
+    )
+    counts = [0, 0, 0]
+    started = time.monotonic()
+    for rows in fleet.batches(batch):
+        with engine.begin() as conn:
+            for index, (table, values) in enumerate(zip(tables, rows)):
+                if values:
+                    conn.execute(table.insert(), values)
+                counts[index] += len(values)
+            advance_sequence(conn, models.CSR.__table__)
+        logger.info(
+            "%d CSRs, %d certificates, %d accesses in %.0fs",
+            *counts,
+            time.monotonic() - started,
+        )
+    return tuple(counts)
+
+
+def cmdline():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    config.add_db_url_argument(parser)
+    parser.add_argument("--csrs", type=int, default=100000)
+    parser.add_argument(
+        "--certificates", type=int, default=3, help="Most certificates per CSR"
+    )
+    parser.add_argument(
+        "--accesses", type=float, default=10, help="Mean access log rows per CSR"
+    )
+    parser.add_argument("--unsigned", type=float, default=0.05)
+    parser.add_argument("--rejected", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--now",
+        type=parse_utc,
+        help="Date expiry and access times are drawn around (UTC), default now",
+    )
+    parser.add_argument("--batch", type=int, default=BATCH)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = cmdline()
+    engine = sa.create_engine(config.get_db_url(args))
+    models.Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        last_id = conn.execute(sa.select(sa.func.max(models.CSR.id))).scalar()
+    fleet = Fleet(
+        args.csrs,
+        certificates=args.certificates,
+        accesses=args.accesses,
+        unsigned=args.unsigned,
+        rejected=args.rejected,
+        first_id=(last_id or 0) + 1,
+        seed=args.seed,
+        now=args.now,
+    )
+    try:
+        generate(engine, fleet, args.batch)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,12 @@ from hashlib import sha256
 from itertools import zip_longest
 from operator import attrgetter
 from textwrap import dedent
+from unittest import mock
+
+import OpenSSL.crypto as _crypto
 
 from caramel import models, views
+from caramel.scripts import generate_ca
 
 day = timedelta(days=1)
 year = 365 * day  # close enough
@@ -123,6 +127,18 @@ subject_prefix = (
 )
 
 
+def signing_ca(bits=2048):
+    """A freshly generated models.SigningCert, with key, whose subject
+    matches subject_prefix"""
+    subject = subject_prefix + (("CN", "Caramel Signing Certificate"),)
+    with mock.patch.object(generate_ca, "CA_BITS", bits):
+        key, _, cert = generate_ca.create_ca(subject)
+    return models.SigningCert(
+        _crypto.dump_certificate(_crypto.FILETYPE_PEM, cert),
+        _crypto.dump_privatekey(_crypto.FILETYPE_PEM, key),
+    )
+
+
 class CertificateData(object):
     initial = CertificateFixture(
         not_before=now - 2 * year,
@@ -0,0 +1,421 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.loadtest drives caramel with a simulated device fleet: devices
+polling GET /{sha256}, new devices POSTing requests and CA fetches, and
+reports throughput, latency percentiles and errors per endpoint.
+
+By default the WSGI app runs in this process, on a fresh SQLite database
+(or --dburl) and a fresh CA, optionally with the autosigner signing in a
+thread. With --url, a running server is tested over HTTP instead, and the
+autosigner is left to run on its own:
+
+    python -m tests.loadtest --devices 1000 --duration 60 --autosign
+    python -m tests.loadtest --url http://127.0.0.1:6543 --devices 1000
+
+Requests start on schedule as long as fewer than --concurrency are in
+flight, so a server that can't keep up shows as lower throughput."""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import heapq
+import json
+import math
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from hashlib import sha256
+
+import OpenSSL.crypto as _crypto
+
+from caramel import models
+
+from . import fixtures
+
+DEVICES = 100
+DURATION = 30
+# Seconds between polls of each device
+POLL_INTERVAL = 10
+# New enrollments and CA fetches per second, as Poisson arrivals
+ENROLL_RATE = 1.0
+CA_RATE = 0.5
+CONCURRENCY = 32
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(ordered, q):
+    """The nearest-rank q:th percentile of an ordered sequence"""
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Stats(object):
+    """Latencies and errors per endpoint, from many threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.statuses = collections.defaultdict(collections.Counter)
+
+    def record(self, endpoint, status, seconds):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+            if not 200 <= status < 400:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed):
+        report = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            report[endpoint] = {
+                "requests": len(ordered),
+                "per_second": len(ordered) / elapsed,
+                "errors": self.errors[endpoint],
+                "error_rate": self.errors[endpoint] / len(ordered),
+                "statuses": {str(k): v for k, v in self.statuses[endpoint].items()},
+            }
+            for q in PERCENTILES:
+                report[endpoint]["p{}".format(q)] = percentile(ordered, q)
+        return report
+
+
+class WSGIClient(object):
+    """Calls a WSGI app in this process"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None):
+        from webob import Request
+
+        request = Request.blank(
+            path, method=method, body=body, environ={"REMOTE_ADDR": "127.0.0.1"}
+        )
+        response = request.get_response(self.app)
+        return response.status_int, response.body
+
+    def close(self):
+        pass
+
+
+class HTTPClient(object):
+    """Calls a server over HTTP, keeping connections alive"""
+
+    def __init__(self, url, pool_size):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, body=None):
+        response = self.session.request(method, self.url + path, data=body)
+        return response.status_code, response.content
+
+    def close(self):
+        self.session.close()
+
+
+def make_csrs(count, prefix, seed=0, bits=2048):
+    """count (sha256sum, pem) requests with the subject prefix and a UUID as
+    CN, as the autosigner wants. They share one key, to keep this fast."""
+    rand = random.Random(seed)
+    key = _crypto.PKey()
+    key.generate_key(_crypto.TYPE_RSA, bits)
+    csrs = []
+    for _ in range(count):
+        req = _crypto.X509Req()
+        subject = req.get_subject()
+        common_name = str(uuid.UUID(int=rand.getrandbits(128), version=4))
+        for name, value in prefix + (("CN", common_name),):
+            setattr(subject, name, value)
+        req.set_pubkey(key)
+        req.sign(key, "sha256")
+        pem = _crypto.dump_certificate_request(_crypto.FILETYPE_PEM, req)
+        csrs.append((sha256(pem).hexdigest(), pem))
+    return csrs
+
+
+def enroll(client, csrs, concurrency=CONCURRENCY):
+    """POST csrs, outside of any measurement"""
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        statuses = pool.map(
+            lambda csr: client.request("POST", "/" + csr[0], csr[1])[0], csrs
+        )
+        failed = [status for status in statuses if status >= 400]
+    if failed:
+        raise RuntimeError("{} enrollments failed".format(len(failed)))
+
+
+class Fleet(object):
+    """Schedules requests from devices polling every poll_interval seconds,
+    enrollments of new devices and CA fetches, for duration seconds"""
+
+    def __init__(
+        self,
+        client,
+        devices,
+        enrollments,
+        duration=DURATION,
+        poll_interval=POLL_INTERVAL,
+        enroll_rate=ENROLL_RATE,
+        ca_rate=CA_RATE,
+        concurrency=CONCURRENCY,
+        seed=0,
+    ):
+        self.client = client
+        self.devices = devices
+        self.enrollments = list(enrollments)
+        self.duration = duration
+        self.poll_interval = poll_interval
+        self.enroll_rate = enroll_rate
+        self.ca_rate = ca_rate
+        self.concurrency = concurrency
+        self.random = random.Random(seed)
+        self.stats = Stats()
+        self.missed = 0
+
+    def enroll_all(self):
+        """POST the initial devices, outside of the measurement"""
+        enroll(self.client, self.devices, self.concurrency)
+
+    def call(self, endpoint, method, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, _ = self.client.request(method, path, body)
+        except Exception:
+            status = 0
+        self.stats.record(endpoint, status, time.perf_counter() - start)
+        return status
+
+    def _arrivals(self, rate, kind):
+        if rate > 0:
+            return [(self.random.expovariate(rate), kind, None)]
+        return []
+
+    def run(self):
+        """Runs the schedule, returns the per endpoint report"""
+        rand = self.random
+        events = [
+            (rand.uniform(0, self.poll_interval), "poll", csr) for csr in self.devices
+        ]
+        events += self._arrivals(self.enroll_rate, "enroll")
+        events += self._arrivals(self.ca_rate, "ca")
+        # A counter breaks ties, so requests are never compared
+        events = [
+            (due, index, kind, csr) for index, (due, kind, csr) in enumerate(events)
+        ]
+        heapq.heapify(events)
+        counter = len(events)
+
+        def schedule(due, kind, csr=None):
+            nonlocal counter
+            counter += 1
+            heapq.heappush(events, (due, counter, kind, csr))
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def release(_):
+            slots.release()
+
+        # New devices start polling once their POST went through
+        posted = queue.SimpleQueue()
+
+        def poll_after(csr):
+            def posted_(future):
+                if 200 <= future.result() < 400:
+                    posted.put(csr)
+
+            return posted_
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            while events and events[0][0] < self.duration:
+                while not posted.empty():
+                    now = time.monotonic() - start
+                    schedule(now + self.poll_interval, "poll", posted.get())
+                due, _, kind, csr = heapq.heappop(events)
+                wait = start + due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                slots.acquire()
+                if kind == "poll":
+                    jitter = rand.uniform(0.8, 1.2)
+                    schedule(due + self.poll_interval * jitter, "poll", csr)
+                    task = ("GET /{sha256}", "GET", "/" + csr[0])
+                elif kind == "enroll":
+                    schedule(due + rand.expovariate(self.enroll_rate), "enroll")
+                    if not self.enrollments:
+                        self.missed += 1
+                        slots.release()
+                        continue
+                    csr = self.enrollments.pop()
+                    task = ("POST /{sha256}", "POST", "/" + csr[0], csr[1])
+                else:
+                    schedule(due + rand.expovariate(self.ca_rate), "ca")
+                    task = ("GET /root.crt", "GET", "/root.crt")
+                future = pool.submit(self.call, *task)
+                future.add_done_callback(release)
+                if kind == "enroll":
+                    future.add_done_callback(poll_after(csr))
+        return self.stats.report(time.monotonic() - start)
+
+
+class InProcess(object):
+    """The caramel app with a fresh CA, on a fresh SQLite database in a
+    temporary directory unless given a dburl, and optionally the
+    autosigner in a thread"""
+
+    def __init__(self, dburl=None, ca_bits=2048):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ca = fixtures.signing_ca(ca_bits)
+        cert = os.path.join(self.directory.name, "caramel.ca.cert")
+        key = os.path.join(self.directory.name, "caramel.ca.key")
+        with open(cert, "wb") as f:
+            f.write(self.ca.pem)
+        with open(key, "wb") as f:
+            f.write(_crypto.dump_privatekey(_crypto.FILETYPE_PEM, self.ca.key))
+        if dburl is None:
+            path = os.path.join(self.directory.name, "caramel.sqlite")
+            dburl = "sqlite:///" + path
+        self.settings = {
+            "sqlalchemy.url": dburl,
+            "sqlite.profile": "true",
+            "ca.cert": cert,
+            "ca.key": key,
+        }
+        self.stop = threading.Event()
+        self.signer = None
+
+    def app(self):
+        import caramel
+
+        # A session left from earlier use would stay bound to its database
+        models.DBSession.remove()
+        app = caramel.main({}, **self.settings)
+        models.Base.metadata.create_all(models.DBSession.get_bind())
+        return app
+
+    def start_autosign(self, delay=0.1, lifetime=datetime.timedelta(hours=3)):
+        from caramel.scripts import autosign
+
+        self.signer = threading.Thread(
+            target=autosign.mainloop,
+            args=(delay, self.ca, lifetime),
+            kwargs={"max_delay": 1.0, "stop": self.stop},
+            daemon=True,
+        )
+        self.signer.start()
+
+    def close(self):
+        self.stop.set()
+        if self.signer is not None:
+            self.signer.join()
+        models.DBSession.remove()
+        self.directory.cleanup()
+
+
+def ca_prefix(client):
+    """The subject prefix requests need, from the CA the server hands out"""
+    status, pem = client.request("GET", "/root.crt")
+    if status != 200:
+        raise RuntimeError("Fetching the CA failed: HTTP {}".format(status))
+    return models.SigningCert(pem).get_ca_prefix()
+
+
+def print_report(report, out=sys.stdout):
+    columns = ["requests", "per_second", "error_rate"]
+    columns += ["p{}".format(q) for q in PERCENTILES]
+    print(
+        "{:<16}".format("endpoint") + "".join("{:>12}".format(c) for c in columns),
+        file=out,
+    )
+    for endpoint, row in report.items():
+        cells = [
+            "{:>12}".format(row["requests"]),
+            "{:>12.1f}".format(row["per_second"]),
+            "{:>12.2%}".format(row["error_rate"]),
+        ]
+        cells += [
+            "{:>10.1f}ms".format(row["p{}".format(q)] * 1000) for q in PERCENTILES
+        ]
+        print("{:<16}".format(endpoint) + "".join(cells), file=out)
+
+
+def cmdline():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Test a running server rather than in-process")
+    parser.add_argument("--dburl", help="Database for the in-process app")
+    parser.add_argument("--autosign", action="store_true", help="Sign in-process")
+    parser.add_argument("--devices", type=int, default=DEVICES)
+    parser.add_argument("--duration", type=float, default=DURATION, help="Seconds")
+    parser.add_argument(
+        "--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds per device"
+    )
+    parser.add_argument(
+        "--enroll-rate", type=float, default=ENROLL_RATE, help="New devices per second"
+    )
+    parser.add_argument(
+        "--ca-rate", type=float, default=CA_RATE, help="CA fetches per second"
+    )
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON here")
+    args = parser.parse_args()
+    if args.url and (args.autosign or args.dburl):
+        parser.error("--autosign and --dburl are for the in-process app")
+    return args
+
+
+def main():
+    args = cmdline()
+    server = None
+    if args.url:
+        client = HTTPClient(args.url, args.concurrency)
+    else:
+        server = InProcess(args.dburl)
+        client = WSGIClient(server.app())
+    try:
+        enrollments = int(args.enroll_rate * args.duration * 1.5) + 1
+        csrs = make_csrs(args.devices + enrollments, ca_prefix(client), args.seed)
+        fleet = Fleet(
+            client,
+            csrs[: args.devices],
+            csrs[args.devices :],
+            duration=args.duration,
+            poll_interval=args.poll_interval,
+            enroll_rate=args.enroll_rate,
+            ca_rate=args.ca_rate,
+            concurrency=args.concurrency,
+            seed=args.seed,
+        )
+        fleet.enroll_all()
+        if args.autosign:
+            server.start_autosign()
+        report = fleet.run()
+    finally:
+        client.close()
+        if server is not None:
+            server.close()
+    print_report(report)
+    if fleet.missed:
+        print("{} enrollments skipped, out of requests".format(fleet.missed))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
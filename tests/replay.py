@@ -0,0 +1,279 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.replay exports the certificate fetches of the access log as an
+anonymized trace, and replays it against a test instance, to test changes
+against the real polling pattern rather than tests.loadtest's synthetic one.
+
+The trace is a CSV of offset (seconds since --since, or the first fetch
+exported), device and addr. Devices and addresses are numbered by first
+appearance, so the trace keeps which fetches came from the same request, or
+from behind the same address, but neither CN, hash nor address:
+
+    python -m tests.replay export --dburl postgresql:///caramel \\
+        --since 2024-05-01 --until 2024-05-02 --output trace.csv
+    python -m tests.replay run trace.csv --speed 10
+    python -m tests.replay run trace.csv --url http://127.0.0.1:6543
+
+Replay enrolls one request per device and waits for them to be signed,
+in-process by the autosigner or, with --url, by the test instance's own,
+before fetching at the recorded offsets divided by --speed. Requests start
+on schedule as long as fewer than --concurrency are in flight; how late they
+started is reported, as a client that can't keep up skews the latencies."""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import sys
+import threading
+import time
+
+from caramel import config, models
+from caramel.scripts.tool import parse_utc
+
+from . import loadtest
+
+FIELDS = ("offset", "device", "addr")
+ENDPOINT = "GET /{sha256}"
+CONCURRENCY = 64
+# Seconds to wait for the enrolled requests to be signed
+SIGN_TIMEOUT = 300
+
+
+def export(rows, out, start=None):
+    """Writes rows of AccessLog.iter_trace to out as an anonymized trace,
+    with offsets from start or the first row, returns how many"""
+    devices = {}
+    addrs = {}
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    count = 0
+    for row in rows:
+        if start is None:
+            start = row.when
+        device = devices.setdefault(row.csr_id, len(devices))
+        addr = addrs.setdefault(row.addr, len(addrs))
+        offset = (row.when - start).total_seconds()
+        writer.writerow(("{:.3f}".format(offset), device, addr))
+        count += 1
+    return count
+
+
+def load_trace(path):
+    """(offset, device) of the fetches in the trace at path, in order"""
+    with open(path, newline="") as f:
+        trace = sorted(
+            (float(row["offset"]), int(row["device"])) for row in csv.DictReader(f)
+        )
+    if trace and trace[0][0] < 0:
+        # Rows are exported in id order, which needn't be the order of when
+        first = trace[0][0]
+        trace = [(offset - first, device) for offset, device in trace]
+    return trace
+
+
+def wait_signed(client, csrs, timeout=SIGN_TIMEOUT, interval=0.5):
+    """Waits until every request in csrs has a certificate"""
+    deadline = time.monotonic() + timeout
+    pending = list(csrs)
+    while pending:
+        pending = [
+            csr for csr in pending if client.request("GET", "/" + csr[0])[0] != 200
+        ]
+        if not pending:
+            break
+        if time.monotonic() > deadline:
+            raise RuntimeError("{} requests weren't signed".format(len(pending)))
+        time.sleep(interval)
+
+
+class Replay(object):
+    """Fetches the certificate of csrs[device] for every (offset, device) in
+    trace, speed times faster than recorded, for at most duration seconds"""
+
+    def __init__(
+        self, client, csrs, trace, speed=1.0, concurrency=CONCURRENCY, duration=None
+    ):
+        self.client = client
+        self.csrs = csrs
+        self.trace = trace
+        self.speed = speed
+        self.concurrency = concurrency
+        self.duration = duration
+        self.stats = loadtest.Stats()
+        # Seconds each request started after its due time
+        self.lags = []
+
+    def call(self, path, due):
+        self.lags.append(max(0.0, time.monotonic() - due))
+        start = time.perf_counter()
+        try:
+            status, _ = self.client.request("GET", path)
+        except Exception:
+            status = 0
+        self.stats.record(ENDPOINT, status, time.perf_counter() - start)
+
+    def run(self):
+        """Runs the trace, returns the per endpoint report"""
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def release(_):
+            slots.release()
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            for offset, device in self.trace:
+                due = offset / self.speed
+                if self.duration is not None and due >= self.duration:
+                    break
+                wait = start + due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                slots.acquire()
+                path = "/" + self.csrs[device][0]
+                future = pool.submit(self.call, path, start + due)
+                future.add_done_callback(release)
+        return self.stats.report(time.monotonic() - start)
+
+    def lag(self):
+        """Percentiles of how late requests started, in seconds"""
+        ordered = sorted(self.lags)
+        lag = {
+            "p{}".format(q): loadtest.percentile(ordered, q)
+            for q in loadtest.PERCENTILES
+        }
+        lag["max"] = ordered[-1] if ordered else None
+        return lag
+
+
+def print_statuses(report, out=sys.stdout):
+    for endpoint, row in report.items():
+        statuses = ", ".join(
+            "{}: {}".format(status, count)
+            for status, count in sorted(row["statuses"].items())
+        )
+        print("{:<16}{}".format(endpoint, statuses), file=out)
+
+
+def cmdline():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    exporting = commands.add_parser("export", help="Export a trace of the access log")
+    config.add_inifile_argument(exporting)
+    config.add_db_url_argument(exporting)
+    config.add_replica_db_url_argument(exporting)
+    exporting.add_argument(
+        "--since", type=parse_utc, help="First fetch to export (UTC)"
+    )
+    exporting.add_argument(
+        "--until", type=parse_utc, help="Export fetches before this (UTC)"
+    )
+    exporting.add_argument("--output", help="Write the trace here, not to stdout")
+
+    running = commands.add_parser("run", help="Replay a trace")
+    running.add_argument("trace", help="Trace from export")
+    running.add_argument("--url", help="Test a running server rather than in-process")
+    running.add_argument("--dburl", help="Database for the in-process app")
+    running.add_argument(
+        "--speed", type=float, default=1.0, help="Replay this many times faster"
+    )
+    running.add_argument(
+        "--duration", type=float, help="Stop after this many seconds of replay"
+    )
+    running.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    running.add_argument(
+        "--sign-timeout",
+        type=float,
+        default=SIGN_TIMEOUT,
+        help="Seconds to wait for the enrolled requests to be signed",
+    )
+    running.add_argument("--seed", type=int, default=0)
+    running.add_argument("--output", help="Write the report as JSON here")
+    args = parser.parse_args()
+    if args.command == "run":
+        if args.url and args.dburl:
+            parser.error("--dburl is for the in-process app")
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+    return args
+
+
+def main_export(args):
+    settings = config.load_settings(args.inifile)
+    config.init_engine(args, settings)
+    out = sys.stdout if args.output is None else open(args.output, "w", newline="")
+    try:
+        with models.use_replica():
+            rows = models.AccessLog.iter_trace(args.since, args.until)
+            count = export(rows, out, args.since)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print("Exported {} fetches".format(count), file=sys.stderr)
+
+
+def main_run(args):
+    trace = load_trace(args.trace)
+    if not trace:
+        sys.exit("The trace is empty")
+    devices = max(device for _, device in trace) + 1
+    server = None
+    if args.url:
+        client = loadtest.HTTPClient(args.url, args.concurrency)
+    else:
+        server = loadtest.InProcess(args.dburl)
+        client = loadtest.WSGIClient(server.app())
+    try:
+        csrs = loadtest.make_csrs(devices, loadtest.ca_prefix(client), args.seed)
+        loadtest.enroll(client, csrs, args.concurrency)
+        if server is not None:
+            server.start_autosign()
+        wait_signed(client, csrs, args.sign_timeout)
+        if server is not None:
+            # Signing is done, leave the process to the app
+            server.stop.set()
+        replay = Replay(
+            client,
+            csrs,
+            trace,
+            speed=args.speed,
+            concurrency=args.concurrency,
+            duration=args.duration,
+        )
+        report = replay.run()
+    finally:
+        client.close()
+        if server is not None:
+            server.close()
+    lag = replay.lag()
+    loadtest.print_report(report)
+    print_statuses(report)
+    print(
+        "Start lag "
+        + ", ".join(
+            "{} {:.1f}ms".format(name, seconds * 1000)
+            for name, seconds in lag.items()
+            if seconds is not None
+        )
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"speed": args.speed, "endpoints": report, "start_lag": lag},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+
+def main():
+    args = cmdline()
+    if args.command == "export":
+        main_export(args)
+    else:
+        main_run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_autosign contains the unittests for caramel.scripts.autosign"""
+
+import threading
+import unittest
+from unittest import mock
+
+from caramel.models import CSR, AutosignBatch
+from caramel.scripts import autosign
+from caramel.scripts.autosign import Pacer, mainloop
+
+
+class TestPacer(unittest.TestCase):
+    def test_initial_batch_is_one_per_worker(self):
+        pacer = Pacer(0.5, 30, max_batch=256, workers=16)
+        self.assertEqual(16, pacer.batch_size())
+
+    def test_batch_follows_latency(self):
+        pacer = Pacer(0.5, 30, max_batch=256, workers=4, target=1.0)
+        pacer.observe([0.1])
+        self.assertEqual(40, pacer.batch_size())
+        pacer.observe([2.0] * 20)
+        self.assertEqual(4, pacer.batch_size())
+
+    def test_batch_is_bounded(self):
+        pacer = Pacer(0.5, 30, max_batch=32, workers=16)
+        pacer.observe([0.001])
+        self.assertEqual(32, pacer.batch_size())
+
+    def test_full_batch_does_not_sleep(self):
+        pacer = Pacer(0.5, 30)
+        self.assertEqual(0, pacer.next_delay(16, 16, 0))
+
+    def test_idle_backoff(self):
+        pacer = Pacer(0.5, 3)
+        delays = [pacer.next_delay(0, 16, 0) for _ in range(5)]
+        self.assertEqual([0.5, 1.0, 2.0, 3, 3], delays)
+
+    def test_signing_resets_backoff(self):
+        pacer = Pacer(0.5, 30)
+        pacer.next_delay(0, 16, 0)
+        pacer.next_delay(0, 16, 0)
+        self.assertEqual(0.5, pacer.next_delay(3, 16, 3))
+        self.assertEqual(0.5, pacer.next_delay(0, 16, 0))
+
+
+class TestMainloop(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(AutosignBatch, "ensure_table")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stop(self):
+        """Setting stop ends the loop, without sleeping out the delay"""
+        stop = threading.Event()
+
+        def unsigned(limit, after_id):
+            stop.set()
+            return []
+
+        with mock.patch.object(
+            CSR, "unsigned_count", return_value=0
+        ), mock.patch.object(CSR, "unsigned", side_effect=unsigned) as fetch:
+            mainloop(60, None, None, stop=stop)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_records_batches(self):
+        """Signed batches are kept for the Retry-After signing capacity"""
+        stop = threading.Event()
+        batches = [[mock.Mock(id=1), mock.Mock(id=2)]]
+
+        def unsigned(limit, after_id):
+            if not batches:
+                stop.set()
+                return []
+            return batches.pop()
+
+        with mock.patch.object(
+            CSR, "unsigned_count", return_value=0
+        ), mock.patch.object(CSR, "unsigned", side_effect=unsigned), mock.patch.object(
+            autosign, "timed_sign", return_value=(True, 0.1)
+        ), mock.patch.object(
+            AutosignBatch, "record"
+        ) as record:
+            mainloop(0, None, None, stop=stop)
+        record.assert_called_once_with(2, 0.2, 16)
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_backlog contains the unittests for caramel.backlog"""
+
+import datetime
+from unittest import mock
+
+from caramel.backlog import Backlog
+from caramel.models import CSR, AutosignBatch
+
+from . import ModelTestCase, fixtures
+
+
+class TestBacklog(ModelTestCase):
+    def setUp(self):
+        super(TestBacklog, self).setUp()
+        self.good = fixtures.CSRData.good()
+        self.good.save()
+        self.other = fixtures.CSRData.bad_subject()
+        self.other.save()
+        self.backlog = Backlog(minimum=5, maximum=300, window=100)
+
+    def capacity(self, per_second):
+        return mock.patch.object(
+            AutosignBatch, "capacity_since", return_value=per_second
+        )
+
+    def test_position(self):
+        self.assertEqual(self.backlog.position(self.good.id), 0)
+        self.assertEqual(self.backlog.position(self.other.id), 1)
+        # Signed before the snapshot
+        initial = CSR.by_sha256sum(fixtures.CSRData.initial.sha256sum)
+        self.assertIsNone(self.backlog.position(initial.id))
+        # Posted after the snapshot
+        self.assertEqual(self.backlog.position(self.other.id + 1), 2)
+
+    def test_capacity(self):
+        """Workers over the sign latency of the batches in the window"""
+        now = datetime.datetime.utcnow()
+        AutosignBatch.record(1, 1.0, 4, now=now - datetime.timedelta(seconds=500))
+        AutosignBatch.record(1, 20.0, 2, now=now - datetime.timedelta(seconds=50))
+        AutosignBatch.record(3, 60.0, 2, now=now - datetime.timedelta(seconds=10))
+        since = now - datetime.timedelta(seconds=100)
+        self.assertEqual(AutosignBatch.capacity_since(since), 0.1)
+        # Two requests at 0.1 per second
+        self.assertEqual(self.backlog.retry_after(self.other.id), 20)
+
+    def test_idle(self):
+        """Without recent batches, requests are polled again soon, not on the
+        rate of an idle server"""
+        self.assertIsNone(AutosignBatch.capacity_since(datetime.datetime.min))
+        self.assertEqual(self.backlog.retry_after(self.good.id), 5)
+
+    def test_no_batches_table(self):
+        """Until the autosigner has run, there is no capacity"""
+        with mock.patch.object(AutosignBatch, "table_exists", return_value=False):
+            self.assertEqual(self.backlog.retry_after(self.good.id), 5)
+
+    def test_prune(self):
+        now = datetime.datetime.utcnow()
+        AutosignBatch.record(1, now=now - datetime.timedelta(days=2))
+        AutosignBatch.record(1, now=now)
+        self.assertEqual(AutosignBatch.query().count(), 1)
+
+    def test_retry_after(self):
+        """Signing one request per 50s"""
+        with self.capacity(0.02):
+            self.assertEqual(self.backlog.retry_after(self.good.id), 50)
+            self.assertEqual(self.backlog.retry_after(self.other.id), 100)
+
+    def test_clamped(self):
+        with self.capacity(1000):
+            self.assertEqual(self.backlog.retry_after(self.good.id), 5)
+        self.backlog._loaded = None
+        with self.capacity(0.001):
+            self.assertEqual(self.backlog.retry_after(self.good.id), 300)
+
+    def test_cached(self):
+        with mock.patch.object(CSR, "unsigned_ids", wraps=CSR.unsigned_ids) as ids:
+            self.backlog.retry_after(self.good.id)
+            self.backlog.retry_after(self.other.id)
+        self.assertEqual(ids.call_count, 1)
+
+    def test_limit(self):
+        """Past the kept ids, the total backlog is the position"""
+        backlog = Backlog(limit=1)
+        self.assertEqual(backlog.position(self.other.id), 2)
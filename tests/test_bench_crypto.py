@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_bench_crypto contains the unittests for tests.bench_crypto"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from . import bench_crypto
+
+BASELINE = {"sign 2048/2048": 0.002, "verify 2048": 0.0001}
+
+
+class TestCompare(unittest.TestCase):
+    def test_beyond_tolerance(self):
+        results = {"sign 2048/2048": 0.0026, "verify 2048": 0.0001}
+        self.assertEqual(
+            bench_crypto.compare(results, BASELINE, tolerance=0.25),
+            [("sign 2048/2048", 0.002, 0.0026)],
+        )
+
+    def test_within_tolerance(self):
+        results = {"sign 2048/2048": 0.0024, "verify 2048": 0.00005}
+        self.assertEqual(bench_crypto.compare(results, BASELINE, tolerance=0.25), [])
+
+    def test_not_in_baseline(self):
+        """New benchmarks have nothing to regress from"""
+        results = {"sign 4096/4096": 1.0}
+        self.assertEqual(bench_crypto.compare(results, BASELINE), [])
+
+
+class TestBaseline(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bench.json")
+        with open(self.path, "w") as f:
+            json.dump({"results": BASELINE}, f)
+
+    def main(self, results):
+        """Runs main against the baseline, returning the exit status and
+        what it logged"""
+        argv = ["bench_crypto", "--baseline", self.path, "--tolerance", "0.25"]
+        stderr = io.StringIO()
+        with mock.patch.object(bench_crypto.sys, "argv", argv), mock.patch.object(
+            bench_crypto, "run", return_value=results
+        ), mock.patch.object(bench_crypto.sys, "stderr", stderr):
+            try:
+                bench_crypto.main()
+            except SystemExit as exc:
+                return exc.code, stderr.getvalue()
+        return 0, stderr.getvalue()
+
+    def test_regression(self):
+        """A slowdown beyond the tolerance is reported, and fails"""
+        status, output = self.main({"sign 2048/2048": 0.003, "verify 2048": 0.0001})
+        self.assertEqual(status, 1)
+        self.assertIn("REGRESSION sign 2048/2048", output)
+        self.assertIn("+50%", output)
+
+    def test_within(self):
+        status, output = self.main({"sign 2048/2048": 0.0024, "verify 2048": 0.0001})
+        self.assertEqual(status, 0)
+        self.assertNotIn("REGRESSION", output)
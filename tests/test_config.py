@@ -3,6 +3,10 @@
 """tests.test_config contains the unittests for caramel.config"""
 import argparse
 import logging
+import os
+import subprocess
+import sys
+import time
 import unittest
 
 from caramel import config
@@ -219,3 +223,36 @@ class TestVerbosity(unittest.TestCase):
                 logger.setLevel(root_lvl)
                 verbosity = config.get_log_level(arg_lvl, logger, env)
                 self.assertEqual(expected, verbosity)
+
+
+class TestLoadSettings(unittest.TestCase):
+    """Tests for reading settings without building the app"""
+
+    INI = os.path.join(os.path.dirname(os.path.dirname(__file__)), "development.ini")
+
+    def test_load_settings(self):
+        """app:main is read, %(here)s interpolated and the defaults left out"""
+        settings = config.load_settings(self.INI)
+        here = os.path.dirname(os.path.abspath(self.INI))
+        url = "sqlite:///" + here + "/caramel.sqlite"
+        self.assertEqual(settings["sqlalchemy.url"], url)
+        self.assertNotIn("here", settings)
+        self.assertNotIn("__file__", settings)
+
+    def test_no_config_path(self):
+        settings = config.load_settings(None)
+        self.assertEqual(settings, config.DEFAULT_APP_SETTINGS)
+        self.assertIsNot(settings, config.DEFAULT_APP_SETTINGS)
+
+    def test_cli_startup(self):
+        """The CLI tools read settings without importing pyramid.config"""
+        code = (
+            "import sys\n"
+            "import caramel.scripts.tool\n"
+            "from caramel import config\n"
+            "config.load_settings({!r})\n"
+            "assert 'pyramid.config' not in sys.modules\n"
+        ).format(self.INI)
+        start = time.monotonic()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        self.assertLess(time.monotonic() - start, 1.5)
@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_dataset contains the unittests for tests.dataset"""
+
+import unittest
+from unittest import mock
+
+import transaction
+from sqlalchemy import create_engine
+
+from caramel.models import CSR, DBSession, init_session
+
+from . import dataset, fixtures, init_db
+
+
+class TestGenerate(unittest.TestCase):
+    def setUp(self):
+        DBSession.remove()
+        self.engine = create_engine("sqlite://")
+        init_session(self.engine, create=True)
+        # Leave a shared database for the tests that follow
+        self.addCleanup(init_db)
+
+    def test_orm_insert_after(self):
+        """The app can still add requests to a generated fleet"""
+        fleet = dataset.Fleet(20, seed=1)
+        counts = dataset.generate(self.engine, fleet, batch=8)
+        self.assertEqual(counts[0], 20)
+        with transaction.manager:
+            fixtures.CSRData.good().save()
+        self.assertEqual(CSR.query().count(), 21)
+
+    def test_postgresql_sequence(self):
+        conn = mock.Mock()
+        conn.dialect.name = "postgresql"
+        dataset.advance_sequence(conn, CSR.__table__)
+        statement, params = conn.execute.call_args[0]
+        self.assertIn("setval", str(statement))
+        self.assertIn("max(id) FROM csr", str(statement))
+        self.assertEqual(params, {"table": "csr"})
+        conn.dialect.name = "sqlite"
+        conn.reset_mock()
+        dataset.advance_sequence(conn, CSR.__table__)
+        conn.execute.assert_not_called()
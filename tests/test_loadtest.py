@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_loadtest contains the unittests for tests.loadtest"""
+
+import unittest
+
+from . import init_db, loadtest
+
+
+class TestPercentile(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_one(self):
+        for q in (0, 1, 50, 100):
+            self.assertEqual(loadtest.percentile([7], q), 7)
+
+    def test_nearest_rank(self):
+        ordered = list(range(1, 11))
+        self.assertEqual(loadtest.percentile(ordered, 0), 1)
+        self.assertEqual(loadtest.percentile(ordered, 50), 5)
+        self.assertEqual(loadtest.percentile(ordered, 95), 10)
+        self.assertEqual(loadtest.percentile(ordered, 100), 10)
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.server = loadtest.InProcess(ca_bits=1024)
+        self.addCleanup(init_db)
+        self.addCleanup(self.server.close)
+        self.client = loadtest.WSGIClient(self.server.app())
+
+    def test_run(self):
+        """A second of a small fleet reaches every endpoint without errors"""
+        csrs = loadtest.make_csrs(12, loadtest.ca_prefix(self.client), bits=1024)
+        fleet = loadtest.Fleet(
+            self.client,
+            csrs[:3],
+            csrs[3:],
+            duration=1.0,
+            poll_interval=0.2,
+            enroll_rate=5,
+            ca_rate=5,
+            concurrency=4,
+        )
+        fleet.enroll_all()
+        report = fleet.run()
+        self.assertEqual(
+            set(report), {"GET /{sha256}", "POST /{sha256}", "GET /root.crt"}
+        )
+        for endpoint, row in report.items():
+            self.assertGreater(row["requests"], 0, endpoint)
+            self.assertEqual(row["errors"], 0, endpoint)
+            self.assertLessEqual(row["p50"], row["p99"])
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_metrics contains the unittests for caramel.metrics"""
+
+import unittest
+import urllib.request
+
+from caramel import metrics
+
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter(
+            "things_total", "Things", labelnames=("kind",), registry=self.registry
+        )
+        counter.inc(kind="a")
+        counter.inc(2, kind='b"c')
+        self.assertEqual(
+            "# HELP things_total Things\n"
+            "# TYPE things_total counter\n"
+            'things_total{kind="a"} 1.0\n'
+            'things_total{kind="b\\"c"} 2.0\n',
+            self.registry.render(),
+        )
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("depth", "Depth", registry=self.registry)
+        gauge.set(7)
+        self.assertIn("depth 7.0\n", self.registry.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(
+            "latency_seconds", "Latency", buckets=(0.1, 1.0), registry=self.registry
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        rendered = self.registry.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1.0\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2.0\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3.0\n', rendered)
+        self.assertIn("latency_seconds_sum 5.55\n", rendered)
+        self.assertIn("latency_seconds_count 3.0\n", rendered)
+        self.assertEqual((3, 5.55), histogram.value())
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter(
+            "x_total", "X", labelnames=("a",), registry=self.registry
+        )
+        with self.assertRaises(ValueError):
+            counter.inc(b=1)
+
+
+class TestServe(unittest.TestCase):
+    def test_serve(self):
+        registry = metrics.Registry()
+        metrics.Gauge("up", "Up", registry=registry).set(1)
+        server = metrics.serve("127.0.0.1:0", registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        url = "http://127.0.0.1:{}/metrics".format(port)
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(metrics.CONTENT_TYPE, response.headers["Content-Type"])
+            self.assertIn(b"up 1.0\n", response.read())
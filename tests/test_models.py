@@ -1,15 +1,22 @@
 #! /usr/bin/env python
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
 
+import datetime
 import unittest
 from operator import attrgetter
+from unittest import mock
 
+from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from caramel.models import (
     CSR,
+    AccessLog,
+    REPLICA,
+    Base,
     SigningCert,
+    use_replica,
 )
 
 from . import ModelTestCase, fixtures
@@ -136,8 +143,78 @@ class TestQuery(ModelTestCase):
         expected = [fixtures.CSRData.initial]
         self.assertSimilarSequence(CSR.refreshable(), expected)
 
+    def test_refreshable_within(self):
+        """Only the expired certificate is within a day of expiry"""
+        expired = fixtures.CSRData.with_expired_cert()
+        expired.save()
+        window = datetime.timedelta(days=1)
+        self.assertSimilarSequence(CSR.refreshable(renew_within=window), [expired])
+
+    def test_refreshable_fraction(self):
+        """initial has half of its lifetime left"""
+        expired = fixtures.CSRData.with_expired_cert()
+        expired.save()
+        self.assertSimilarSequence(CSR.refreshable(renew_fraction=0.4), [expired])
+        self.assertSimilarSequence(
+            CSR.refreshable(renew_fraction=0.6),
+            [fixtures.CSRData.initial, expired],
+        )
+
     def test_unsigned(self):
         """Good is not signed and should be the only one"""
         good = fixtures.CSRData.good()
         good.save()
         self.assertSimilarSequence(CSR.unsigned(), [good])
+
+    def test_unsigned_batches(self):
+        """unsigned can be walked in id order with limit and after_id"""
+        good = fixtures.CSRData.good()
+        good.save()
+        other = fixtures.CSRData.bad_subject()
+        other.save()
+        self.assertSimilarSequence(CSR.unsigned(limit=1), [good])
+        self.assertSimilarSequence(CSR.unsigned(after_id=good.id), [other])
+
+    def test_iter_trace(self):
+        """Accesses come in id order, a page at a time, limited by since"""
+        initial = fixtures.CSRData.initial
+        accesses = [(access.when, access.addr) for access in initial.accessed]
+        rows = list(AccessLog.iter_trace(page_size=1))
+        self.assertEqual([(row.when, row.addr) for row in rows], accesses)
+        self.assertEqual({row.csr_id for row in rows}, {1})
+        since = fixtures.AccessLogData.initial_2.when
+        rows = list(AccessLog.iter_trace(since=since))
+        self.assertEqual([row.addr for row in rows], ["127.0.0.127"])
+
+
+class TestReplica(ModelTestCase):
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        # An empty replica, as if it hadn't caught up at all
+        replica = create_engine("sqlite://")
+        Base.metadata.create_all(replica)
+        REPLICA.configure(replica, max_lag=10)
+        self.addCleanup(REPLICA.configure, None)
+
+    def test_reads_replica(self):
+        with use_replica() as replica:
+            self.assertTrue(replica)
+            self.assertEqual(CSR.query().count(), 0)
+        self.assertEqual(CSR.query().count(), 1)
+
+    def test_writes_primary(self):
+        with use_replica():
+            fixtures.CSRData.good().save()
+        self.assertEqual(CSR.query().count(), 2)
+
+    def test_lagging_replica(self):
+        with mock.patch.object(REPLICA, "lag", return_value=60):
+            with use_replica() as replica:
+                self.assertFalse(replica)
+                self.assertEqual(CSR.query().count(), 1)
+
+    def test_no_replica(self):
+        REPLICA.configure(None)
+        with use_replica() as replica:
+            self.assertFalse(replica)
+            self.assertEqual(CSR.query().count(), 1)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_profiling contains the unittests for caramel.profiling"""
+
+import os
+import pstats
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from caramel import profiling
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def sleep(stop):
+    stop.wait()
+
+
+class TestSampler(unittest.TestCase):
+    def setUp(self):
+        self.stop = threading.Event()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def start(self, target, name):
+        thread = threading.Thread(target=target, args=(self.stop,), name=name)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.stop.set)
+
+    def stacks(self, sampler, thread_name):
+        return [stack for stack in sampler.stacks if stack.startswith(thread_name)]
+
+    def test_wall(self):
+        self.start(sleep, "sleeper")
+        sampler = profiling.Sampler("wall", interval=0.001)
+        sampler.run(0.05)
+        self.assertGreater(sampler.samples, 0)
+        (stack,) = self.stacks(sampler, "sleeper;")
+        self.assertIn("test_profiling.py:sleep;threading.py:wait", stack)
+
+    def test_cpu(self):
+        """Only threads that ran since the previous sample are counted"""
+        self.start(sleep, "sleeper")
+        self.start(spin, "spinner")
+        sampler = profiling.Sampler("cpu", interval=0.001)
+        if sampler.mode != "cpu":
+            self.skipTest("No per thread CPU time")
+        sampler.run(0.1)
+        self.assertEqual(self.stacks(sampler, "sleeper;"), [])
+        self.assertTrue(self.stacks(sampler, "spinner;"))
+
+    def test_no_native_ids(self):
+        """Before Python 3.8, cpu mode falls back to wall time"""
+        self.addCleanup(setattr, threading, "get_native_id", threading.get_native_id)
+        del threading.get_native_id
+        with self.assertLogs("caramel.profiling", "WARNING"):
+            sampler = profiling.Sampler("cpu")
+        self.assertEqual(sampler.mode, "wall")
+
+    def test_write(self):
+        sampler = profiling.Sampler()
+        sampler.stacks.update({"MainThread;a;b": 1, "MainThread;a": 3})
+        path = os.path.join(self.dir.name, "out.folded")
+        sampler.write(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "MainThread;a 3\nMainThread;a;b 1\n")
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            profiling.Sampler("user")
+
+    def test_pstats(self):
+        path = os.path.join(self.dir.name, "out.pstats")
+        profile = profiling.start(path)
+        sum(range(1000))
+        profile.stop()
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn("<built-in method builtins.sum>", functions)
+
+    def test_signal(self):
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.getsignal(signal.SIGUSR2))
+        self.assertTrue(profiling.install(self.dir.name, seconds=0.05))
+        with self.assertLogs("caramel.profiling", "WARNING") as logs:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            deadline = time.monotonic() + 5
+            while len(logs.output) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        (name,) = os.listdir(self.dir.name)
+        self.assertTrue(name.startswith("caramel-{}-".format(os.getpid())))
+        self.assertIn("Wrote profile", logs.output[-1])
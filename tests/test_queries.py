@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_queries contains the unittests for caramel.queries"""
+
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from caramel import models, queries
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+
+    def test_counting(self):
+        queries.install(self.engine)
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            with queries.counting() as stats:
+                conn.execute(text("SELECT 2"))
+                conn.execute(text("SELECT 3"))
+            conn.execute(text("SELECT 4"))
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.statements, ["SELECT 2", "SELECT 3"])
+
+    def test_not_installed(self):
+        with queries.counting() as stats:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        self.assertEqual(stats.count, 0)
+
+    def test_slow(self):
+        """Slow statements are logged with the caramel code running them"""
+        queries.install(self.engine, slow=0)
+        models.DBSession.remove()
+        models.init_session(self.engine, create=True)
+        with self.assertLogs("caramel.queries", "WARNING") as logs:
+            models.CSR.valid()
+        self.assertIn("from models.py:", logs.output[0])
+        self.assertIn("FROM csr", logs.output[0])
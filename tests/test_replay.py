@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_replay contains the unittests for tests.replay"""
+
+import datetime
+import io
+import os
+import tempfile
+
+from caramel.models import AccessLog, DBSession
+
+from . import ModelTestCase, fixtures, replay
+
+START = datetime.datetime(2024, 5, 1)
+
+
+class TestExport(ModelTestCase):
+    db_per_test = True
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.csrs = [fixtures.CSRData.good(), fixtures.CSRData.bad_subject()]
+        # (csr, addr, seconds after START)
+        accesses = [
+            (1, "192.0.2.10", 0.5),
+            (0, "198.51.100.7", 1.0),
+            (1, "192.0.2.10", 2.25),
+            (0, "192.0.2.10", 4.0),
+        ]
+        for csr in self.csrs:
+            csr.save()
+        for index, addr, offset in accesses:
+            access = AccessLog(self.csrs[index], addr)
+            access.when = START + datetime.timedelta(seconds=offset)
+            DBSession.add(access)
+        DBSession.flush()
+
+    def export(self):
+        out = io.StringIO()
+        rows = AccessLog.iter_trace(START, START + datetime.timedelta(hours=1))
+        self.assertEqual(replay.export(rows, out, START), 4)
+        return out.getvalue()
+
+    def test_anonymized(self):
+        """Neither CN, hash nor address of the requests is exported"""
+        trace = self.export()
+        for csr in self.csrs:
+            self.assertNotIn(csr.commonname, trace)
+            self.assertNotIn(csr.sha256sum, trace)
+        for addr in ("192.0.2.10", "198.51.100.7", "192.0", "198.51"):
+            self.assertNotIn(addr, trace)
+
+    def test_renumbered(self):
+        """Devices and addresses are numbered by first appearance"""
+        self.assertEqual(
+            self.export().splitlines(),
+            [
+                "offset,device,addr",
+                "0.500,0,0",
+                "1.000,1,1",
+                "2.250,0,0",
+                "4.000,1,0",
+            ],
+        )
+
+    def test_round_trip(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "trace.csv")
+        with open(path, "w", newline="") as f:
+            f.write(self.export())
+        self.assertEqual(
+            replay.load_trace(path), [(0.5, 0), (1.0, 1), (2.25, 0), (4.0, 1)]
+        )
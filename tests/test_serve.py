@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_serve contains the unittests for caramel_serve"""
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+from caramel.scripts import serve
+
+_SERVER = """
+import os
+from caramel.scripts import serve
+
+def app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+
+sock = serve.bind("127.0.0.1:0")
+print(sock.getsockname()[1], flush=True)
+serve.Master(lambda: app, sock, workers=2, threads=1, graceful_timeout=5).run()
+"""
+
+# Serves the metrics like the timing tween, on the path in argv
+_METRICS_SERVER = """
+import os
+import sys
+from caramel import timing
+from caramel.scripts import serve
+
+metrics = timing._MetricsServer("unix:" + sys.argv[1])
+
+def app(environ, start_response):
+    metrics.start()
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+
+sock = serve.bind("127.0.0.1:0")
+print(sock.getsockname()[1], flush=True)
+serve.Master(lambda: app, sock, workers=2, threads=1, graceful_timeout=5).run()
+"""
+
+
+class TestListen(unittest.TestCase):
+    INI = os.path.join(os.path.dirname(os.path.dirname(__file__)), "development.ini")
+
+    def test_from_ini(self):
+        args = argparse.Namespace(listen=None)
+        self.assertRegex(serve.get_listen(args, self.INI), r"^[\w.:]+:6543$")
+
+    def test_argument(self):
+        args = argparse.Namespace(listen="127.0.0.1:8080")
+        self.assertEqual(serve.get_listen(args, self.INI), "127.0.0.1:8080")
+
+    def test_default(self):
+        args = argparse.Namespace(listen=None)
+        self.assertEqual(serve.get_listen(args), serve.DEFAULT_LISTEN)
+
+
+class TestMaster(unittest.TestCase):
+    SERVER = _SERVER
+    ARGS = ()
+
+    def setUp(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", self.SERVER, *self.ARGS],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(self.proc.kill)
+        self.addCleanup(self.proc.stdout.close)
+        self.url = "http://127.0.0.1:{}/".format(self.proc.stdout.readline().strip())
+
+    def fetch_pid(self):
+        with urllib.request.urlopen(self.url, timeout=5) as response:
+            return int(response.read())
+
+    def test_reload_and_stop(self):
+        """Workers answer, are replaced on SIGHUP and stop on SIGTERM"""
+        old = {self.fetch_pid() for _ in range(4)}
+        self.assertNotIn(self.proc.pid, old)
+        self.proc.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + 10
+        while self.fetch_pid() in old:
+            self.assertLess(time.monotonic(), deadline, "workers not replaced")
+            time.sleep(0.1)
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(timeout=10), 0)
+
+
+class TestMetrics(TestMaster):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "metrics.sock")
+        self.SERVER = _METRICS_SERVER
+        self.ARGS = (self.path,)
+        super(TestMetrics, self).setUp()
+
+    def fetch_metrics(self, path):
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            return sock.makefile("rb").readline()
+
+    def test_per_worker(self):
+        """Each of two workers serves its metrics on its own socket"""
+        paths = [self.path + "-0", self.path + "-1"]
+        deadline = time.monotonic() + 10
+        while not all(os.path.exists(path) for path in paths):
+            self.assertLess(time.monotonic(), deadline, "metrics not served")
+            self.fetch_pid()
+        for path in paths:
+            self.assertIn(b" 200 ", self.fetch_metrics(path))
+        self.assertFalse(os.path.exists(self.path))
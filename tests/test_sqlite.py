@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_sqlite contains the unittests for caramel.sqlite"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from caramel import sqlite
+
+
+def _locked():
+    return OperationalError(
+        "INSERT", {}, sqlite3.OperationalError("database is locked")
+    )
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.tmp.name, "caramel.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pragmas(self):
+        engine = create_engine(self.url, **sqlite.engine_options(self.url))
+        self.assertTrue(sqlite.apply_profile(engine, {"sqlite.busy_timeout": "1234"}))
+        with engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal"
+            )
+            self.assertEqual(conn.exec_driver_sql("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(conn.exec_driver_sql("PRAGMA busy_timeout").scalar(), 1234)
+        engine.dispose()
+
+    def test_readers_not_blocked(self):
+        """A reader sees the last commit while another connection writes"""
+        engine = create_engine(self.url, **sqlite.engine_options(self.url))
+        sqlite.apply_profile(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE t (x INTEGER)")
+            conn.exec_driver_sql("INSERT INTO t VALUES (1)")
+        writer = engine.connect()
+        trans = writer.begin()
+        writer.exec_driver_sql("INSERT INTO t VALUES (2)")
+        with engine.connect() as reader:
+            count = reader.exec_driver_sql("SELECT count(*) FROM t").scalar()
+        self.assertEqual(count, 1)
+        trans.commit()
+        writer.close()
+        engine.dispose()
+
+    def test_memory_ignored(self):
+        engine = create_engine("sqlite://")
+        self.assertEqual(sqlite.engine_options("sqlite://"), {})
+        self.assertFalse(sqlite.apply_profile(engine))
+
+    def test_not_sqlite(self):
+        self.assertFalse(sqlite.is_file_database("postgresql://host/caramel"))
+
+
+class TestRetryOnBusy(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(sqlite, "BUSY_DELAY", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_is_busy(self):
+        self.assertTrue(sqlite.is_busy(_locked()))
+        error = OperationalError(
+            "SELECT", {}, sqlite3.OperationalError("no such table")
+        )
+        self.assertFalse(sqlite.is_busy(error))
+        self.assertFalse(sqlite.is_busy(ValueError("database is locked")))
+
+    def test_retries(self):
+        func = mock.Mock(side_effect=[_locked(), _locked(), "done"])
+        self.assertEqual(sqlite.retry_on_busy(func, 1, key=2), "done")
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with(1, key=2)
+
+    def test_gives_up(self):
+        func = mock.Mock(side_effect=_locked())
+        with self.assertRaises(OperationalError):
+            sqlite.retry_on_busy(func)
+        self.assertEqual(func.call_count, sqlite.BUSY_ATTEMPTS)
+
+    def test_other_errors_raise(self):
+        error = OperationalError(
+            "SELECT", {}, sqlite3.OperationalError("no such table")
+        )
+        func = mock.Mock(side_effect=error)
+        with self.assertRaises(OperationalError):
+            sqlite.retry_on_busy(func)
+        self.assertEqual(func.call_count, 1)
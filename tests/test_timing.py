@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_timing contains the unittests for caramel.timing"""
+
+import unittest
+from unittest import mock
+
+from pyramid.response import Response
+
+from caramel import timing
+
+
+class TestPhase(unittest.TestCase):
+    def test_disabled(self):
+        """Outside a timed request, phases are the shared null context"""
+        self.assertIs(timing.phase("parse"), timing.phase("flush"))
+
+    def test_server_timing(self):
+        header = timing.server_timing([("flush", 0.001), ("ca", 0.5), ("flush", 0.002)])
+        self.assertEqual(header, "flush;dur=3.00, ca;dur=500.00")
+
+
+class TestTween(unittest.TestCase):
+    def setUp(self):
+        self.registry = mock.Mock(settings={})
+        self.request = mock.Mock()
+        self.request.matched_route.name = "csr"
+
+    def handler(self, request):
+        with timing.phase("parse"):
+            pass
+        with timing.phase("flush"):
+            pass
+        return Response()
+
+    def test_header(self):
+        tween = timing.timing_tween_factory(self.handler, self.registry)
+        before = timing.PHASE_SECONDS.value(route="csr", phase="flush")[0]
+        response = tween(self.request)
+        names = [
+            part.split(";")[0] for part in response.headers["Server-Timing"].split(", ")
+        ]
+        self.assertEqual(names, ["parse", "flush", "total", "sql"])
+        self.assertEqual(
+            timing.PHASE_SECONDS.value(route="csr", phase="flush")[0], before + 1
+        )
+        # Phases after the request are not timed
+        self.assertIs(timing.phase("parse"), timing._NULL)
+
+    def test_no_header(self):
+        self.registry.settings["timing.header"] = "false"
+        tween = timing.timing_tween_factory(self.handler, self.registry)
+        before = timing.REQUEST_SECONDS.value(route="csr")[0]
+        response = tween(self.request)
+        self.assertNotIn("Server-Timing", response.headers)
+        self.assertEqual(timing.REQUEST_SECONDS.value(route="csr")[0], before + 1)
+
+
+class TestMetricsAddress(unittest.TestCase):
+    def test_outside_serve(self):
+        self.assertEqual(timing.metrics_address("127.0.0.1:9101"), "127.0.0.1:9101")
+
+    def test_port(self):
+        self.assertEqual(timing.metrics_address("127.0.0.1:9101", 2), "127.0.0.1:9103")
+
+    def test_unix(self):
+        self.assertEqual(
+            timing.metrics_address("unix:/run/caramel.sock", 0),
+            "unix:/run/caramel.sock-0",
+        )
@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
+"""tests.test_tool contains the unittests for caramel.scripts.tool"""
+
+import csv
+import datetime
+import io
+import json
+import unittest.mock
+
+import transaction
+
+from caramel import models
+from caramel.models import CSR, Certificate, RefreshRun
+from caramel.scripts import tool
+
+from . import ModelTestCase, fixtures
+
+day = datetime.timedelta(days=1)
+
+
+class TestRefresh(ModelTestCase):
+    db_per_test = True
+
+    def setUp(self):
+        super(TestRefresh, self).setUp()
+        with transaction.manager:
+            fixtures.CSRData.with_expired_cert().save()
+        patcher = unittest.mock.patch.object(tool, "refresh")
+        self.refresh = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_checkpoints(self):
+        tool.csr_resign(None, day, 7 * day, False, chunk=1)
+        self.assertEqual(2, self.refresh.call_count)
+        run = RefreshRun.latest()
+        self.assertEqual(2, run.signed)
+        self.assertEqual(0, run.failed)
+        self.assertIsNotNone(run.finished)
+
+    def test_query_count(self):
+        """The newest certificates are loaded once per chunk, and handed to
+        the workers"""
+        with self.assertMaxQueries(9):
+            tool.csr_resign(None, day, 7 * day, False)
+        for call in self.refresh.call_args_list:
+            self.assertIsInstance(call.kwargs["last"], Certificate)
+
+    def test_failures_are_counted(self):
+        self.refresh.side_effect = ValueError("nope")
+        tool.csr_resign(None, day, 7 * day, False)
+        self.assertEqual(2, RefreshRun.latest().failed)
+
+    def test_resume_finished_is_noop(self):
+        tool.csr_resign(None, day, 7 * day, False)
+        self.refresh.reset_mock()
+        tool.csr_resign(None, day, 7 * day, False, resume=True)
+        self.refresh.assert_not_called()
+
+    def test_resume_interrupted(self):
+        RefreshRun.ensure_table()
+        first = fixtures.CSRData.initial.sha256sum
+        with transaction.manager:
+            RefreshRun(last_csr_id=1, signed=1, failed=0).save()
+        tool.csr_resign(None, day, 7 * day, False, resume=True)
+        self.assertEqual(1, self.refresh.call_count)
+        csr = self.refresh.call_args[0][0]
+        self.assertNotEqual(first, csr.sha256sum)
+        self.assertEqual(2, RefreshRun.latest().signed)
+
+
+class TestClean(ModelTestCase):
+    db_per_test = True
+
+    def setUp(self):
+        super(TestClean, self).setUp()
+        with transaction.manager:
+            csr = CSR.query().one()
+            for age in (1, 2, 3):
+                old = fixtures.CertificateData.initial(csr)
+                old.not_after -= age * 365 * day
+                old.save()
+            fixtures.CSRData.with_expired_cert().save()
+
+    def count(self, csr_id):
+        return Certificate.query().filter_by(csr_id=csr_id).count()
+
+    def test_clean_all(self):
+        self.assertEqual(3, tool.clean_all(dry_run=True))
+        self.assertEqual(4, self.count(1))
+        self.assertEqual(3, tool.clean_all())
+        self.assertEqual(1, self.count(1))
+        self.assertEqual(1, self.count(2))
+        newest = Certificate.query().filter_by(csr_id=1).one()
+        self.assertEqual(fixtures.CertificateData.initial.not_after, newest.not_after)
+
+    def test_clean_ties(self):
+        """Of certificates expiring at once, the last one made is kept"""
+        with transaction.manager:
+            csr = CSR.query().get(1)
+            twin = fixtures.CertificateData.initial(csr)
+            twin.save()
+            twin_id = twin.id
+        self.assertEqual(4, tool.csr_clean(1))
+        self.assertEqual(
+            [twin_id], [cert.id for cert in CSR.query().get(1).certificates]
+        )
+
+    def test_clean_all_skips_rejected(self):
+        with transaction.manager:
+            CSR.query().get(1).rejected = True
+        self.assertEqual(0, tool.clean_all())
+        self.assertEqual(4, self.count(1))
+
+    def test_clean_chunks(self):
+        selection = Certificate.superseded()
+        self.assertEqual(3, tool.delete_certificates(selection, chunk=2))
+        self.assertEqual(1, self.count(1))
+
+    def test_clean_one(self):
+        self.assertEqual(0, tool.csr_clean(2))
+        self.assertEqual(3, tool.csr_clean(1))
+        self.assertEqual(1, self.count(1))
+
+    def test_wipe(self):
+        self.assertEqual(4, tool.csr_wipe(1, dry_run=True))
+        self.assertEqual(4, tool.csr_wipe(1))
+        self.assertEqual(0, self.count(1))
+        self.assertEqual(1, self.count(2))
+
+    def test_missing(self):
+        with self.assertRaises(SystemExit):
+            tool.csr_wipe(17)
+
+
+class TestList(ModelTestCase):
+    def setUp(self):
+        super(TestList, self).setUp()
+        self.good = fixtures.CSRData.good()
+        self.good.save()
+        self.expired = fixtures.CSRData.with_expired_cert()
+        self.expired.save()
+
+    def listed(self, output_format="jsonl", **filters):
+        out = io.StringIO()
+        tool.print_list(output_format, out=out, **filters)
+        return out.getvalue().splitlines()
+
+    def test_signed_first(self):
+        rows = [json.loads(line) for line in self.listed()]
+        self.assertEqual([1, 3, 2], [row["id"] for row in rows])
+        self.assertIsNone(rows[-1]["not_after"])
+
+    def test_query_count(self):
+        with self.assertMaxQueries(2):
+            self.listed()
+
+    def test_paged(self):
+        rows = models.CSR.iter_printable(page_size=1)
+        self.assertEqual([1, 3, 2], [row.id for row in rows])
+
+    def test_text(self):
+        lines = self.listed("text")
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[-1].endswith(" ----------"))
+
+    def test_csv(self):
+        rows = list(csv.reader(self.listed("csv")))
+        self.assertEqual(["id", "commonname", "sha256sum", "not_after"], rows[0])
+        self.assertEqual(["2", "bar.example.com", self.good.sha256sum, ""], rows[-1])
+
+    def test_filters(self):
+        def ids(**filters):
+            return [json.loads(line)["id"] for line in self.listed(**filters)]
+
+        self.assertEqual([2], ids(signed=False))
+        self.assertEqual([1, 3], ids(signed=True))
+        self.assertEqual([3], ids(expiring_before=datetime.datetime.utcnow()))
+        self.assertEqual([1, 3, 2], ids(orgunit="Example Dept"))
+        self.assertEqual([], ids(orgunit="Other Dept"))
+        self.assertEqual([1], ids(like=tool.glob_to_like("f*")))
+        self.assertEqual([2], ids(like=tool.glob_to_like("?a?.example.com")))
+
+    def test_parse_utc(self):
+        expected = datetime.datetime(2024, 5, 1, 10, 30)
+        self.assertEqual(expected, tool.parse_utc("2024-05-01 10:30"))
+        self.assertEqual(expected, tool.parse_utc("2024-05-01T12:30+02:00"))
+        self.assertEqual(expected, tool.parse_utc("2024-05-01T10:30Z"))
+
+    def test_glob_to_like(self):
+        self.assertEqual("a\\_b%c_", tool.glob_to_like("a_b*c?"))
+
+
+class TestBulk(ModelTestCase):
+    db_per_test = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestBulk, cls).setUpClass()
+        cls.ca = fixtures.signing_ca()
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        with transaction.manager:
+            fixtures.CSRData.good().save()
+            fixtures.CSRData.with_expired_cert().save()
+
+    def test_parse_ids(self):
+        self.assertEqual([(1, 3), (7, 7)], tool.parse_ids("1-3,7"))
+        self.assertEqual([(2, 2), (4, 5)], tool.parse_ids("-", io.StringIO("2\n4-5\n")))
+        with self.assertRaises(SystemExit):
+            tool.parse_ids("1-x")
+
+    def test_select(self):
+        def ids(**selectors):
+            return [row.id for row in tool.select_bulk(**selectors)]
+
+        self.assertEqual([1, 3, 2], ids())
+        self.assertEqual([1, 2], ids(ids=[(1, 2)]))
+        self.assertEqual([3, 2], ids(cn_regex="^(spam|bar)\\."))
+        self.assertEqual([2], ids(signed=False, orgunit="Example Dept"))
+
+    def test_select_ids_in_sql(self):
+        with self.assertMaxQueries(2) as sql:
+            rows = list(tool.select_bulk(ids=[(2, 2), (3, 7)]))
+        self.assertEqual([3, 2], [row.id for row in rows])
+        self.assertIn("BETWEEN", sql.statements[0])
+
+    def test_dry_run(self):
+        rows = tool.select_bulk(signed=False)
+        self.assertEqual((0, 0), tool.bulk_sign(rows, self.ca, day, False, True))
+        self.assertEqual(1, len(CSR.unsigned()))
+
+    def test_sign(self):
+        rows = tool.select_bulk()
+        # initial has a valid, longer lived certificate
+        self.assertEqual((2, 1), tool.bulk_sign(rows, self.ca, day, False, chunk=1))
+        self.assertEqual([], CSR.unsigned())
+        self.assertEqual(2, Certificate.query().filter_by(csr_id=3).count())
+
+    def test_reject(self):
+        rows = tool.select_bulk(ids=[(2, 3)])
+        self.assertEqual(2, tool.bulk_reject(rows))
+        rejected = CSR.query().filter_by(rejected=True).all()
+        self.assertEqual([2, 3], sorted(csr.id for csr in rejected))
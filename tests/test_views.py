@@ -1,6 +1,7 @@
 #! /usr/bin/env python
 # vim: expandtab shiftwidth=4 softtabstop=4 tabstop=17 filetype=python :
 import datetime
+import hashlib
 import unittest
 import unittest.mock
 
@@ -12,11 +13,15 @@ from pyramid.httpexceptions import (
     HTTPRequestEntityTooLarge,
 )
 from pyramid.response import Response
+from sqlalchemy import create_engine
 
 from caramel import views
 from caramel.models import (
     CSR,
+    REPLICA,
     AccessLog,
+    Base,
+    DBSession,
 )
 
 from . import ModelTestCase, fixtures
@@ -55,6 +60,20 @@ class TestCSRAdd(ModelTestCase):
         req = dummypost(fixtures.CSRData.good)
         csr = views.csr_add(req)
         self.assertSimilar(fixtures.CSRData.good, csr)
+        self.assertEqual(req.response.status_int, 202)
+        self.assertIn("Retry-After", req.response.headers)
+
+    def test_query_count(self):
+        # Includes the backlog's one-off check for the autosign batches table
+        with self.assertMaxQueries(4):
+            views.csr_add(dummypost(fixtures.CSRData.good))
+
+    def test_ca_cached(self):
+        """The CA is read once per registry"""
+        views.csr_add(dummypost(fixtures.CSRData.good))
+        with self.assertRaises(HTTPBadRequest):
+            views.csr_add(dummypost(fixtures.CSRData.good))
+        self.assertEqual(views.SigningCert.from_files.call_count, 1)
 
     def test_duplicate(self):
         req = dummypost(fixtures.CSRData.initial)
@@ -149,6 +168,49 @@ class TestCertFetch(ModelTestCase):
             csr.accessed[0].when, now, delta=datetime.timedelta(seconds=1)
         )
 
+    def test_query_count(self):
+        self.req.matchdict["sha256"] = fixtures.CSRData.initial.sha256sum
+        with self.assertMaxQueries(3):
+            views.cert_fetch(self.req)
+
+    def test_etag(self):
+        """The ETag is the sha256 of the certificate"""
+        sha256sum = fixtures.CSRData.initial.sha256sum
+        csr = CSR.by_sha256sum(sha256sum)
+        self.req.matchdict["sha256"] = sha256sum
+        resp = views.cert_fetch(self.req)
+        pem = csr.certificates[0].pem
+        self.assertEqual(resp.etag, hashlib.sha256(pem).hexdigest())
+        self.assertTrue(resp.conditional_response)
+
+    def test_replica_behind(self):
+        """A replica missing the request falls back on the primary"""
+        replica = create_engine("sqlite://")
+        Base.metadata.create_all(replica)
+        REPLICA.configure(replica)
+        self.addCleanup(REPLICA.configure, None)
+        sha256sum = fixtures.CSRData.initial.sha256sum
+        csr = CSR.by_sha256sum(sha256sum)
+        accesses = len(AccessLog.all())
+        self.req.matchdict["sha256"] = sha256sum
+        resp = views.cert_fetch(self.req)
+        self.assertEqual(resp.body, csr.certificates[0].pem)
+        self.assertEqual(len(AccessLog.all()), accesses + 1)
+
+    def test_replica_unsigned(self):
+        """Polls for unsigned requests are answered by an up to date replica"""
+        REPLICA.configure(DBSession.get_bind())
+        self.addCleanup(REPLICA.configure, None)
+        csr = fixtures.CSRData.good()
+        csr.save()
+        self.req.matchdict["sha256"] = csr.sha256sum
+        with unittest.mock.patch.object(
+            CSR, "by_sha256sum", wraps=CSR.by_sha256sum
+        ) as by_sha256sum:
+            views.cert_fetch(self.req)
+        self.assertEqual(self.req.response.status_int, 202)
+        by_sha256sum.assert_called_once_with(csr.sha256sum)
+
     def test_exists_expired(self):
         csr = fixtures.CSRData.with_expired_cert()
         csr.save()
@@ -158,6 +220,8 @@ class TestCertFetch(ModelTestCase):
         # Verify response contents
         self.assertIs(resp, csr)
         self.assertEqual(self.req.response.status_int, 202)
+        # No replacement before the refresh job runs
+        self.assertEqual(self.req.response.headers["Retry-After"], "300")
         # Verify there's a new AccessLog entry
         self.assertEqual(csr.accessed[0].addr, self.req.remote_addr)
         self.assertAlmostEqual(
@@ -173,6 +237,8 @@ class TestCertFetch(ModelTestCase):
         # Verify response contents
         self.assertIs(resp, csr)
         self.assertEqual(self.req.response.status_int, 202)
+        # The autosigner hasn't signed anything recently, so it's the minimum
+        self.assertEqual(self.req.response.headers["Retry-After"], "5")
         # Verify there's a new AccessLog entry
         self.assertEqual(csr.accessed[0].addr, self.req.remote_addr)
         self.assertAlmostEqual(